@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# Benchmark of the export of sequences (see tools/mdb-export-sequences), with
+# records written directly from MongoDB documents or, as formerly, with Sequence
+# objects converted into Biopython SeqRecord objects and written by SeqIO. No
+# MongoDB server is needed; the former implementation requires Biopython.
+# Usage: python benchmarks/bench_export.py [--sequences N] [--format FORMAT]
+
+import optparse
+import random, time
+import cStringIO
+
+import common
+from MetagenomeDB.orm import methods
+from MetagenomeDB.tools import formats
+from MetagenomeDB import Sequence
+
+p = optparse.OptionParser(description = "Benchmark of the export of sequences")
+
+p.add_option("--sequences", dest = "number_of_sequences", type = "int", default = 20000, metavar = "INTEGER",
+	help = "Number of sequences to export (default: %default)")
+
+p.add_option("--length", dest = "sequence_length", type = "int", default = 250, metavar = "INTEGER",
+	help = "Average length of the sequences (default: %default)")
+
+p.add_option("--format", dest = "format", default = "fasta", metavar = "STRING",
+	help = "Either 'fasta' or 'fastq' (default: %default)")
+
+p.add_option("--repeat", dest = "repeat", type = "int", default = 3, metavar = "INTEGER",
+	help = "Number of measurements; the best is reported (default: %default)")
+
+(p, a) = p.parse_args()
+
+import bson
+
+rng = random.Random(0)
+
+# documents as stored by Sequence objects and returned by pymongo
+documents = []
+for i in xrange(p.number_of_sequences):
+	length = rng.randint(p.sequence_length // 2, p.sequence_length * 3 // 2)
+	sequence, length = Sequence._process_sequence(common.random_sequence(length, rng))
+
+	document = {
+		u"_id": bson.objectid.ObjectId(common.object_id(rng)),
+		u"name": u"read%06d" % i,
+		u"description": u"read%06d length=%d" % (i, length),
+		u"sequence": sequence,
+		u"length": length,
+		u"_relationship_with": [],
+	}
+
+	if (p.format == "fastq"):
+		document[u"quality"] = Sequence._process_quality({
+			"values": [rng.randint(2, 40) for j in xrange(length)],
+			"scale": "PHRED"
+		})
+
+	documents.append(document)
+
+def export_with_seqio():
+	from Bio import SeqIO
+	from Bio.Seq import Seq
+	from Bio.SeqRecord import SeqRecord
+
+	def records():
+		for document in documents:
+			sequence = methods._forge_from_entry("Sequence", document)
+
+			record = SeqRecord(
+				id = sequence.peek("name"),
+				seq = Seq(sequence["sequence"]),
+				description = sequence.peek("description", '')
+			)
+
+			if (p.format == "fastq"):
+				record.letter_annotations["phred_quality"] = sequence["quality"]["values"].tolist()
+
+			yield record
+
+	output = cStringIO.StringIO()
+	SeqIO.write(records(), output, p.format)
+
+	return output.getvalue()
+
+def export_with_formats():
+	records = [(
+		document["name"],
+		document["description"],
+		document["sequence"],
+		document.get("quality")
+	) for document in documents]
+
+	output = cStringIO.StringIO()
+	formats.write_sequences(records, output, p.format)
+
+	return output.getvalue()
+
+def best (function):
+	throughputs = []
+	for i in xrange(p.repeat):
+		t = time.time()
+		function()
+		throughputs.append(len(documents) / (time.time() - t))
+
+	return max(throughputs)
+
+try:
+	import Bio
+	has_biopython = True
+except ImportError:
+	has_biopython = False
+
+after = best(export_with_formats)
+
+if (has_biopython):
+	before = best(export_with_seqio)
+
+	# sanity check: both implementations must produce the same file
+	assert (export_with_seqio() == export_with_formats())
+
+print "%d sequences of %d nucleotides in average (%s format)" % (p.number_of_sequences, p.sequence_length, p.format)
+print
+
+print "%-32s %12s %12s %9s" % ("benchmark", "before", "after", "speed-up")
+
+if (has_biopython):
+	print "%-32s %12.0f %12.0f %8.2fx" % ("sequences exported per second", before, after, after / before)
+else:
+	print "%-32s %12s %12.0f %9s" % ("sequences exported per second", "n/a", after, "n/a")
+	print
+	print "(Biopython is not installed; the former implementation was not measured)"
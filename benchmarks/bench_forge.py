@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Benchmark of the instanciation of objects from MongoDB documents ('forging'),
+# with documents decoded in a single pass or, as formerly, with a generic tree
+# traversal followed by an expansion of the properties. No MongoDB server is
+# needed. Usage: python benchmarks/bench_forge.py [--hits N] [--objects N]
+
+import optparse
+import time
+
+import common
+import legacy_tree
+from MetagenomeDB.orm import methods, cache
+
+p = optparse.OptionParser(description = "Benchmark of the instanciation of objects from MongoDB documents")
+
+p.add_option("--hits", dest = "number_of_hits", type = "int", default = 50, metavar = "INTEGER",
+	help = "Number of hits of each sequence (default: %default)")
+
+p.add_option("--objects", dest = "number_of_objects", type = "int", default = 2000, metavar = "INTEGER",
+	help = "Number of objects to forge (default: %default)")
+
+p.add_option("--repeat", dest = "repeat", type = "int", default = 3, metavar = "INTEGER",
+	help = "Number of measurements; the best is reported (default: %default)")
+
+(p, a) = p.parse_args()
+
+import bson
+
+documents = []
+for i in xrange(p.number_of_objects):
+	document = common.blast_query_document(p.number_of_hits, seed = i)
+	document["_id"] = bson.objectid.ObjectId(document["_id"])
+	documents.append(document)
+
+def legacy_decode (entry):
+	return legacy_tree.traverse(entry, lambda x: True, lambda x: str(x))
+
+def forge():
+	# objects are not kept, so that they are
+	# removed from the cache as they are forged
+	cache.set_size("Sequence", 0)
+	cache.release()
+
+	t = time.time()
+	for document in documents:
+		methods._forge_from_entry("Sequence", document)
+
+	return len(documents) / (time.time() - t)
+
+def best (function):
+	return max([function() for i in xrange(p.repeat)])
+
+decode, is_forged = methods._decode, methods.is_forged
+
+# former implementation: generic traversal, then expansion of the properties
+methods._decode = legacy_decode
+methods.is_forged = lambda properties: False
+before = best(forge)
+
+methods._decode, methods.is_forged = decode, is_forged
+after = best(forge)
+
+# sanity check: both implementations must produce the same properties
+instance = methods._forge_from_entry("Sequence", documents[0])
+assert (instance._properties == legacy_tree.expand(legacy_decode(documents[0])))
+
+print "%d sequences with %d hits each" % (p.number_of_objects, p.number_of_hits)
+print
+
+print "%-32s %12s %12s %9s" % ("benchmark", "before", "after", "speed-up")
+print "%-32s %12.0f %12.0f %8.2fx" % ("objects forged per second", before, after, after / before)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# Micro-benchmark of MetagenomeDB.utils.tree against its former implementation
+# (legacy_tree.py), on documents similar to those created when importing BLAST
+# alignments. Usage: python benchmarks/bench_tree.py [--hits N]
+
+import optparse
+import copy
+
+import common
+import legacy_tree
+from MetagenomeDB.utils import tree
+
+p = optparse.OptionParser(description = "Benchmark of MetagenomeDB.utils.tree")
+
+p.add_option("--hits", dest = "number_of_hits", type = "int", default = 50, metavar = "INTEGER",
+	help = "Number of hits of the query sequence (default: %default)")
+
+p.add_option("--duration", dest = "duration", type = "float", default = 0.5, metavar = "SECONDS",
+	help = "Minimal duration of each measurement (default: %default)")
+
+(p, a) = p.parse_args()
+
+document = common.blast_query_document(p.number_of_hits)
+relationship = document["_relationships"].values()[0][0]
+
+property_keys = [
+	"name", "length", "class",
+	u"run.algorithm.name", u"run.algorithm.parameters.expect",
+	u"score.e_value", u"score.percent_identity",
+	u"alignment.source_coordinates", u"run.database.name",
+]
+
+relationship_filter = {
+	"type": "similar-to",
+	"run": {"algorithm": {"name": "BLASTN"}},
+	"score": {"e_value": {"$lt": 1e-5}, "percent_identity": {"$gte": 90}},
+}
+
+dotted_properties = dict([(key, i) for i, key in enumerate(property_keys)])
+
+def benchmarks (module):
+	keys = [module.expand_key(key) for key in property_keys[3:]]
+
+	def expand_key():
+		for key in property_keys:
+			module.expand_key(key)
+
+	def get():
+		for key in keys:
+			module.get(relationship, key)
+
+	def contains():
+		for key in keys:
+			module.contains(relationship, key)
+			module.contains(relationship, key + ("missing",))
+
+	def set_and_delete():
+		r = {}
+		for key in keys:
+			module.set(r, key, 0)
+		for key in keys:
+			module.delete(r, key)
+
+	def items():
+		return module.items(relationship)
+
+	def flatten():
+		return module.flatten(relationship_filter)
+
+	def expand():
+		return module.expand(dotted_properties)
+
+	def decode():
+		return module.traverse(document, lambda x: True, lambda x: str(x))
+
+	return (
+		("expand_key", expand_key),
+		("get", get),
+		("contains", contains),
+		("set + delete", set_and_delete),
+		("items (relationship)", items),
+		("flatten (relationship filter)", flatten),
+		("expand (dotted properties)", expand),
+		("traverse (query sequence)", decode),
+	)
+
+# sanity check: both implementations must return the same results
+for ((name, before), (name_, after)) in zip(benchmarks(legacy_tree), benchmarks(tree)):
+	before, after = before(), after()
+	if (type(before) == list):
+		before, after = sorted(before), sorted(after)
+
+	assert (before == after), name
+
+print "query sequence with %d hits, %d relationships" % (
+	p.number_of_hits, sum([len(r) for r in document["_relationships"].itervalues()]))
+print
+
+common.report_header()
+
+for ((name, before), (name_, after)) in zip(benchmarks(legacy_tree), benchmarks(tree)):
+	common.report(name,
+		common.timeit(before, duration = p.duration),
+		common.timeit(after, duration = p.duration))
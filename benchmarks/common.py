@@ -0,0 +1,134 @@
+# Helpers shared by the benchmarks: realistic documents and timing
+
+import sys, os
+import random, time
+
+# benchmarks are run from a source checkout
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+def random_sequence (length, rng):
+	return ''.join([rng.choice("ACGT") for i in xrange(length)])
+
+def blast_relationship (rng, include_alignment = False):
+	""" Return a relationship as created by mdb-import-BLAST-alignments
+	"""
+	query_start, sbjct_start = rng.randint(1, 500), rng.randint(1, 500)
+	align_length = rng.randint(50, 300)
+
+	r = {
+		"type": "similar-to",
+		"run": {
+			"date": {"year": 2010, "month": 6, "day": 21},
+			"algorithm": {
+				"name": "BLASTN",
+				"version": "2.2.23+",
+				"parameters": {
+					"expect": 10.0,
+					"matrix": "",
+					"gap_open": 5,
+					"gap_extend": 2,
+					"sc_match": 1,
+					"sc_mismatch": -3,
+					"filter": "L;m;"
+				},
+			},
+			"database": {
+				"name": "nt",
+				"number_of_sequences": 11520542,
+				"number_of_letters": 29395347232,
+			}
+		},
+		"score": {
+			"percent_identity": rng.uniform(70, 100),
+			"percent_positives": rng.uniform(70, 100),
+			"e_value": 10 ** -rng.randint(1, 80),
+			"gaps": rng.randint(0, 10),
+		},
+		"alignment": {
+			"source_coordinates": [query_start, query_start + align_length],
+			"target_coordinates": [sbjct_start, sbjct_start + align_length],
+		},
+	}
+
+	if (include_alignment):
+		r["alignment"]["source"] = random_sequence(align_length, rng)
+		r["alignment"]["match"] = '|' * align_length
+		r["alignment"]["target"] = random_sequence(align_length, rng)
+
+	return r
+
+def object_id (rng):
+	return "%024x" % rng.getrandbits(96)
+
+def blast_query_document (number_of_hits = 50, seed = 0):
+	""" Return a Sequence document, as returned by pymongo (i.e., with unicode
+		keys and strings), for a query sequence related to a number of hits
+	"""
+	rng = random.Random(seed)
+
+	def to_unicode (value):
+		value_t = type(value)
+
+		if (value_t == dict):
+			return dict([(unicode(k), to_unicode(v)) for (k, v) in value.iteritems()])
+
+		if (value_t == list):
+			return [to_unicode(v) for v in value]
+
+		if (value_t == str):
+			return unicode(value)
+
+		return value
+
+	relationships = {}
+	for i in xrange(number_of_hits):
+		relationships[object_id(rng)] = [blast_relationship(rng) for j in xrange(rng.randint(1, 3))]
+
+	collection_id = object_id(rng)
+	relationships[collection_id] = [{"type": "part-of"}]
+
+	return to_unicode({
+		"_id": object_id(rng),
+		"name": "contig%05d" % seed,
+		"length": 1000,
+		"class": "contig",
+		"_relationship_with": relationships.keys(),
+		"_relationships": relationships,
+		"_creation_time": "2010-06-21 11:05:23",
+	})
+
+def timeit (function, repeat = 3, duration = 0.5):
+	""" Return the best time per call of a function, in seconds
+	"""
+	# number of calls needed to run for at least the given duration
+	n = 1
+	while True:
+		t = time.time()
+		for i in xrange(n):
+			function()
+		t = time.time() - t
+
+		if (t >= duration / 10):
+			break
+
+		n *= 10
+
+	n = max(1, int(n * duration / 10 / max(t, 1e-9)))
+
+	best = None
+	for i in xrange(repeat):
+		t = time.time()
+		for j in xrange(n):
+			function()
+		t = (time.time() - t) / n
+
+		if (best == None) or (t < best):
+			best = t
+
+	return best
+
+def report (name, before, after):
+	print "%-32s %12.2f %12.2f %8.2fx" % (name, before * 1e6, after * 1e6, before / after)
+
+def report_header (before = "before (us)", after = "after (us)"):
+	print "%-32s %12s %12s %9s" % ("benchmark", before, after, "speed-up")
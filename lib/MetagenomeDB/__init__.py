@@ -71,3 +71,5 @@ def max_verbosity():
 import errors
 import tools
 from objects import *
+from orm.classes import commit_all, batch
+from orm import cache
@@ -6,7 +6,14 @@ import errors
 import utils
 
 import zlib
+import string
 import itertools
+import cStringIO
+import array
+import bson
+import random
+import math
+import time
 
 class Direction:
 	INGOING, SUB = 1, 1
@@ -50,6 +57,25 @@ class Sequence (orm.PersistentObject):
 	__MAX_UNCOMPRESSED_SEQUENCE_SIZE = 1000000
 	__MAX_COMPRESSED_SEQUENCE_SIZE = 1000000
 
+	# nucleotide sequences are packed if long enough, and if they do not
+	# contain too many runs of ambiguous or lower-case (soft-masked) nucleotides
+	__MIN_PACKED_SEQUENCE_SIZE = 32
+	__MIN_NUCLEOTIDES_PER_RUN = 16
+
+	# sequences are only compressed if they can
+	# possibly fit; otherwise, they are stored as blobs
+	__MAX_COMPRESSION_RATIO = 8
+
+	# number of characters per compressed or packed block
+	__BLOCK_SIZE = 65536
+
+	# complement of IUPAC nucleotide codes
+	__COMPLEMENT = string.maketrans("ACGTURYKMSWBDHVNacgturykmswbdhvn", "TGCAAYRMKSWVHDBNtgcaayrmkswvhdbn")
+
+	# the sequence and its quality scores are only
+	# retrieved from the database when accessed
+	_deferred_properties = ("sequence", "quality")
+
 	def __init__ (self, properties):
 		""" Create a new Sequence object.
 
@@ -66,16 +92,30 @@ class Sequence (orm.PersistentObject):
 			can coexist in the database as long as they belong to two different
 			collections (or if they are not related to any collection).
 		"""
-		if (not "name" in properties):
-			raise errors.InvalidObjectError("Property 'name' is missing")
+		# sequence to be stored as a blob on the next commit, and blobs
+		# of former sequences to be removed (see _commit_precallback())
+		self._pending_sequence = None
+		self._obsolete_handles = []
+
+		# sequences retrieved from the database (possibly partially) were
+		# validated and processed when first committed
+		if (not "_id" in properties):
+			if (not "name" in properties):
+				raise errors.InvalidObjectError("Property 'name' is missing")
 
-		if (not "sequence" in properties):
-			raise errors.InvalidObjectError("Property 'sequence' is missing")
+			if (not "sequence" in properties):
+				raise errors.InvalidObjectError("Property 'sequence' is missing")
 
-		sequence, length = Sequence._process_sequence(properties["sequence"])
+			sequence, length = Sequence._process_sequence(properties["sequence"])
 
-		properties["sequence"] = sequence
-		properties["length"] = length
+			if (Sequence._is_blob(sequence)):
+				self._pending_sequence = properties["sequence"]
+
+			properties["sequence"] = sequence
+			properties["length"] = length
+
+			if ("quality" in properties):
+				properties["quality"] = Sequence._process_quality(properties["quality"])
 
 		indices = {
 			"name": False,
@@ -87,52 +127,384 @@ class Sequence (orm.PersistentObject):
 
 	@classmethod
 	def _process_sequence (self, value):
+		# sequences too large to fit even when packed are stored as blobs
+		# straight away, rather than packed or compressed for nothing
+		if (len(value) // 4 > Sequence.__MAX_COMPRESSED_SEQUENCE_SIZE):
+			return {"handle": None, "crc": zlib.crc32(value)}, len(value)
+
+		# storing nucleotide sequences with 2 bits per nucleotide; sequences
+		# longer than a block are packed as blocks of __BLOCK_SIZE nucleotides,
+		# so that any region can be read without retrieving it all
+		if (len(value) >= Sequence.__MIN_PACKED_SEQUENCE_SIZE):
+			blocks, size, n_runs = [], 0, 0
+			for i in xrange(0, len(value), Sequence.__BLOCK_SIZE):
+				block = Sequence._pack(value[i:i + Sequence.__BLOCK_SIZE])
+				if (block == None):
+					break
+
+				blocks.append(block)
+				size += len(block["packed"])
+				n_runs += len(block.get("runs", ())) + len(block.get("lower", ()))
+			else:
+				# sequences with many ambiguous or soft-masked nucleotides are not packed
+				if (size <= Sequence.__MAX_COMPRESSED_SEQUENCE_SIZE) and \
+				   (n_runs <= len(value) / Sequence.__MIN_NUCLEOTIDES_PER_RUN):
+					if (len(blocks) == 1):
+						return blocks[0], len(value)
+
+					return {"blocks": blocks, "block_size": Sequence.__BLOCK_SIZE}, len(value)
+
+				# if packed nucleotides are too large, so would be compressed ones
+				if (size > Sequence.__MAX_COMPRESSED_SEQUENCE_SIZE):
+					return {"handle": None, "crc": zlib.crc32(value)}, len(value)
+
 		# storing the sequence as an uncompressed string
 		if (len(value) <= Sequence.__MAX_UNCOMPRESSED_SEQUENCE_SIZE):
 			return value, len(value)
 
-		sequence, crc = zlib.compress(value, 9), zlib.crc32(value)
+		# storing the sequence as blocks compressed independently,
+		# so that any region can be read without decompressing it all
+		if (len(value) <= Sequence.__MAX_COMPRESSED_SEQUENCE_SIZE * Sequence.__MAX_COMPRESSION_RATIO):
+			blocks, size = [], 0
+			for i in xrange(0, len(value), Sequence.__BLOCK_SIZE):
+				block = value[i:i + Sequence.__BLOCK_SIZE]
+				data = zlib.compress(block)
+
+				size += len(data)
+				if (size > Sequence.__MAX_COMPRESSED_SEQUENCE_SIZE):
+					break
+
+				blocks.append({"data": bson.binary.Binary(data), "crc": zlib.crc32(block)})
+			else:
+				return {"blocks": blocks, "block_size": Sequence.__BLOCK_SIZE}, len(value)
+
+		# storing the sequence as a blob; the blob
+		# itself is created on the next commit
+		return {"handle": None, "crc": zlib.crc32(value)}, len(value)
+
+	@classmethod
+	def _pack (self, value):
+		# pack a nucleotide sequence, or return None if it contains
+		# codes other than IUPAC nucleotide codes (e.g., a protein)
+		try:
+			value_, lower = utils.codec.encode_case(value)
+			packed, runs = utils.codec.encode(value_)
+		except ValueError:
+			return None
+
+		sequence = {"packed": bson.binary.Binary(packed), "crc": zlib.crc32(value)}
+		if (len(runs) > 0):
+			sequence["runs"] = runs
+
+		if (len(lower) > 0):
+			sequence["lower"] = lower
+
+		return sequence
+
+	@classmethod
+	def _decode_blocks (self, blocks):
+		# blocks are either packed or compressed
+		sequence = []
+		for block in blocks:
+			if ("packed" in block):
+				data = utils.codec.decode(block["packed"], block.get("runs", ()))
+				data = utils.codec.decode_case(data, block.get("lower", ()))
+			else:
+				data = zlib.decompress(block["data"])
+
+			if (zlib.crc32(data) != block["crc"]):
+				raise errors.InvalidObjectError("Sequence information has been corrupted.")
+
+			sequence.append(data)
 
-		# storing the sequence as a compressed string
-		if (len(sequence) <= Sequence.__MAX_COMPRESSED_SEQUENCE_SIZE):
-			return {"data": sequence, "crc": crc}, len(value)
+		return ''.join(sequence)
 
-		# storing the sequence as a blob
-		handle = None
+	@classmethod
+	def _process_quality (self, value):
+		# storing quality scores with one byte per score
+		if (type(value) == dict) and ("values" in value):
+			value = value.copy()
+			value["values"] = Sequence._process_quality_scores(value["values"])
+
+		return value
+
+	@classmethod
+	def _process_quality_scores (self, value):
+		if (not type(value) in (list, tuple, array.array)):
+			return value
+
+		try:
+			scores = utils.codec.encode_scores(value)
+		except ValueError:
+			return value
+
+		scores["data"] = bson.binary.Binary(scores["data"])
+		return scores
 
-		raise NotImplementedError() ####
+	@classmethod
+	def _is_blob (self, value):
+		return (type(value) == dict) and ("handle" in value)
 
-		return {"handle": handle, "crc": crc}, len(value)
+	def _stored_handle (self):
+		# identifier of the blob the sequence is
+		# stored in in the database, if any
+		if (not "_id" in self._properties):
+			return None
+
+		if (self._is_loaded(("sequence",))):
+			value = self._properties["sequence"]
+		else:
+			value = orm.methods.load_properties(self, {"sequence.handle": True}).get("sequence")
+
+		if (Sequence._is_blob(value)):
+			return value["handle"]
 
 	def _setitem_precallback (self, key, value):
 		orm.PersistentObject._setitem_precallback(self, key, value)
 
 		if (key == ("sequence",)):
+			handle = self._stored_handle()
+			if (handle != None):
+				self._obsolete_handles.append(handle)
+
 			sequence, length = Sequence._process_sequence(value)
+
+			if (Sequence._is_blob(sequence)):
+				self._pending_sequence = value
+			else:
+				self._pending_sequence = None
+
 			self._properties["length"] = length
+			self._mark_modified(("length",))
 			return sequence
 
 		if (key == ("length",)):
 			raise errors.InvalidObjectOperationError("Property 'length' is tied to 'sequence' and cannot be changed directly.")
 
+		if (key == ("quality",)):
+			return Sequence._process_quality(value)
+
+		if (key == ("quality", "values")):
+			return Sequence._process_quality_scores(value)
+
 		return value
 
+	@classmethod
+	def _decode_sequence (self, value):
+		# decode a sequence as stored in the database (see _process_sequence())
+		if (type(value) in (str, unicode)):
+			return value
+
+		if ("packed" in value):
+			sequence = utils.codec.decode(value["packed"], value.get("runs", ()))
+			sequence = utils.codec.decode_case(sequence, value.get("lower", ()))
+			if (zlib.crc32(sequence) != value["crc"]):
+				raise errors.InvalidObjectError("Sequence information has been corrupted.")
+
+			return sequence
+
+		if ("blocks" in value):
+			return Sequence._decode_blocks(value["blocks"])
+
+		if ("data" in value):
+			sequence = zlib.decompress(value["data"])
+			if (zlib.crc32(sequence) != value["crc"]):
+				raise errors.InvalidObjectError("Sequence information has been corrupted.")
+
+			return sequence
+
+		if ("handle" in value):
+			sequence = orm.blobs.get(value["handle"])
+			if (zlib.crc32(sequence) != value["crc"]):
+				raise errors.InvalidObjectError("Sequence information has been corrupted.")
+
+			return sequence
+
+		raise errors.InvalidObjectError("Invalid value for 'sequence' property.")
+
 	def _getitem_precallback (self, key, value):
 		if (key == ("sequence",)):
-			if (type(value) in (str, unicode)):
-				return value
+			if (Sequence._is_blob(value)) and (self._pending_sequence != None):
+				return self._pending_sequence
+
+			return Sequence._decode_sequence(value)
+
+		# quality scores are returned as arrays of integers, unless
+		# stored as lists (i.e., by former versions of MetagenomeDB)
+		if (key == ("quality",)):
+			if (type(value) == dict) and (type(value.get("values")) == dict):
+				return dict(value, values = utils.codec.decode_scores(value["values"]))
+
+		if (key == ("quality", "values")):
+			if (type(value) == dict):
+				return utils.codec.decode_scores(value)
+
+	def _commit_precallback (self):
+		orm.PersistentObject._commit_precallback(self)
+
+		# sequences too large to be stored in the object are stored as blobs
+		if (self._pending_sequence != None) and (self._properties["sequence"]["handle"] == None):
+			self._properties["sequence"]["handle"] = orm.blobs.put(self._pending_sequence)
+			self._mark_modified(("sequence",))
+
+	def _commit_postcallback (self):
+		orm.PersistentObject._commit_postcallback(self)
+
+		self._pending_sequence = None
+
+		if (len(self._obsolete_handles) > 0):
+			orm.blobs.delete(self._obsolete_handles)
+			self._obsolete_handles = []
+
+	def get_subsequence (self, start, end, strand = '+'):
+		""" Return a region of this sequence.
+
+		Parameters:
+			- **start**: position of the first nucleotide of the region,
+			  starting at 1.
+			- **end**: position of the last nucleotide of the region. If lower
+			  than **start**, the region is read on the reverse strand; this
+			  allows to use the coordinates stored in alignments as-is (e.g.,
+			  'source_coordinates' and 'target_coordinates' properties).
+			- **strand**: either '+' (default) or '-'. If set to '-', the
+			  reverse complement of the region is returned.
+
+		.. note::
+			- Only the part of the sequence covering the region is retrieved
+			  from the database and decoded when possible; i.e., if the sequence
+			  is stored as packed or compressed blocks (nucleotide sequences of
+			  more than 65,536 nucleotides) or as a blob.
+			- A ValueError exception is thrown if the region is not within the
+			  sequence.
+
+		.. seealso::
+			:meth:`Sequence.open_sequence() <MetagenomeDB.Sequence.open_sequence>`
+		"""
+		if (not strand in ('+', '-')):
+			raise ValueError("Invalid strand '%s'" % strand)
+
+		if (start > end):
+			start, end = end, start
+			strand = {'+': '-', '-': '+'}[strand]
+
+		if (start < 1) or (end > self["length"]):
+			raise ValueError("Invalid region [%s, %s] for a sequence of length %s" % (start, end, self["length"]))
+
+		subsequence = self._get_region(start - 1, end)
+
+		if (strand == '-'):
+			return str(subsequence).translate(Sequence.__COMPLEMENT)[::-1]
+
+		return subsequence
 
-			if ("data" in value):
-				sequence = zlib.decompress(value["data"])
-				if (zlib.crc32(sequence) != value["crc"]):
-					raise errors.InvalidObjectError("Sequence information has been corrupted.")
+	def _get_region (self, start, end):
+		# the sequence is to be stored as a blob, and is still in memory
+		if (self._pending_sequence != None):
+			return self._pending_sequence[start:end]
 
-				return sequence
+		first_block = start // Sequence.__BLOCK_SIZE
+		last_block = (end - 1) // Sequence.__BLOCK_SIZE
 
-			if ("handle" in value):
-				pass
+		if (self._is_loaded(("sequence",))):
+			value, offset = self._properties["sequence"], 0
+		else:
+			# only the blocks covering the region (if any) are retrieved
+			with orm.connection.protect():
+				properties = orm.methods.load_properties(self, {
+					"sequence.blocks": {"$slice": [first_block, last_block - first_block + 1]},
+					"sequence.block_size": True,
+					"sequence.packed": True,
+					"sequence.runs": True,
+					"sequence.lower": True,
+					"sequence.crc": True,
+					"sequence.data": True,
+					"sequence.handle": True,
+				})
+
+			value, offset = properties.get("sequence"), first_block
+
+			# the sequence is stored as a string
+			if (value == None):
+				self._load_property(("sequence",))
+				value, offset = self._properties["sequence"], 0
+
+		if (type(value) in (str, unicode)):
+			return value[start:end]
+
+		if ("packed" in value):
+			region = utils.codec.decode(value["packed"], value.get("runs", ()), start, end)
+			return utils.codec.decode_case(region, value.get("lower", ()), start)
+
+		if ("blocks" in value) and (value["block_size"] == Sequence.__BLOCK_SIZE):
+			blocks = value["blocks"][first_block - offset:last_block - offset + 1]
+			start_ = start - first_block * Sequence.__BLOCK_SIZE
+			return Sequence._decode_blocks(blocks)[start_:start_ + end - start]
+
+		if ("handle" in value):
+			file = orm.blobs.open(value["handle"])
+			with orm.connection.protect():
+				file.seek(start)
+				return file.read(end - start)
+
+		return self["sequence"][start:end]
+
+	def open_sequence (self):
+		""" Return the sequence as a read-only file-like object, with read(),
+		seek() and tell() methods. Sequences stored as blobs are read from the
+		database by chunks, as they are consumed.
+		"""
+		self._load_property(("sequence",))
+		value = self._properties["sequence"]
+
+		if (Sequence._is_blob(value)) and (self._pending_sequence == None):
+			return orm.blobs.open(value["handle"])
+
+		return cStringIO.StringIO(self["sequence"])
+
+	def remove (self):
+		""" Remove this sequence from the database.
+
+		.. note::
+			- Relationships from and to this sequence are removed as well.
+			- The sequence remains in memory, flagged as uncommitted.
+		"""
+		handle = self._stored_handle()
+
+		orm.PersistentObject.remove(self)
+
+		if (handle != None):
+			orm.blobs.delete([handle])
+
+	@classmethod
+	def remove_all (cls, filter = None):
+		""" Remove all sequences from the database, or only those matching
+		a filter. See :meth:`~MetagenomeDB.orm.PersistentObject.remove_all`.
+		"""
+		query = {"sequence.handle": {"$exists": True}}
+		if (filter != None) and (filter != {}):
+			query = {"$and": [filter, query]}
+
+		handles = orm.methods.distinct(cls.__name__, "sequence.handle", query).keys()
 
-			raise errors.InvalidObjectError("Invalid value for 'sequence' property.")
+		n = super(Sequence, cls).remove_all(filter)
+
+		if (len(handles) > 0):
+			orm.blobs.delete(handles)
+
+		return n
+
+	@classmethod
+	def _forget_instances (cls, instances):
+		# sequences stored as blobs are kept in memory,
+		# to be stored as new blobs if committed again
+		for object in instances:
+			if (Sequence._is_blob(object._properties.get("sequence"))):
+				if (object._pending_sequence == None):
+					object._pending_sequence = object["sequence"]
+
+				object._properties["sequence"]["handle"] = None
+
+		super(Sequence, cls)._forget_instances(instances)
 
 	def _delitem_precallback (self, key):
 		orm.PersistentObject._delitem_precallback(self, key)
@@ -157,7 +529,9 @@ class Sequence (orm.PersistentObject):
 
 		.. note::
 			- If the collection already contains a sequence with the same name
-			  a :class:`MetagenomeDB.errors.DuplicateObjectError` exception is thrown.
+			  a :class:`MetagenomeDB.errors.DuplicateObjectError` exception is
+			  thrown; within a :func:`~MetagenomeDB.batch` context, sequences
+			  queued for commit are considered as well.
 			- If the collection has never been committed to the database a
 			  :class:`MetagenomeDB.errors.UncommittedObjectError` is thrown.
 			- This sequence will need to be committed to the database for the
@@ -170,7 +544,10 @@ class Sequence (orm.PersistentObject):
 		if (not isinstance(collection, Collection)):
 			raise ValueError("The 'collection' parameter must be a Collection object.")
 
-		if (collection.count_sequences({"name": self["name"]}) > 0):
+		# sequences queued for commit within a batch() context
+		# are not in the database yet, and are checked first
+		if (orm.classes._is_queued(collection, self["name"])) or \
+		   (collection.count_sequences({"name": self["name"]}) > 0):
 			raise errors.DuplicateObjectError(
 				self.__class__.__name__,
 				(("name", self["name"]),),
@@ -203,7 +580,7 @@ class Sequence (orm.PersistentObject):
 
 		self._disconnect_from(collection, relationship_filter)
 
-	def list_collections (self, collection_filter = None, relationship_filter = None):
+	def list_collections (self, collection_filter = None, relationship_filter = None, fields = None):
 		""" List collections this sequence is linked to.
 
 		Parameters:
@@ -211,6 +588,8 @@ class Sequence (orm.PersistentObject):
 			  :doc:`queries`.
 			- **relationship_filter**: filter for the relationship linking this
 			  sequence to collections (optional). See :doc:`queries`.
+			- **fields**: properties of the collections to retrieve (optional).
+			  See :meth:`Collection.find() <MetagenomeDB.Collection.find>`.
 
 		.. note::
 			- If this sequence is not committed and **relationship_filter** is
@@ -220,7 +599,7 @@ class Sequence (orm.PersistentObject):
 		.. seealso::
 			:meth:`Sequence.count_collections() <MetagenomeDB.Sequence.count_collections>`
 		"""
-		return self._out_vertices("Collection", collection_filter, relationship_filter)
+		return self._out_vertices("Collection", collection_filter, relationship_filter, fields = fields)
 
 	def count_collections (self, collection_filter = None, relationship_filter = None):
 		""" Count collections this sequence is linked to.
@@ -250,34 +629,59 @@ class Sequence (orm.PersistentObject):
 		Parameters:
 			- **collection_filter**: filter for the top collections (optional). See :doc:`queries`.
 		"""
-		# we list all top collections
-		top, visited = {}, {}
-		def crawl (collection):
-			if (collection.count_super_collections() == 0):
-				top[collection] = True
-			else:
-				for super_collection in collection.list_super_collections():
-					if (super_collection in visited):
-						continue
+		collections, super_collections, sub_collections = _collection_graph()
 
-					crawl(super_collection)
-					visited[super_collection] = True
+		# we list all top collections, starting from
+		# the collections this sequence belongs to
+		top, visited = [], set()
+		stack = [id for id in self.peek("_relationship_with", ()) if (id in collections)]
 
-		for collection in self.list_collections():
-			crawl(collection)
+		while (len(stack) > 0):
+			id = stack.pop()
+			if (id in visited):
+				continue
+
+			visited.add(id)
+
+			if (len(super_collections[id]) == 0):
+				top.append(id)
+			else:
+				stack.extend(super_collections[id])
 
 		# we then filter these collections, if needed
-		if (collection_filter == None):
-			return sorted(top.keys())
+		return _select_collections(collections, top, collection_filter)
 
-		else:
-			query = {"_id": {"$in": [collection["_id"] for collection in top]}}
+	@classmethod
+	def _orphan_filter (cls):
+		# a sequence is an orphan if none of the objects
+		# it has relationships with is a collection
+		collection_ids = [str(id) for id in orm.methods.find_ids("Collection")]
+		return {"_relationship_with": {"$nin": collection_ids}}
 
-			collection_filter = utils.tree.expand(collection_filter)
-			for key in collection_filter:
-				query[key] = collection_filter[key]
+	@classmethod
+	def count_orphans (cls):
+		""" Count all sequences that belong to no collection.
 
-			return backend.find("Collection", query)
+		.. seealso::
+			:meth:`Sequence.remove_orphans() <MetagenomeDB.Sequence.remove_orphans>`
+		"""
+		return cls.count(cls._orphan_filter())
+
+	@classmethod
+	def remove_orphans (cls):
+		""" Remove all sequences that belong to no collection.
+
+		Return:
+			The number of sequences removed.
+
+		.. note::
+			Sequences are selected with a single query, then removed by
+			batches of 1,000.
+
+		.. seealso::
+			:meth:`Sequence.count_orphans() <MetagenomeDB.Sequence.count_orphans>`
+		"""
+		return cls.remove_all(cls._orphan_filter())
 
 	def relate_to_sequence (self, sequence, relationship = None):
 		""" Link this sequence to another sequence.
@@ -394,9 +798,9 @@ class Sequence (orm.PersistentObject):
 
 	def __str__ (self):
 		return "<Sequence id:%s name:'%s' length:%s state:'%s'>" % (
-			self.get_property("_id", "none"),
-			self["name"],
-			self["length"],
+			self.peek("_id", "none"),
+			self.peek("name"),
+			self.peek("length"),
 			{True: "committed", False: "uncommitted"}[self.is_committed()],
 		)
 
@@ -417,7 +821,7 @@ class Collection (orm.PersistentObject):
 			  the same name a :class:`MetagenomeDB.errors.DuplicateObjectError`
 			  exception is thrown.
 		"""
-		if (not "name" in properties):
+		if (not "_id" in properties) and (not "name" in properties):
 			raise errors.InvalidObjectError("Property 'name' is missing")
 
 		indices = {
@@ -433,7 +837,7 @@ class Collection (orm.PersistentObject):
 		if (key == ("name",)):
 			raise errors.InvalidObjectOperationError("Property 'name' cannot be deleted.")
 
-	def list_sequences (self, sequence_filter = None, relationship_filter = None):
+	def list_sequences (self, sequence_filter = None, relationship_filter = None, fields = None):
 		""" List sequences this collection contains.
 
 		Parameters:
@@ -441,11 +845,13 @@ class Collection (orm.PersistentObject):
 			  See :doc:`queries`.
 			- **relationship_filter**: filter for the relationship linking
 			  sequences to this collection (optional). See :doc:`queries`.
+			- **fields**: properties of the sequences to retrieve (optional).
+			  See :meth:`Sequence.find() <MetagenomeDB.Sequence.find>`.
 
 		.. seealso::
 			:meth:`Collection.count_sequences() <MetagenomeDB.Collection.count_sequences>`
 		"""
-		return self._in_vertices("Sequence", sequence_filter, relationship_filter)
+		return self._in_vertices("Sequence", sequence_filter, relationship_filter, fields = fields)
 
 	def count_sequences (self, sequence_filter = None, relationship_filter = None):
 		""" Count sequences this collection contains.
@@ -461,6 +867,124 @@ class Collection (orm.PersistentObject):
 		"""
 		return self._in_vertices("Sequence", sequence_filter, relationship_filter, True)
 
+	def distinct_sequences (self, property, sequence_filter = None, relationship_filter = None):
+		""" For each value found for a given property amongst the sequences this
+		collection contains, return the number of sequences that have this value.
+
+		Parameters:
+			- **property**: property to count sequences for. Nested properties
+			  can be expressed using dot notation (e.g., 'taxonomy.genus').
+			- **sequence_filter**: filter for the sequences to consider
+			  (optional). See :doc:`queries`.
+			- **relationship_filter**: filter for the relationship linking
+			  sequences to this collection (optional). See :doc:`queries`.
+
+		Return:
+			A dictionary with all values found for this property as keys, and
+			number of sequences having this value as values.
+
+		.. seealso::
+			:meth:`Sequence.distinct() <MetagenomeDB.Sequence.distinct>`
+		"""
+		return self._in_vertices("Sequence", sequence_filter, relationship_filter, distinct = property)
+
+	def resolve_sequences (self, names, chunk_size = 1000, fields = None):
+		""" Retrieve sequences this collection contains from their names.
+
+		Parameters:
+			- **names**: names of the sequences to retrieve, as an iterable.
+			- **chunk_size**: number of names looked up per query (optional).
+			- **fields**: properties of the sequences to retrieve (optional).
+			  See :meth:`Sequence.find() <MetagenomeDB.Sequence.find>`.
+
+		Returns:
+			A tuple with (1) a dictionary mapping names to the only sequence
+			in this collection having this name, (2) a list of the names no
+			sequence in this collection has, and (3) a list of the names more
+			than one sequence in this collection has.
+
+		.. note::
+			Names are resolved by batches of **chunk_size** names, each batch
+			requiring a single query in the database. Names of ambiguous
+			sequences do not appear in the returned dictionary.
+
+		.. seealso::
+			:meth:`Collection.list_sequences() <MetagenomeDB.Collection.list_sequences>`
+		"""
+		if (chunk_size < 1):
+			raise ValueError("Invalid chunk size: %s" % chunk_size)
+
+		# unique names, in order of first appearance
+		names_, seen = [], {}
+		for name in names:
+			if (name in seen):
+				continue
+
+			names_.append(name)
+			seen[name] = True
+
+		candidates = {}
+		for i in range(0, len(names_), chunk_size):
+			chunk = names_[i:i + chunk_size]
+
+			for sequence in self._in_vertices("Sequence", {"name": {"$in": chunk}}, fields = fields):
+				candidates.setdefault(sequence.peek("name"), []).append(sequence)
+
+		sequences, missing, ambiguous = {}, [], []
+		for name in names_:
+			matches = candidates.get(name, [])
+
+			if (len(matches) == 0):
+				missing.append(name)
+			elif (len(matches) > 1):
+				ambiguous.append(name)
+			else:
+				sequences[name] = matches[0]
+
+		return sequences, missing, ambiguous
+
+	def sample_sequences (self, n, seed = None, sequence_filter = None, fields = None):
+		""" Select sequences this collection contains at random.
+
+		Parameters:
+			- **n**: number of sequences to select.
+			- **seed**: seed of the random number generator (optional). With
+			  the same seed, the same sequences are selected as long as the
+			  collection is not modified.
+			- **sequence_filter**: filter for the sequences to select from
+			  (optional). See :doc:`queries`.
+			- **fields**: properties of the sequences to retrieve (optional).
+			  See :meth:`Sequence.find() <MetagenomeDB.Sequence.find>`.
+
+		Return:
+			A list of **n** sequences, or of all sequences if the collection
+			contains less than **n** sequences.
+
+		.. note::
+			Sequences are selected by reservoir sampling over their identifiers,
+			which are the only properties retrieved for all sequences. Only the
+			selected sequences are then retrieved, by batches of 1,000.
+
+		.. seealso::
+			:meth:`Collection.list_sequences() <MetagenomeDB.Collection.list_sequences>`
+		"""
+		ids = self._sample_sequence_ids(n, seed, sequence_filter)
+
+		sequences = []
+		for i in range(0, len(ids), 1000):
+			sequences.extend(self._in_vertices("Sequence", {"_id": {"$in": ids[i:i + 1000]}}, fields = fields))
+
+		return sequences
+
+	def _sample_sequence_ids (self, n, seed = None, sequence_filter = None):
+		if (n < 0):
+			raise ValueError("Invalid sample size: %s" % n)
+
+		ids = (document["_id"] for document in
+			self._in_vertices("Sequence", sequence_filter, fields = ["_id"], raw = True))
+
+		return _sample(ids, n, random.Random(seed))
+
 	def add_to_collection (self, collection, relationship = None):
 		""" Add this collection to a (super) collection.
 
@@ -651,9 +1175,196 @@ class Collection (orm.PersistentObject):
 
 		return collections_c
 
+	def list_ancestor_collections (self, collection_filter = None, max_depth = None):
+		""" List all collections this collection is linked to, directly or
+		through other collections (i.e., super-collections, super-collections
+		of these super-collections, and so on).
+
+		Parameters:
+			- **collection_filter**: filter for the collections to list (optional).
+			  See :doc:`queries`.
+			- **max_depth**: maximum number of relationships between this
+			  collection and the collections to list (optional). Default: no limit.
+
+		.. note::
+			- The collections are listed from the closest to the farthest.
+			- The collection graph is read in a single query, then kept in
+			  memory until a collection is committed or removed, or for at
+			  most a few seconds.
+
+		.. seealso::
+			:meth:`Collection.list_descendant_collections() <MetagenomeDB.Collection.list_descendant_collections>`,
+			:meth:`Collection.list_super_collections() <MetagenomeDB.Collection.list_super_collections>`
+		"""
+		collections, super_collections, sub_collections = _collection_graph()
+		return _select_collections(collections,
+			_crawl_collections(self, collections, super_collections, max_depth),
+			collection_filter)
+
+	def list_descendant_collections (self, collection_filter = None, max_depth = None):
+		""" List all collections that are linked to this collection, directly
+		or through other collections (i.e., sub-collections, sub-collections of
+		these sub-collections, and so on).
+
+		Parameters:
+			- **collection_filter**: filter for the collections to list (optional).
+			  See :doc:`queries`.
+			- **max_depth**: maximum number of relationships between the
+			  collections to list and this collection (optional). Default: no limit.
+
+		.. note::
+			- The collections are listed from the closest to the farthest.
+			- The collection graph is read in a single query, then kept in
+			  memory until a collection is committed or removed, or for at
+			  most a few seconds.
+
+		.. seealso::
+			:meth:`Collection.list_ancestor_collections() <MetagenomeDB.Collection.list_ancestor_collections>`,
+			:meth:`Collection.list_sub_collections() <MetagenomeDB.Collection.list_sub_collections>`
+		"""
+		collections, super_collections, sub_collections = _collection_graph()
+		return _select_collections(collections,
+			_crawl_collections(self, collections, sub_collections, max_depth),
+			collection_filter)
+
+	@classmethod
+	def list_top_collections (cls, collection_filter = None):
+		""" List all collections that are linked to no other collection.
+
+		Parameters:
+			- **collection_filter**: filter for the collections to list (optional).
+			  See :doc:`queries`.
+
+		.. seealso::
+			:meth:`Sequence.list_top_collections() <MetagenomeDB.Sequence.list_top_collections>`
+		"""
+		collections, super_collections, sub_collections = _collection_graph()
+		return _select_collections(collections,
+			[id for id in collections if (len(super_collections[id]) == 0)],
+			collection_filter)
+
 	def __str__ (self):
 		return "<Collection id:%s name:'%s' state:'%s'>" % (
-			self.get_property("_id", "none"),
-			self["name"],
+			self.peek("_id", "none"),
+			self.peek("name"),
 			{True: "committed", False: "uncommitted"}[self.is_committed()],
 		)
+
+#:::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+# Graph of the collections in the database, as (generation, expiration time,
+# collections, super-collections, sub-collections) with collection identifiers
+# (as ObjectId) indexed by their string form, and lists of super- and sub-
+# collection identifiers per collection. The graph is built from the documents
+# committed to the database, in a single query; it is kept until a collection
+# is committed or removed by this process (see orm.methods.generation()), or
+# for at most GRAPH_TTL seconds so that changes made by other clients are
+# eventually seen.
+_graph = None
+
+# maximal number of seconds the collection graph is kept
+GRAPH_TTL = 5
+
+def _collection_graph():
+	global _graph
+
+	generation = orm.methods.generation("Collection")
+	if (_graph != None) and (_graph[0] == generation) and (time.time() < _graph[1]):
+		return _graph[2:]
+
+	# relationships of collections not committed
+	# yet are ignored, as are cached instances
+	documents = list(orm.methods.find("Collection", None, fields = ["_relationship_with"], raw = True))
+
+	collections = {}
+	for document in documents:
+		collections[str(document["_id"])] = document["_id"]
+
+	super_collections = dict([(id, []) for id in collections])
+	sub_collections = dict([(id, []) for id in collections])
+
+	for document in documents:
+		id = str(document["_id"])
+		for target_id in document.get("_relationship_with", ()):
+			# relationships with sequences are ignored
+			if (not target_id in collections):
+				continue
+
+			super_collections[id].append(target_id)
+			sub_collections[target_id].append(id)
+
+	_graph = (generation, time.time() + GRAPH_TTL, collections, super_collections, sub_collections)
+	return _graph[2:]
+
+# List the identifiers of all collections reachable from a collection
+# through a given set of edges, from the closest to the farthest
+def _crawl_collections (collection, collections, edges, max_depth):
+	id = str(collection.peek("_id", None))
+	if (not id in collections):
+		return []
+
+	found, visited, frontier, depth = [], set([id]), [id], 0
+
+	while (len(frontier) > 0) and ((max_depth == None) or (depth < max_depth)):
+		frontier_ = []
+		for id in frontier:
+			for target_id in edges[id]:
+				if (target_id in visited):
+					continue
+
+				visited.add(target_id)
+				found.append(target_id)
+				frontier_.append(target_id)
+
+		frontier = frontier_
+		depth += 1
+
+	return found
+
+# Return the collections with the given identifiers, in
+# the same order, filtered if needed
+def _select_collections (collections, ids, collection_filter):
+	if (len(ids) == 0):
+		return []
+
+	query = {"_id": {"$in": [collections[id] for id in ids]}}
+
+	if (collection_filter != None):
+		collection_filter = utils.tree.expand(collection_filter)
+		for key in collection_filter:
+			query[key] = collection_filter[key]
+
+	selected = dict([(str(collection["_id"]), collection) for collection in Collection.find(query)])
+
+	return [selected[id] for id in ids if (id in selected)]
+
+# Select n items at random from an iterable of unknown length, in a single
+# pass, with as few random numbers drawn as possible (Li's 'algorithm L')
+def _sample (items, n, rng):
+	items = iter(items)
+
+	sample = list(itertools.islice(items, n))
+	if (len(sample) < n) or (n == 0):
+		return sample
+
+	def uniform():
+		# random number in ]0, 1[
+		u = 0.0
+		while (u == 0.0):
+			u = rng.random()
+		return u
+
+	w = math.exp(math.log(uniform()) / n)
+
+	while True:
+		# number of items skipped before the next one is selected
+		skip = int(math.floor(math.log(uniform()) / math.log(1 - w)))
+
+		selected = list(itertools.islice(items, skip, skip + 1))
+		if (len(selected) == 0):
+			break
+
+		sample[rng.randrange(n)] = selected[0]
+		w *= math.exp(math.log(uniform()) / n)
+
+	return sample
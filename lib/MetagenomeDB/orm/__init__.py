@@ -5,3 +5,6 @@ logger = logging.getLogger("MetagenomeDB.ORM")
 from connection import *
 from methods import *
 from classes import *
+
+import relationships
+import blobs
@@ -0,0 +1,76 @@
+# storage of large property values in GridFS
+
+# Note: Documents stored in MongoDB cannot exceed 16 MB. Values too large to
+# be stored as part of their object (e.g., sequences of whole chromosomes) are
+# stored as GridFS files instead, in a 'Blob' collection prefix, and referenced
+# by their file identifier. Values are written and read by chunks, so that they
+# are never duplicated as a whole in memory.
+
+from .. import errors
+import connection
+
+import gridfs
+
+import logging
+
+logger = logging.getLogger("MetagenomeDB.ORM.blobs")
+
+# prefix of the MongoDB collections blobs are stored in
+_COLLECTION_NAME = "Blob"
+
+# size of the chunks blobs are written and read by
+_CHUNK_SIZE = 255 * 1024
+
+def _grid():
+	return gridfs.GridFS(connection.connection(), collection = _COLLECTION_NAME)
+
+def put (value):
+	""" Store a string as a blob, and return the identifier of this blob
+	"""
+	with connection.protect():
+		file = _grid().new_file(chunk_size = _CHUNK_SIZE)
+		try:
+			for i in xrange(0, len(value), _CHUNK_SIZE):
+				file.write(value[i:i + _CHUNK_SIZE])
+		finally:
+			file.close()
+
+	logger.debug("Blob %s created (%s bytes)." % (file._id, len(value)))
+	return file._id
+
+def open (id):
+	""" Return a blob as a read-only file-like object
+	"""
+	with connection.protect():
+		try:
+			return _grid().get(id)
+
+		except gridfs.errors.NoFile:
+			raise errors.InvalidObjectError("Blob %s no longer exists." % id)
+
+def get (id):
+	""" Return the content of a blob, as a string
+	"""
+	file = open(id)
+
+	chunks = []
+	with connection.protect():
+		while True:
+			chunk = file.read(_CHUNK_SIZE)
+			if (chunk == ''):
+				break
+
+			chunks.append(chunk)
+
+	return ''.join(chunks)
+
+def delete (ids):
+	""" Remove blobs, given their identifiers
+	"""
+	grid = _grid()
+
+	with connection.protect():
+		for id in ids:
+			grid.delete(id)
+
+	logger.debug("%s blob%s removed." % (len(ids), {True: 's', False: ''}[len(ids) > 1]))
@@ -0,0 +1,242 @@
+# identity map of the objects retrieved from or committed to the database
+
+# Note: Each object of the database is represented by at most one instance of
+# its class at any time. Instances are referenced by identifier in a map with
+# weak values, so that any instance still in use is found again when the same
+# object is retrieved. In addition, the most recently used instances of each
+# class can be retained (i.e., strongly referenced) so that objects accessed
+# repeatedly, such as collections in importer loops, are not forged again
+# each time their last reference is dropped. By default, only collections are
+# retained, as they are few and small; sequences are not (see set_size()).
+# Retention only applies to instances that are committed; an instance is no
+# longer retained as soon as it is modified.
+
+import weakref
+import collections
+import logging
+
+logger = logging.getLogger("MetagenomeDB.ORM.cache")
+
+# default number of instances retained per class
+DEFAULT_SIZE = 0
+DEFAULT_SIZES = {"Collection": 100}
+
+class IdentityMap (object):
+	""" Map of object identifiers to instances, with a bounded number of
+		most recently used instances retained per class
+	"""
+	def __init__ (self):
+		self._objects = weakref.WeakValueDictionary()
+
+		# most recently used instances, per class name
+		self._retained = {}
+		self._sizes = {}
+
+		self.reset_statistics()
+
+	def reset_statistics (self):
+		self._statistics = {}
+
+	def _counters (self, class_name):
+		if (not class_name in self._statistics):
+			self._statistics[class_name] = {"hits": 0, "misses": 0, "evictions": 0}
+
+		return self._statistics[class_name]
+
+	def _retain (self, id, object):
+		class_name = object.__class__.__name__
+		size = self.get_size(class_name)
+
+		if (size == 0):
+			return
+
+		# instances not committed since their latest
+		# modification are never retained
+		if (not getattr(object, "_committed", False)):
+			self._release(id, class_name)
+			return
+
+		if (not class_name in self._retained):
+			self._retained[class_name] = collections.OrderedDict()
+
+		retained = self._retained[class_name]
+
+		# the instance is moved to the end of the list
+		retained.pop(id, None)
+		retained[id] = object
+
+		while (len(retained) > size):
+			retained.popitem(last = False)
+			self._counters(class_name)["evictions"] += 1
+
+	def _release (self, id, class_name):
+		retained = self._retained.get(class_name)
+		if (retained != None):
+			retained.pop(id, None)
+
+	def update (self, id, object):
+		""" Retain or release an instance after it has been committed or
+			modified (see PersistentObject._committed)
+		"""
+		if (self._objects.get(id) is object):
+			self._retain(id, object)
+
+	def __contains__ (self, id):
+		return (id in self._objects)
+
+	def __getitem__ (self, id):
+		return self._objects[id]
+
+	def get (self, id, default = None):
+		return self._objects.get(id, default)
+
+	def __setitem__ (self, id, object):
+		self._objects[id] = object
+
+		# note: a class is stored in place of an object while
+		# this object is instanciated (see methods.py)
+		if (not isinstance(object, type)):
+			self._retain(id, object)
+
+	def __delitem__ (self, id):
+		object = self._objects.pop(id, None)
+		if (object == None):
+			return
+
+		self._release(id, object.__class__.__name__)
+
+	def __len__ (self):
+		return len(self._objects)
+
+	def instances (self):
+		""" Return all instances currently in the map
+		"""
+		return [object for object in self._objects.values() if (not isinstance(object, type))]
+
+	def lookup (self, id, class_name):
+		""" Return the instance of a given class with the given identifier,
+			or None if there is no such instance
+		"""
+		object = self._objects.get(id)
+
+		if (object == None) or (isinstance(object, type)) or (object.__class__.__name__ != class_name):
+			self._counters(class_name)["misses"] += 1
+			return None
+
+		self._counters(class_name)["hits"] += 1
+		self._retain(id, object)
+
+		return object
+
+	def set_size (self, class_name, size):
+		if (size < 0):
+			raise ValueError("Invalid cache size: %s" % size)
+
+		self._sizes[class_name] = size
+
+		retained = self._retained.get(class_name)
+		if (retained == None):
+			return
+
+		while (len(retained) > size):
+			retained.popitem(last = False)
+			self._counters(class_name)["evictions"] += 1
+
+	def get_size (self, class_name):
+		if (class_name in self._sizes):
+			return self._sizes[class_name]
+
+		return DEFAULT_SIZES.get(class_name, DEFAULT_SIZE)
+
+	def release (self):
+		self._retained = {}
+
+	def statistics (self):
+		statistics = {}
+
+		def get (class_name):
+			if (not class_name in statistics):
+				statistics[class_name] = {
+					"hits": 0,
+					"misses": 0,
+					"evictions": 0,
+					"objects": 0,
+					"retained": 0,
+					"size": self.get_size(class_name),
+				}
+
+			return statistics[class_name]
+
+		for (class_name, counters) in self._statistics.iteritems():
+			get(class_name).update(counters)
+
+		for object in self.instances():
+			get(object.__class__.__name__)["objects"] += 1
+
+		for (class_name, retained) in self._retained.iteritems():
+			get(class_name)["retained"] = len(retained)
+
+		return statistics
+
+# instances of all classes
+identity_map = IdentityMap()
+
+def _class_name (clazz):
+	if (isinstance(clazz, type)):
+		return clazz.__name__
+
+	return clazz
+
+def set_size (clazz, size):
+	""" Set the number of most recently used objects of a given class that are
+		kept in memory, even if not referenced anymore.
+
+	Parameters:
+		- **clazz**: class of the objects, either as a class (e.g.,
+		  :class:`~MetagenomeDB.Sequence`) or as a class name (e.g., 'Sequence')
+		- **size**: number of objects to keep in memory; 0 to keep objects only
+		  as long as they are referenced elsewhere. Default: 100 for
+		  collections, 0 for sequences
+
+	.. note::
+		- Whatever the size, two instances representing the same object can
+		  never coexist; objects still referenced are always found in the cache.
+		- Objects that have been modified but not committed are never kept in
+		  memory by the cache.
+	"""
+	class_name = _class_name(clazz)
+	identity_map.set_size(class_name, size)
+	logger.debug("Cache size for class '%s' set to %s." % (class_name, size))
+
+def get_size (clazz):
+	""" Return the number of most recently used objects of a given class that
+		are kept in memory (see :func:`set_size`).
+	"""
+	return identity_map.get_size(_class_name(clazz))
+
+def statistics():
+	""" Return statistics about the object cache, as a dictionary with class
+		names as keys and dictionaries with the following keys as values:
+
+		- **hits**: number of objects retrieved that were found in the cache
+		- **misses**: number of objects retrieved that were not in the cache
+		- **evictions**: number of objects that were no longer kept in memory
+		  to make room for more recently used objects
+		- **objects**: number of objects currently in the cache
+		- **retained**: number of these objects that are kept in memory by
+		  the cache itself
+		- **size**: maximum number of objects kept in memory
+	"""
+	return identity_map.statistics()
+
+def reset_statistics():
+	""" Reset the hits, misses and evictions counters of the object cache.
+	"""
+	identity_map.reset_statistics()
+
+def release():
+	""" Release all objects kept in memory by the cache; objects still
+		referenced elsewhere remain in the cache.
+	"""
+	identity_map.release()
+	logger.debug("Cached objects released.")
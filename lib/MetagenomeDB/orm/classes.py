@@ -3,29 +3,117 @@
 from .. import errors
 import connection
 import methods
+import relationships
 from .. import utils
 
 import bson
 
 import sys
 import copy
+import contextlib
 import logging
 
 logger = logging.getLogger("MetagenomeDB.ORM.classes")
 
+# number of objects processed at once by PersistentObject.remove_all()
+_REMOVAL_BATCH_SIZE = 1000
+
+# number of targets considered at once when relationship filters
+# are evaluated by the server (see PersistentObject._out_vertices())
+_TARGETS_PER_QUERY = 1000
+
 class MutableObject (object):
 	""" MutableObject: Base object that can receive arbitrary properties.
 	"""
-	def __init__ (self, properties):
+	def __init__ (self, properties, expand = True):
 		""" Create a new object.
 
 		Parameters:
 			- **properties** (optional): object annotations, as a dictionary.
 			  Nested properties can be expressed using dot notation or by nested
 			  dictionaries.
+			- **expand** (optional): if False, properties are assumed to be a
+			  nested dictionary already, and are used as-is rather than copied.
 		"""
-		self._properties = utils.tree.expand(properties)
+		if (expand):
+			self._properties = utils.tree.expand(properties)
+		else:
+			self._properties = properties
+
 		self._modified = False
+		self._reset_modifications()
+
+	def _reset_modifications (self):
+		""" Forget about the modifications made to this object's properties.
+		"""
+		self._updated_keys = {} # keys set (True) or deleted (False)
+		self._appended_values = {} # values appended to list properties
+
+	def _mark_modified (self, key, deleted = False):
+		""" Record that a property has been set, updated or deleted.
+
+		Parameters:
+			- **key**: property that has been modified, as a tuple
+			- **deleted**: True if the property has been deleted (optional)
+		"""
+		# case 1: a parent property is already recorded as a whole
+		for n in range(1, len(key)):
+			parent = key[:n]
+			if (parent in self._updated_keys):
+				# a child of a deleted property can only be set if
+				# this property has been created again in between
+				if (not self._updated_keys[parent]) and (not deleted):
+					self._updated_keys[parent] = True
+				return
+
+		# case 2: this property supersedes any modification of its children
+		for key_ in self._updated_keys.keys():
+			if (len(key_) > len(key)) and (key_[:len(key)] == key):
+				del self._updated_keys[key_]
+
+		for key_ in self._appended_values.keys():
+			if (key_[:len(key)] == key):
+				del self._appended_values[key_]
+
+		self._updated_keys[key] = not deleted
+
+	def _mark_appended (self, key, value):
+		""" Record that a value has been appended to a list property.
+
+		Parameters:
+			- **key**: list property that has been modified, as a tuple
+			- **value**: value appended to this property
+		"""
+		for n in range(1, len(key) + 1):
+			if (key[:n] in self._updated_keys):
+				# the property (or a parent) will be set as a whole
+				if (not self._updated_keys[key[:n]]):
+					self._updated_keys[key[:n]] = True
+				return
+
+		self._appended_values.setdefault(key, []).append(value)
+
+	def _get_modifications (self):
+		""" Return the modifications made to this object's properties since
+			the latest call to _reset_modifications().
+
+		Return:
+			A tuple with (1) a dictionary of set or updated properties, (2) a
+			list of deleted properties and (3) a dictionary of values appended
+			to list properties. Properties are expressed in dot notation.
+		"""
+		updated, deleted, appended = {}, [], {}
+
+		for (key, is_set) in self._updated_keys.iteritems():
+			if (is_set):
+				updated['.'.join(key)] = utils.tree.get(self._properties, key)
+			else:
+				deleted.append('.'.join(key))
+
+		for (key, values) in self._appended_values.iteritems():
+			appended['.'.join(key)] = values
+
+		return updated, deleted, appended
 
 	def get_properties (self):
 		""" Return a copy of all of this object's properties, as a dictionary.
@@ -45,11 +133,39 @@ class MutableObject (object):
 			:meth:`~MutableObject.get_properties`
 		"""
 		try:
-			return copy.deepcopy(self.__getitem__(key))
+			# note: __getitem__ already returns a copy
+			return self.__getitem__(key)
 
 		except KeyError:
 			return default
 
+	def peek (self, key, default = None):
+		""" Return the value for a given property, without copying it.
+
+		Parameters:
+			- **key**: property to retrieve; see :doc:`annotations`.
+			- **default**: value to return if the property doesn't exist
+			  (optional).
+
+		.. note::
+			Dictionaries and lists are returned as read-only views, which
+			cannot be modified. Use :meth:`~MutableObject.get_property` to
+			obtain a copy that can be modified.
+
+		.. seealso::
+			:meth:`~MutableObject.get_property`
+		"""
+		key = utils.tree.expand_key(key)
+
+		try:
+			value = utils.tree.get(self._properties, key)
+
+		except KeyError:
+			return default
+
+		value_ = self._getitem_precallback(key, value)
+		return utils.views.view(value if (value_ == None) else value_)
+
 	def _setitem_precallback (self, key, value):
 		""" Setter callback, called before the property is set or updated.
 
@@ -78,6 +194,7 @@ class MutableObject (object):
 		# only modify the property if the value is different from its previous one (if any)
 		if (not utils.tree.contains(self._properties, key)) or (value != utils.tree.get(self._properties, key)):
 			utils.tree.set(self._properties, key, value)
+			self._mark_modified(key)
 			self._modified = True
 		else:
 			self._modified = False
@@ -123,6 +240,12 @@ class MutableObject (object):
 		utils.tree.delete(self._properties, key)
 		self._modified = True
 
+		# parent properties left empty are deleted as well
+		for n in range(1, len(key) + 1):
+			if (not utils.tree.contains(self._properties, key[:n])):
+				self._mark_modified(key[:n], deleted = True)
+				break
+
 		self._delitem_postcallback()
 
 	def __contains__ (self, key):
@@ -133,6 +256,10 @@ class PersistentObject (MutableObject):
 	""" PersistentObject: Persistent object that can be committed to the backend database.
 	"""
 
+	# properties that are not retrieved from the database with the others,
+	# but only the first time they are accessed (see PersistentObject.find())
+	_deferred_properties = ()
+
 	class __metaclass__ (type):
 		""" Hook called when a subclass of PersistentObject is declared; this
 			subclass is automatically registered as a foundry in methods.py
@@ -151,7 +278,9 @@ class PersistentObject (MutableObject):
 			  Nested properties can be expressed using dot notation or by nested
 			  dictionaries.
 		"""
-		MutableObject.__init__(self, properties)
+		# objects forged from database entries receive
+		# properties that are already decoded and expanded
+		MutableObject.__init__(self, properties, not methods.is_forged(properties))
 
 		# if the object is provided with an identifier,
 		# we check if this identifier is present in the
@@ -170,13 +299,176 @@ class PersistentObject (MutableObject):
 		else:
 			self._committed = False
 
-		if (not "_relationships" in self._properties):
+		# note: with relationships stored in a dedicated collection, the
+		# '_relationships' property only contains relationships that
+		# have not been committed yet (see relationships.py)
+		if (not "_relationship_with" in self._properties):
 			self._properties["_relationship_with"] = []
+
+		if (not "_relationships" in self._properties):
 			self._properties["_relationships"] = {}
 
+		self._removed_relationships = {}
+
+		# properties that were retrieved from the database, as an (include,
+		# keys) tuple, or None if all properties were (see _set_projection())
+		self._projection = None
+
 		self._indices = indices
 		self._indices["_relationship_with"] = False
 
+	def _set_projection (self, projection):
+		""" Declare this object as partially loaded from the database.
+
+		Parameters:
+			- **projection**: properties retrieved from the database, as a
+			  tuple with (1) True if the listed properties are the only ones
+			  retrieved or False if they are the only ones not retrieved and (2)
+			  a list of properties, as tuples.
+
+		.. note::
+			This method should not be called directly.
+		"""
+		self._projection = (projection[0], list(projection[1]))
+
+		# relationships stored in the object are retrieved only when needed
+		if (not relationships.is_external()) and (not self._is_loaded(("_relationships",))):
+			del self._properties["_relationships"]
+
+	def _is_loaded (self, key):
+		""" Test if a property (and all its sub-properties) has been retrieved
+			from the database.
+
+		.. note::
+			This method should not be called directly.
+		"""
+		if (self._projection == None) or (key[0] == "_id"):
+			return True
+
+		include, keys = self._projection
+
+		for key_ in keys:
+			n = min(len(key), len(key_))
+			if (key_[:n] != key[:n]):
+				continue
+
+			# the property is retrieved if itself or a parent is
+			if (include) and (len(key_) <= len(key)):
+				return True
+
+			# the property is not retrieved if itself, a parent or a child is not
+			if (not include):
+				return False
+
+		return (not include)
+
+	def _load_property (self, key):
+		""" Retrieve a property from the database if the object has only been
+			partially loaded and this property has not been retrieved yet.
+
+		.. note::
+			- This method should not be called directly.
+			- The whole top-level property is retrieved.
+		"""
+		if (self._is_loaded(key)):
+			return
+
+		with connection.protect():
+			properties = methods.load_properties(self, {key[0]: True})
+
+		self._merge_properties(properties, (True, [key[:1]]))
+
+	def _load_properties (self):
+		""" Retrieve all properties that have not been retrieved yet from the
+			database, if the object has only been partially loaded.
+
+		.. note::
+			This method should not be called directly.
+		"""
+		if (self._projection == None):
+			return
+
+		include, keys = self._projection
+
+		# retrieve properties not retrieved so far
+		with connection.protect():
+			properties = methods.load_properties(self, dict([('.'.join(key), not include) for key in keys]))
+
+		self._merge_properties(properties, None)
+
+	def _merge_properties (self, properties, projection):
+		""" Merge properties retrieved from the database into this object's.
+
+		Parameters:
+			- **properties**: properties retrieved from the database
+			- **projection**: properties that were requested, as an (include,
+			  keys) tuple, or None if all were (see _set_projection())
+
+		.. note::
+			- This method should not be called directly.
+			- Properties set, modified or deleted since this object was loaded
+			  take precedence over those retrieved from the database.
+		"""
+		def is_modified (key):
+			for n in range(1, len(key) + 1):
+				if (key[:n] in self._updated_keys):
+					return True
+
+			return False
+
+		def merge (target, source, branch):
+			for (key, value) in source.iteritems():
+				key_ = branch + (key,)
+				if (is_modified(key_)):
+					continue
+
+				if (not key in target):
+					target[key] = value
+
+				elif (type(target[key]) == dict) and (type(value) == dict):
+					merge(target[key], value, key_)
+
+		merge(self._properties, properties, ())
+
+		# update the list of properties retrieved so far
+		def overlaps (key, key_):
+			n = min(len(key), len(key_))
+			return (key[:n] == key_[:n])
+
+		if (projection == None):
+			self._projection = None
+
+		# the new properties are all but some
+		elif (not projection[0]):
+			if (self._projection[0]):
+				self._projection = (False, list(projection[1]))
+			else:
+				self._projection = (False, [key for key in self._projection[1] if (True in [overlaps(key, key_) for key_ in projection[1]])])
+
+		# the new properties are some
+		elif (self._projection[0]):
+			self._projection[1].extend(projection[1])
+		else:
+			self._projection = (False, [key for key in self._projection[1] if (not True in [(key[:len(key_)] == key_) for key_ in projection[1]])])
+
+		if (self._projection != None) and (not self._projection[0]) and (len(self._projection[1]) == 0):
+			self._projection = None
+
+		if (not "_relationships" in self._properties) and (self._is_loaded(("_relationships",))):
+			self._properties["_relationships"] = {}
+
+	def _get_committed (self):
+		return self.__committed
+
+	def _set_committed (self, committed):
+		self.__committed = committed
+
+		# the object cache only retains committed objects
+		if ("_id" in self._properties):
+			methods._cache.update(self._properties["_id"], self)
+
+	_committed = property(_get_committed, _set_committed)
+
 	def _setitem_precallback (self, key, value):
 		if (key[0].startswith('_')):
 			raise errors.InvalidObjectOperationError("Property '%s' is reserved and cannot be modified." % '.'.join(key))
@@ -184,7 +476,8 @@ class PersistentObject (MutableObject):
 		return value
 
 	def _setitem_postcallback (self):
-		self._committed = not self._modified
+		if (self._modified):
+			self._committed = False
 
 	def _delitem_precallback (self, key):
 		if (key[0].startswith('_')):
@@ -193,6 +486,51 @@ class PersistentObject (MutableObject):
 	def _delitem_postcallback (self):
 		self._committed = False
 
+	def _commit_precallback (self):
+		""" Commit callback, called before the object is committed.
+		"""
+		pass
+
+	def _commit_postcallback (self):
+		""" Commit callback, called after the object has been committed.
+		"""
+		pass
+
+	def __getitem__ (self, key):
+		self._load_property(utils.tree.expand_key(key))
+		return MutableObject.__getitem__(self, key)
+
+	def peek (self, key, default = None):
+		""" Return the value for a given property, without copying it.
+
+		.. seealso::
+			:meth:`~MutableObject.peek`
+		"""
+		self._load_property(utils.tree.expand_key(key))
+		return MutableObject.peek(self, key, default)
+
+	def __delitem__ (self, key):
+		self._load_property(utils.tree.expand_key(key))
+		MutableObject.__delitem__(self, key)
+
+	def __contains__ (self, key):
+		self._load_property(utils.tree.expand_key(key))
+		return MutableObject.__contains__(self, key)
+
+	def get_properties (self):
+		""" Return a copy of all of this object's properties, as a dictionary.
+
+		.. note::
+			If this object was retrieved with a field projection (see
+			:meth:`~PersistentObject.find`), the missing properties are
+			retrieved from the database first.
+
+		.. seealso::
+			:meth:`~MutableObject.get_property`
+		"""
+		self._load_properties()
+		return MutableObject.get_properties(self)
+
 	def commit (self):
 		""" Commit this object to the database.
 
@@ -200,16 +538,26 @@ class PersistentObject (MutableObject):
 			- The commit will not be performed if the object has already been
 			  committed once and no modification (property manipulation) has
 			  been performed since then.
+			- Once an object has been committed, subsequent commits only send
+			  the properties that were modified (or deleted) since the
+			  previous commit.
 			- If an object already exists in the database with the same values
 			  for properties flagged as unique a :class:`MetagenomeDB.errors.DuplicateObjectError`
 			  exception is thrown.
+			- Within a :func:`~MetagenomeDB.batch` context the commit is
+			  deferred until the batch is flushed.
 
 		.. seealso::
-			:meth:`~PersistentObject.is_committed`
+			:meth:`~PersistentObject.is_committed`, :func:`~MetagenomeDB.commit_all`
 		"""
 		if (self._committed):
 			return
 
+		# within a batch() context, the commit is deferred
+		if (_batch != None):
+			_batch.append(self)
+			return
+
 		"""
 		# pre-flight: if some patch needs to be applied on the object's
 		# properties, we temporary store the old values
@@ -254,41 +602,58 @@ class PersistentObject (MutableObject):
 		return methods.count(cls.__name__, query = filter)
 
 	@classmethod
-	def distinct (cls, property):
+	def distinct (cls, property, filter = None):
 		""" For each value found in the database for a given property, return
 		the number of objects that have this value.
 
 		Parameters:
-			- **property**: property to count objects for.
+			- **property**: property to count objects for. Nested properties
+			  can be expressed using dot notation (e.g., 'taxonomy.genus').
+			- **filter**: filter for the objects to consider (optional); see
+			  :doc:`queries`.
 
 		Return:
 			A dictionary with all values found for this property as keys, and
-			number of objects having this value as values.
+			number of objects having this value as values. Objects lacking
+			this property are counted with None as a value. List values are
+			returned as tuples.
 		"""
-		return methods.distinct(cls.__name__, property)
+		return methods.distinct(cls.__name__, property, filter)
 
 	@classmethod
-	def find (cls, filter = None):
+	def find (cls, filter = None, fields = None):
 		""" Find all objects of this type that match a query.
 
 		Parameters:
 			- **filter**: filter for the objects to select (optional); see
 			  :doc:`queries`.
+			- **fields**: properties to retrieve (optional), either as a list
+			  of properties or as a dictionary with properties as keys and
+			  True (to retrieve) or False (to ignore) as values. By default,
+			  all properties but the deferred ones (e.g., 'sequence' and
+			  'quality' for sequences) are retrieved. An empty dictionary
+			  retrieves all properties.
 
 		Return:
 			A generator.
 
+		.. note::
+			Properties that were not retrieved are transparently fetched from
+			the database the first time they are accessed.
+
 		.. seealso::
 			:meth:`~PersistentObject.count`, :meth:`~PersistentObject.find_one`
 		"""
-		return methods.find(cls.__name__, query = filter)
+		return methods.find(cls.__name__, query = filter, fields = fields)
 
 	@classmethod
-	def find_one (cls, filter):
+	def find_one (cls, filter, fields = None):
 		""" Find the first (or only) object of this type that match a query.
 
 		Parameters:
 			- **filter**: filter for the object to select; see :doc:`queries`.
+			- **fields**: properties to retrieve (optional); see
+			  :meth:`~PersistentObject.find`.
 
 		Return:
 			An object, or None if no object found.
@@ -296,7 +661,7 @@ class PersistentObject (MutableObject):
 		.. seealso::
 			:meth:`~PersistentObject.find`
 		"""
-		return methods.find(cls.__name__, query = filter, find_one = True)
+		return methods.find(cls.__name__, query = filter, find_one = True, fields = fields)
 
 	def _connect_to (self, target, relationship):
 		""" Connect this object to another through a directed,
@@ -322,12 +687,20 @@ class PersistentObject (MutableObject):
 		else:
 			relationship = utils.tree.expand(relationship)
 
+		if (relationships.is_external()):
+			self._connect_to_(target, target_id, relationship)
+			return
+
+		self._load_property(("_relationships",))
+
 		# case where this object has no connection with the target yet
 		if (not target_id in self._properties["_relationships"]):
 			assert (not target_id in self._properties["_relationship_with"]) ###
 
 			self._properties["_relationship_with"].append(target_id)
 			self._properties["_relationships"][target_id] = [relationship]
+			self._mark_appended(("_relationship_with",), target_id)
+			self._mark_modified(("_relationships", target_id))
 			self._committed = False
 
 			logger.debug("Initial relationship %s created between %s and %s." % (relationship, self, target))
@@ -338,10 +711,52 @@ class PersistentObject (MutableObject):
 				raise errors.DuplicateObjectError("A relationship %s already exists between objects %s and %s." % (relationship, self, target))
 
 			self._properties["_relationships"][target_id].append(relationship)
+			self._mark_appended(("_relationships", target_id), relationship)
 			self._committed = False
 
 			logger.debug("Relationship %s created between %s and %s." % (relationship, self, target))
 
+	def _connect_to_ (self, target, target_id, relationship):
+		# _connect_to(), for relationships stored in a dedicated collection
+		new_relationships = self._properties["_relationships"].get(target_id, [])
+
+		if (relationship in new_relationships) or \
+		   ((target_id in self._properties["_relationship_with"]) and \
+		    (relationship in [r["properties"] for r in self._stored_relationships(target_id)])):
+			raise errors.DuplicateObjectError("A relationship %s already exists between objects %s and %s." % (relationship, self, target))
+
+		if (not target_id in self._properties["_relationship_with"]):
+			self._properties["_relationship_with"].append(target_id)
+			self._mark_appended(("_relationship_with",), target_id)
+
+		self._properties["_relationships"][target_id] = new_relationships + [relationship]
+		self._committed = False
+
+		logger.debug("Relationship %s created between %s and %s." % (relationship, self, target))
+
+	def _stored_relationships (self, target_id, relationship_filter = None):
+		""" List relationships from this object to a target that are stored in
+			the database, and have not been removed since the latest commit.
+
+		.. note::
+			This method should not be called directly, and is only relevant
+			when relationships are stored in a dedicated collection.
+		"""
+		if (not "_id" in self._properties):
+			return []
+
+		removed = self._removed_relationships.get(target_id, ())
+		if (removed == None):
+			return []
+
+		query = relationships.query(
+			source = self._properties["_id"],
+			target = target_id,
+			relationship_filter = relationship_filter
+		)
+
+		return filter(lambda x: not x["_id"] in removed, relationships.find(query))
+
 	def _disconnect_from (self, target, relationship_filter):
 		""" Disconnect this object from another.
 
@@ -360,6 +775,12 @@ class PersistentObject (MutableObject):
 
 		target_id = str(target._properties["_id"])
 
+		if (relationships.is_external()):
+			self._disconnect_from_(target, target_id, relationship_filter)
+			return
+
+		self._load_property(("_relationships",))
+
 		if (not target_id in self._properties["_relationships"]):
 			raise errors.InvalidObjectOperationError("%s is not connected to %s." % (self, target))
 
@@ -367,6 +788,8 @@ class PersistentObject (MutableObject):
 		if (relationship_filter == None):
 			del self._properties["_relationships"][target_id]
 			self._properties["_relationship_with"].remove(target_id)
+			self._mark_modified(("_relationships", target_id), deleted = True)
+			self._mark_modified(("_relationship_with",))
 			self._committed = False
 
 			logger.debug("Removed all relationships between %s and %s." % (self, target))
@@ -377,19 +800,35 @@ class PersistentObject (MutableObject):
 				raise errors.UncommittedObjectError("Cannot disconnect %s from %s: the source is not committed." % (self, target))
 
 			n_relationships = len(self._properties["_relationships"][target_id])
-			clazz = self.__class__.__name__
-			to_remove = []
 
-			for n in range(n_relationships):
-				query = {"_id": self._properties["_id"]}
-
-				for key, value in utils.tree.flatten(relationship_filter).iteritems():
-					query["_relationships.%s.%s.%s" % (target_id, n, key)] = value
+			# as the source is committed, relationships
+			# in memory are the same as in the database
+			try:
+				match = relationships.matcher(relationship_filter)
+
+				def matches (n, relationship):
+					return match(relationship)
+
+			# filters the matcher does not support are run by the server; the
+			# position of the matching relationships is selected in a single
+			# query over the source document
+			except ValueError:
+				positions = set([int(r["n"]) for r in methods.aggregate(self.__class__.__name__, [
+					{"$match": {"_id": self._properties["_id"]}},
+					{"$project": {"relationship": "$_relationships.%s" % target_id}},
+					{"$unwind": {"path": "$relationship", "includeArrayIndex": "n"}},
+					{"$match": relationships.filter_query(relationship_filter, "relationship.")},
+					{"$project": {"n": True}},
+				])])
+
+				def matches (n, relationship):
+					return (n in positions)
 
-				if (methods.find(clazz, query, count = True) == 0):
-					continue
+			to_remove = []
 
-				to_remove.append(n)
+			for n, relationship in enumerate(self._properties["_relationships"][target_id]):
+				if (matches(n, relationship)):
+					to_remove.append(n)
 
 			if (len(to_remove) == 0):
 				raise errors.InvalidObjectOperationError("%s is not connected to %s by any relationship matching %s." % (self, target, utils.tree.flatten(relationship_filter)))
@@ -402,11 +841,88 @@ class PersistentObject (MutableObject):
 			if (len(to_remove) == n_relationships):
 				del self._properties["_relationships"][target_id]
 				self._properties["_relationship_with"].remove(target_id)
+				self._mark_modified(("_relationships", target_id), deleted = True)
+				self._mark_modified(("_relationship_with",))
+			else:
+				self._mark_modified(("_relationships", target_id))
 
 			self._committed = False
 
-	def _in_vertices (self, neighbor_collection, neighbor_filter = None, relationship_filter = None, count = False):
+	def _disconnect_from_ (self, target, target_id, relationship_filter):
+		# _disconnect_from(), for relationships stored in a dedicated collection
+		if (not target_id in self._properties["_relationship_with"]):
+			raise errors.InvalidObjectOperationError("%s is not connected to %s." % (self, target))
+
+		# case 1: we remove all relationships between the object and target
+		if (relationship_filter == None):
+			to_remove = None
+
+		# case 2: we remove all relationships matching a criteria
+		else:
+			if (not self._committed):
+				raise errors.UncommittedObjectError("Cannot disconnect %s from %s: the source is not committed." % (self, target))
+
+			n_relationships = relationships.count(relationships.query(
+				source = self._properties["_id"],
+				target = target_id
+			))
+
+			to_remove = [r["_id"] for r in self._stored_relationships(target_id, relationship_filter)]
+
+			if (len(to_remove) == 0):
+				raise errors.InvalidObjectOperationError("%s is not connected to %s by any relationship matching %s." % (self, target, utils.tree.flatten(relationship_filter)))
+
+			if (len(to_remove) == n_relationships):
+				to_remove = None
+
+		if (to_remove == None):
+			self._properties["_relationships"].pop(target_id, None)
+			self._properties["_relationship_with"].remove(target_id)
+			self._mark_modified(("_relationship_with",))
+			self._removed_relationships[target_id] = None
+
+			logger.debug("Removed all relationships between %s and %s." % (self, target))
+		else:
+			self._removed_relationships.setdefault(target_id, []).extend(to_remove)
+
+			logger.debug("Removed %s relationship%s between %s and %s." % (len(to_remove), {True: 's', False: ''}[len(to_remove) > 1], self, target))
+
+		self._committed = False
+
+	def _forget_relationships_with (self, target_ids):
+		""" Remove from memory any relationship from this object to a set of
+			targets (as a set of identifiers), after these relationships were
+			removed from the database.
+
+		.. note::
+			This method should not be called directly.
+		"""
+		relationship_with = self._properties["_relationship_with"]
+
+		for target_id in [id for id in relationship_with if (id in target_ids)]:
+			relationship_with.remove(target_id)
+
+			if ("_relationships" in self._properties):
+				self._properties["_relationships"].pop(target_id, None)
+
+			self._removed_relationships.pop(target_id, None)
+
+			# modifications not committed yet are forgotten
+			appended = self._appended_values.get(("_relationship_with",))
+			if (appended != None) and (target_id in appended):
+				appended.remove(target_id)
+
+			self._updated_keys.pop(("_relationships", target_id), None)
+			self._appended_values.pop(("_relationships", target_id), None)
+
+			logger.debug("Removed all relationships between %s and object %s." % (self, target_id))
+
+	def _in_vertices (self, neighbor_collection, neighbor_filter = None, relationship_filter = None, count = False, fields = None, distinct = None, raw = False, sample = None):
 		""" List (or count) all incoming relationships between objects and this object.
+		If distinct is set to a property, count objects per value of this property.
+		If raw is set, objects are listed as MongoDB documents.
+		If sample is set to a number, at most this number of objects are
+		selected at random by the server, and listed as MongoDB documents.
 
 		.. note::
 			This method should not be called directly.
@@ -415,7 +931,9 @@ class PersistentObject (MutableObject):
 		# no object can possibly be linked to it.
 		if (not "_id" in self._properties):
 			logger.debug("Attempt to list in-neighbors of %s while this object has never been committed." % self)
-			if (count):
+			if (distinct != None):
+				return {}
+			elif (count):
 				return 0
 			else:
 				return []
@@ -425,23 +943,46 @@ class PersistentObject (MutableObject):
 		query = {"_relationship_with": object_id}
 
 		if (relationship_filter != None):
-			query["_relationships.%s" % object_id] = {"$elemMatch": utils.tree.flatten(relationship_filter)}
+			if (relationships.is_external()):
+				sources = relationships.distinct(relationships.query(
+					target = object_id,
+					source_class = neighbor_collection,
+					relationship_filter = relationship_filter
+				), "source")
+
+				query["_id"] = {"$in": [bson.objectid.ObjectId(id) for id in sources]}
+			else:
+				query["_relationships.%s" % object_id] = {"$elemMatch": utils.tree.flatten(relationship_filter)}
 
 		if (neighbor_filter != None):
 			neighbor_filter = utils.tree.expand(neighbor_filter)
 			for key in neighbor_filter:
 				query[key] = neighbor_filter[key]
 
-		return methods.find(neighbor_collection, query, count = count)
+		if (distinct != None):
+			return methods.distinct(neighbor_collection, distinct, query)
 
-	def _out_vertices (self, neighbor_collection, neighbor_filter = None, relationship_filter = None, count = False):
+		# only the selected objects are sent back
+		if (sample != None):
+			pipeline = [{"$match": query}]
+			if (fields != None):
+				pipeline.append({"$project": dict([(field, True) for field in fields])})
+
+			pipeline.append({"$sample": {"size": sample}})
+
+			return list(methods.aggregate(neighbor_collection, pipeline))
+
+		return methods.find(neighbor_collection, query, count = count, fields = fields, raw = raw)
+
+	def _out_vertices (self, neighbor_collection, neighbor_filter = None, relationship_filter = None, count = False, fields = None):
 		""" List (or count) all outgoing relationships between this object and others.
 
 		.. note::
 			- This method should not be called directly.
-			- If relationship_filter is not None, a query is performed in the
-			  database; hence, the source object must be committed. If not a
-			  :class:`MetagenomeDB.errors.UncommittedObjectError` exception is thrown.
+			- If relationship_filter is not None, relationships are filtered as
+			  stored in the database; hence, the source object must be committed.
+			  If not a :class:`MetagenomeDB.errors.UncommittedObjectError`
+			  exception is thrown.
 		"""
 		targets = self._properties["_relationship_with"]
 
@@ -456,21 +997,53 @@ class PersistentObject (MutableObject):
 			candidates = targets
 
 		# consider neighbors matching relationship_filter
-		else:
+		elif (relationships.is_external()):
 			if (not self._committed):
 				raise errors.UncommittedObjectError("Cannot list relationships from %s to other objects: the source is not committed." % self)
 
-			candidates = []
-			for target_id in targets:
-				query = {
-					"_id": self._properties["_id"],
-					"_relationships.%s" % target_id: {"$elemMatch": utils.tree.flatten(relationship_filter)}
-				}
+			candidates = relationships.distinct(relationships.query(
+				source = self._properties["_id"],
+				target = targets,
+				relationship_filter = relationship_filter
+			), "target")
 
-				if (methods.find(self.__class__.__name__, query, count = True) == 0):
-					continue
+		else:
+			if (not self._committed):
+				raise errors.UncommittedObjectError("Cannot list relationships from %s to other objects: the source is not committed." % self)
 
-				candidates.append(target_id)
+			# as the source is committed, relationships already
+			# in memory are the same as in the database
+			try:
+				matches = relationships.matcher(relationship_filter)
+			except ValueError:
+				matches = None
+
+			if (matches != None):
+				self._load_property(("_relationships",))
+				candidates = []
+
+				for (target_id, relationships_) in self._properties["_relationships"].iteritems():
+					for relationship in relationships_:
+						if (matches(relationship)):
+							candidates.append(target_id)
+							break
+
+			# filters the matcher does not support are run by the server; the
+			# targets of the matching relationships are selected in a single
+			# query over the source document per chunk of targets
+			else:
+				candidates = []
+				for i in xrange(0, len(targets), _TARGETS_PER_QUERY):
+					candidates.extend([r["_id"] for r in methods.aggregate(self.__class__.__name__, [
+						{"$match": {"_id": self._properties["_id"]}},
+						{"$project": {"relationship": [
+							{"target": {"$literal": target_id}, "properties": "$_relationships.%s" % target_id}
+							for target_id in targets[i:i + _TARGETS_PER_QUERY]]}},
+						{"$unwind": "$relationship"},
+						{"$unwind": "$relationship.properties"},
+						{"$match": relationships.filter_query(relationship_filter, "relationship.properties.")},
+						{"$group": {"_id": "$relationship.target"}},
+					])])
 
 		if (len(candidates) == 0):
 			if (count):
@@ -486,7 +1059,7 @@ class PersistentObject (MutableObject):
 			for key in neighbor_filter:
 				query[key] = neighbor_filter[key]
 
-		return methods.find(neighbor_collection, query, count = count)
+		return methods.find(neighbor_collection, query, count = count, fields = fields)
 
 	def has_relationships_with (self, target):
 		""" Test if this object has relationship(s) with another object.
@@ -501,7 +1074,7 @@ class PersistentObject (MutableObject):
 			logger.debug("Attempt to test a relationship between %s and %s while the later has never been committed." % (self, target))
 			return False
 
-		return (str(target._properties["_id"]) in self._properties["_relationships"])
+		return (str(target._properties["_id"]) in self._properties["_relationship_with"])
 
 	def list_relationships_with (self, target):
 		""" List relationship(s), if any, from this object to others.
@@ -521,6 +1094,12 @@ class PersistentObject (MutableObject):
 
 		target_id = str(target._properties["_id"])
 
+		if (relationships.is_external()) and (target_id in self._properties["_relationship_with"]):
+			stored = [r["properties"] for r in self._stored_relationships(target_id)]
+			return stored + copy.deepcopy(self._properties["_relationships"].get(target_id, []))
+
+		self._load_property(("_relationships",))
+
 		if (target_id in self._properties["_relationships"]):
 			return copy.deepcopy(self._properties["_relationships"][target_id])
 		else:
@@ -536,55 +1115,131 @@ class PersistentObject (MutableObject):
 		.. seealso::
 			:meth:`~PersistentObject.remove_all`
 		"""
-		# remove all relationships with other objects
-		for collection_name in methods.list_collections():
-			if ("_id" in self._properties):
-				for object in self._in_vertices(collection_name):
-					object._disconnect_from(self, None)
-
-			for object in self._out_vertices(collection_name):
-				self._disconnect_from(object, None)
-
 		# if the object has been committed at least once,
 		if ("_id" in self._properties):
-			# remove the object from the database
+			# the object remains in memory with all its properties
+			self._load_properties()
+
+			object_id = self._properties["_id"]
+
 			with connection.protect():
+				# remove all relationships from other objects to this one
+				methods.remove_relationships([object_id])
+
+				# remove the object from the database
 				methods.remove_object(self)
 
+				if (relationships.is_external()):
+					relationships.remove({"source": str(object_id)})
+
 			# and declare it has never having been committed
-			del self._properties["_id"]
+			self._forget_instances([self])
 
-		self._committed = False
+		# relationships from this object to others are removed as well
+		else:
+			self._properties["_relationship_with"] = []
+			self._properties["_relationships"] = {}
+			self._removed_relationships = {}
+			self._committed = False
 
 	@classmethod
-	def remove_all (cls):
-		""" Remove all objects of this type from the database.
+	def remove_all (cls, filter = None):
+		""" Remove all objects of this type from the database, or only those
+		matching a filter.
+
+		Parameters:
+			- **filter**: filter for the objects to remove (optional); see
+			  :doc:`queries`.
+
+		Return:
+			The number of objects removed.
 
 		.. note::
 			- Relationships from and to these objects are removed as well.
 			- Instanciated objects remain in memory, flagged as uncommitted.
+			- Objects are removed by batches of 1,000; if all objects are
+			  removed, the whole collection is dropped at once.
 
 		.. seealso::
 			:meth:`~PersistentObject.remove`
 		"""
 		collection_name = cls.__name__
 
-		n_objects = methods.find(collection_name, None, count = True)
-		objects = methods.find(collection_name, None)
+		if (filter == {}):
+			filter = None
+
+		# relationships between objects that are all removed
+		# don't need to be removed from these objects first
+		if (filter == None):
+			exclude = collection_name
+		else:
+			exclude = None
+
+		def remove (ids):
+			# remove all relationships from other objects to these objects
+			methods.remove_relationships(ids, exclude = exclude)
+
+			# then remove the objects themselves, unless
+			# the whole collection is dropped afterward
+			if (filter == None):
+				return
+
+			# instances still in memory will keep all their properties
+			ids_ = set(ids)
+			instances = [object for object in methods.list_instances(collection_name) if (object._properties["_id"] in ids_)]
+			for object in instances:
+				object._load_properties()
+
+			methods.remove_objects(collection_name, ids)
+
+			if (relationships.is_external()):
+				relationships.remove(relationships.query(source = ids))
+
+			cls._forget_instances(instances)
 
 		n = 0
-		for object in objects:
-			try:
-				object.remove()
-				n += 1
-			except:
-				continue
+		with connection.protect():
+			ids = []
+			for id in methods.find_ids(collection_name, filter):
+				ids.append(id)
 
-		if (n < n_objects):
-			logger.warning("%s out of %s objects in collection '%s' were not removed." % (n_objects - n, n_objects, collection_name))
-			return
+				if (len(ids) == _REMOVAL_BATCH_SIZE):
+					remove(ids)
+					n += len(ids)
+					ids = []
+
+			if (len(ids) > 0):
+				remove(ids)
+				n += len(ids)
+
+			if (filter == None):
+				instances = methods.list_instances(collection_name)
+				for object in instances:
+					object._load_properties()
 
-		methods.drop_collection(cls.__name__)
+				if (relationships.is_external()):
+					relationships.remove({"source_class": collection_name})
+
+				methods.drop_collection(collection_name)
+				cls._forget_instances(instances)
+
+		logger.debug("%s object%s removed from collection '%s'." % (n, {True: 's', False: ''}[n > 1], collection_name))
+		return n
+
+	@classmethod
+	def _forget_instances (cls, instances):
+		""" Declare instances of objects that were removed from the
+			database as never having been committed.
+
+		.. note::
+			This method should not be called directly.
+		"""
+		for object in instances:
+			del object._properties["_id"]
+			object._properties["_relationship_with"] = []
+			object._properties["_relationships"] = {}
+			object._removed_relationships = {}
+			object._committed = False
 
 	def __del__ (self):
 		if (hasattr(self, "_committed") and (not self._committed)):
@@ -592,3 +1247,168 @@ class PersistentObject (MutableObject):
 
 	def __repr__ (self):
 		return self.__str__()
+
+# Queue of objects to commit, when within a batch() context
+_batch = None
+
+class _CommitQueue (object):
+	""" Queue of objects whose commit is deferred until the queue is flushed.
+	"""
+	def __init__ (self, batch_size):
+		self._batch_size = batch_size
+		self._objects, self._queued = [], {}
+
+		# names of the objects queued, per identifier of
+		# the objects they have relationships with
+		self._names = {}
+
+	def append (self, object):
+		name = object._properties.get("name")
+		if (name != None):
+			for target_id in object._properties.get("_relationship_with", ()):
+				self._names.setdefault(target_id, set()).add(name)
+
+		if (id(object) in self._queued):
+			return
+
+		self._objects.append(object)
+		self._queued[id(object)] = True
+
+		if (len(self._objects) >= self._batch_size):
+			self.flush()
+
+	def has_name (self, target, name):
+		""" Test if an object with a given name and a relationship with
+			**target** is queued.
+		"""
+		return (name in self._names.get(str(target._properties.get("_id")), ()))
+
+	def flush (self):
+		""" Commit all objects queued so far.
+		"""
+		objects, self._objects, self._queued, self._names = self._objects, [], {}, {}
+		commit_all(objects, self._batch_size)
+
+	def __len__ (self):
+		return len(self._objects)
+
+def _is_queued (target, name):
+	# test if an object with a given name and a relationship
+	# with target is queued for commit (see batch())
+	return (_batch != None) and (_batch.has_name(target, name))
+
+def _commit_batch (objects):
+	with connection.protect():
+		failures = methods._commit_all(objects)
+
+	failed = {}
+	for (object, exception) in failures:
+		failed[id(object)] = exception
+
+	for object in objects:
+		if (not id(object) in failed):
+			object._committed = True
+
+	# the first error is raised, along with the list of all
+	# objects that could not be committed and their error
+	if (len(failures) > 0):
+		if (len(failures) > 1):
+			logger.debug("%s out of %s objects were not committed." % (len(failures), len(objects)))
+
+		exception = failures[0][1]
+		exception.failures = failures
+
+		raise exception
+
+def commit_all (objects, batch_size = 1000):
+	""" Commit several objects to the database at once.
+
+	Parameters:
+		- **objects**: objects to commit, as a list or an iterator.
+		- **batch_size**: maximum number of objects sent to the database in
+		  a single bulk operation (optional). Default: 1000
+
+	.. note::
+		- Objects that have already been committed and not modified since
+		  then are ignored.
+		- Objects are grouped by type; i.e., all sequences of a batch are
+		  committed in one operation, and all collections in another.
+		- If an object already exists in the database with the same values
+		  for properties flagged as unique a :class:`MetagenomeDB.errors.DuplicateObjectError`
+		  exception is thrown once the batch this object belongs to has been
+		  processed; subsequent batches are not processed. Objects that could
+		  not be committed remain flagged as uncommitted.
+		- If more than one object of a batch could not be committed, the
+		  exception thrown is that of the first one; all of them are listed,
+		  with their own exception, as (object, exception) tuples in the
+		  'failures' attribute of this exception.
+
+	.. seealso::
+		:meth:`~PersistentObject.commit`, :func:`~MetagenomeDB.batch`
+	"""
+	if (batch_size < 1):
+		raise ValueError("Invalid batch size: %s" % batch_size)
+
+	batch, queued = [], {}
+	for object in objects:
+		if (not isinstance(object, PersistentObject)):
+			raise ValueError("Unable to commit %s: not a persistent object." % object)
+
+		if (object._committed) or (id(object) in queued):
+			continue
+
+		batch.append(object)
+		queued[id(object)] = True
+
+		if (len(batch) == batch_size):
+			_commit_batch(batch)
+			batch, queued = [], {}
+
+	if (len(batch) > 0):
+		_commit_batch(batch)
+
+@contextlib.contextmanager
+def batch (batch_size = 1000):
+	""" Defer the commit of objects, so that they are committed in bulk.
+
+	Parameters:
+		- **batch_size**: number of objects to queue before they are all
+		  committed at once (optional). Default: 1000
+
+	Example::
+
+		with mdb.batch():
+			for record in records:
+				sequence = mdb.Sequence(record)
+				sequence.add_to_collection(collection)
+				sequence.commit() # queued, not committed yet
+
+	.. note::
+		- Any call to :meth:`~PersistentObject.commit` within this context
+		  queues the object rather than committing it. Queued objects are
+		  committed every **batch_size** objects, and when leaving the
+		  context. If an exception is raised within the context the objects
+		  still in the queue are not committed.
+		- A queued object is flagged as uncommitted until its batch is
+		  committed; in particular, it can not be the target of a
+		  relationship until then. The queue can be committed at any time
+		  by calling the ``flush()`` method of the object returned by the
+		  context manager.
+
+	.. seealso::
+		:func:`~MetagenomeDB.commit_all`
+	"""
+	global _batch
+
+	# nested contexts share the same queue
+	if (_batch != None):
+		yield _batch
+		return
+
+	_batch = _CommitQueue(batch_size)
+	try:
+		yield _batch
+		_batch.flush()
+
+	finally:
+		_batch = None
@@ -13,6 +13,7 @@ logger = logging.getLogger("MetagenomeDB.ORM.connection")
 
 _connection = None # connection to a database (warning: instance of pymongo.database.Database, NOT pymongo.connection.Connection)
 _connection_info = {} # information about the connection
+_connection_pid = None # process the connection was opened by
 
 def connect (host = None, port = None, db = None, user = None, password = None):
 	""" Open a connection to a MongoDB database.
@@ -98,6 +99,9 @@ def connect (host = None, port = None, db = None, user = None, password = None):
 	global _connection
 	_connection = database
 
+	global _connection_pid
+	_connection_pid = os.getpid()
+
 	global _connection_info
 	_connection_info = {
 		"host": host,
@@ -115,14 +119,32 @@ def connection():
 
 	.. note::
 		connection() is a singleton; i.e., any call to this function will
-		return the same connection object.
+		return the same connection object. The only exception are processes
+		forked after the connection was opened (e.g., by the multiprocessing
+		module), which open their own connection with the same parameters.
 	"""
 	if (_connection == None):
 		logger.debug("New connection requested by PID %s" % os.getpid())
 		connect()
 
+	elif (_connection_pid != os.getpid()):
+		_reconnect()
+
 	return _connection
 
+def _reconnect():
+	# sockets of a connection cannot be shared between
+	# processes; a forked process opens its own connection
+	logger.debug("New connection requested by PID %s (forked from PID %s)" % (os.getpid(), _connection_pid))
+
+	connect(
+		host = _connection_info["host"],
+		port = _connection_info["port"],
+		db = _connection_info["db"],
+		user = _connection_info["user"],
+		password = _connection_info["password"]
+	)
+
 def connection_information():
 	""" Obtain information about the connection to MongoDB, as a dictionary.
 	"""
@@ -130,6 +152,9 @@ def connection_information():
 		logger.debug("New connection information requested by PID %s" % os.getpid())
 		connect()
 
+	elif (_connection_pid != os.getpid()):
+		_reconnect()
+
 	return copy.deepcopy(_connection_info)
 
 @contextlib.contextmanager
@@ -6,11 +6,12 @@
 from .. import errors
 import connection
 import classes
+import relationships
+import cache
 from .. import utils
 
 import pymongo, bson
 
-import weakref
 import datetime
 import re
 import logging
@@ -18,8 +19,8 @@ import inspect
 
 logger = logging.getLogger("MetagenomeDB.ORM.methods")
 
-# Object cache, as a map with weak values
-_cache = weakref.WeakValueDictionary()
+# Object cache (see cache.py)
+_cache = cache.identity_map
 
 # List of classes the foundry should instanciate from MongoDB documents, based on the name of the collection this document comes from
 _classes = {}
@@ -27,18 +28,40 @@ _classes = {}
 def declare_class (cls):
 	_classes[cls.__name__] = cls
 
+# Number of times each MongoDB collection was modified by this process, per
+# database; used to invalidate information derived from a collection content
+_generations = {}
+
+def _modified (collection_name):
+	key = (connection.connection().name, collection_name)
+	_generations[key] = _generations.get(key, 0) + 1
+
+def generation (collection_name):
+	""" Return a value that changes each time objects are committed to, or
+		removed from a given MongoDB collection by this process
+	"""
+	key = (connection.connection().name, collection_name)
+	return key + (_generations.get(key, 0),)
+
 #:::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
 
-# Commit a PersistentObject to the database. IMPORTANT NOTE: this does not
-# support concurrent modifications. I.e., if another client modifies the
-# backend database after an object has been instanciated, a commit() will
-# overwrite those modifications.
-def _commit (object):
+# Names of the MongoDB collections known to exist in the database, as
+# (database, collection) tuples; used to avoid listing all collections
+# of the database before each commit
+_existing_collections = set()
+
+# Return the MongoDB collection a PersistentObject is stored in. If this
+# collection doesn't exist in the database, it is created with its indices
+def _get_collection (object):
 	db = connection.connection()
 
 	collection_name = object.__class__.__name__
 	collection = db[collection_name]
 
+	key = (db.name, collection_name)
+	if (key in _existing_collections):
+		return collection
+
 	# if the collection this object belongs to doesn't exist in
 	# the database, we create it with its indices (if any)
 	if (not collection_name in db.collection_names()):
@@ -51,44 +74,238 @@ def _commit (object):
 
 		logger.debug(msg + '.')
 
-	# second case: the object is not committed, and is not in the database
+	_existing_collections.add(key)
+	return collection
+
+# Update the creation or modification time of an object about to be committed
+def _timestamp (object):
+	# first case: the object is not committed, and is not in the database
 	if (not "_id" in object):
 		object._properties["_creation_time"] = datetime.datetime.utcnow()
-		verb = "created"
+		return "created"
 
-	# third case: the object is not committed, but a former version exists in the database
+	# second case: the object is not committed, but a former version exists in the database
 	else:
 		object._properties["_modification_time"] = datetime.datetime.utcnow()
-		verb = "updated"
+		return "updated"
+
+# Translate a duplicate key error message into a DuplicateObjectError exception
+def _duplicate_object_error (object, message):
+	collection_name = object.__class__.__name__
+	properties = [(key, object[key]) for key in filter(lambda x: "$%s_" % x in message, object._indices)]
+
+	return errors.DuplicateObjectError(collection_name, properties)
+
+# Test if an error message reports a document exceeding the maximum size
+def _is_too_large_error (message):
+	return ("too large" in message) or ("larger than" in message)
+
+# Build a MongoDB update document (see http://www.mongodb.org/display/DOCS/Updating)
+# with only those properties of an object that were modified since its
+# latest commit
+def _update_document (object):
+	updated, deleted, appended = object._get_modifications()
+
+	# relationships stored in a dedicated collection are committed separately
+	if (relationships.is_external()):
+		is_relationship = lambda key: (key == "_relationships") or key.startswith("_relationships.")
+
+		for key in filter(is_relationship, updated.keys()):
+			del updated[key]
+
+		deleted = filter(lambda key: not is_relationship(key), deleted)
+
+		for key in filter(is_relationship, appended.keys()):
+			del appended[key]
+
+	updated["_modification_time"] = object._properties["_modification_time"]
+
+	update = {"$set": updated}
+
+	if (len(deleted) > 0):
+		update["$unset"] = dict([(key, 1) for key in deleted])
+
+	if (len(appended) > 0):
+		update["$push"] = dict([(key, {"$each": values}) for (key, values) in appended.iteritems()])
+
+	return update
+
+# Return the document representing a new object in the database
+def _insert_document (object):
+	document = object.get_properties()
+
+	# relationships stored in a dedicated collection are committed separately
+	if (relationships.is_external()):
+		del document["_relationships"]
+
+	return document
+
+# Commit a PersistentObject to the database. New objects are inserted as
+# a whole, while objects already in the database are updated with the
+# properties that were modified since their latest commit. IMPORTANT NOTE:
+# this does not support concurrent modifications of the same properties.
+# I.e., if another client modifies a property in the backend database after
+# an object has been instanciated, a commit() of a modification of this
+# property will overwrite it.
+def _commit (object):
+	collection_name = object.__class__.__name__
+	collection = _get_collection(object)
+
+	object._commit_precallback()
+
+	verb = _timestamp(object)
 
 	try:
-		object_id = collection.save(
-			object.get_properties(),
-			safe = True
-		)
+		if (verb == "created"):
+			object_id = collection.insert(
+				_insert_document(object),
+				safe = True
+			)
+		else:
+			object_id = object._properties["_id"]
+			collection.update(
+				{"_id": object_id},
+				_update_document(object),
+				safe = True
+			)
 
 		object._properties["_id"] = object_id
+		object._reset_modifications()
 		_cache[object_id] = object
 
 	except pymongo.errors.OperationFailure as e:
 		# we process index-related errors independently
 		if ("E11000" in str(e)):
-			properties = [(key, object[key]) for key in filter(lambda x: "$%s_" % x in str(e), object._indices)]
-			raise errors.DuplicateObjectError(collection_name, properties)
+			raise _duplicate_object_error(object, str(e))
+
+		if (_is_too_large_error(str(e))):
+			raise errors.DBOperationError("Object is too large to be committed")
 
 		raise e
 
 	except bson.errors.InvalidDocument as e:
-		if ("too large" in str(e)):
+		if (_is_too_large_error(str(e))):
 			raise errors.DBOperationError("Object is too large to be committed")
 
 		raise e
 
+	_modified(collection_name)
+
+	if (relationships.is_external()):
+		relationships.commit([object])
+
+	object._commit_postcallback()
+
 	logger.debug("Object %s %s in collection '%s'." % (object, verb, collection_name))
 
+# Commit several PersistentObject instances to the database, grouping the
+# writes as one bulk operation per MongoDB collection. Return a list of
+# (object, exception) tuples for the objects that couldn't be committed.
+# The same restriction than for _commit() applies regarding concurrent
+# modifications of the database.
+def _commit_all (objects):
+	# objects are grouped by collection, in order of appearance
+	collections, objects_per_collection = [], {}
+	for object in objects:
+		collection_name = object.__class__.__name__
+		if (not collection_name in objects_per_collection):
+			collections.append(collection_name)
+			objects_per_collection[collection_name] = []
+
+		objects_per_collection[collection_name].append(object)
+
+	failures = []
+	for collection_name in collections:
+		objects_ = objects_per_collection[collection_name]
+		collection = _get_collection(objects_[0])
+
+		bulk = collection.initialize_unordered_bulk_op()
+		operations = []
+
+		for object in objects_:
+			object._commit_precallback()
+			verb = _timestamp(object)
+
+			if (verb == "created"):
+				document = _insert_document(object)
+				document["_id"] = object_id = bson.objectid.ObjectId()
+				bulk.insert(document)
+			else:
+				object_id = object._properties["_id"]
+				bulk.find({"_id": object_id}).update_one(_update_document(object))
+
+			operations.append((object, object_id, verb))
+
+		failed = {}
+		try:
+			bulk.execute({"w": 1})
+
+		except pymongo.errors.BulkWriteError as e:
+			for error in e.details["writeErrors"]:
+				object = operations[error["index"]][0]
+
+				# we process index-related errors independently
+				if (error.get("code") in (11000, 11001)) or ("E11000" in error["errmsg"]):
+					failed[error["index"]] = _duplicate_object_error(object, error["errmsg"])
+
+				elif (_is_too_large_error(error["errmsg"])):
+					failed[error["index"]] = errors.DBOperationError("Object is too large to be committed")
+
+				else:
+					failed[error["index"]] = errors.DBOperationError(
+						"Unable to commit object %s. Reason: %s" % (object, error["errmsg"]))
+
+		# the bulk operation is interrupted by documents that cannot be
+		# encoded (e.g., too large); objects inserted before that are
+		# found by their identifier, and all others considered as failed
+		except bson.errors.InvalidDocument as e:
+			if (_is_too_large_error(str(e))):
+				e = errors.DBOperationError("Object is too large to be committed")
+
+			inserted_ids = [object_id for (object, object_id, verb) in operations if (verb == "created")]
+			inserted_ids = set([entry["_id"] for entry in collection.find(
+				{"_id": {"$in": inserted_ids}}, fields = ["_id"], timeout = False)])
+
+			for n, (object, object_id, verb) in enumerate(operations):
+				if (not object_id in inserted_ids):
+					failed[n] = e
+
+		committed = []
+		for n, (object, object_id, verb) in enumerate(operations):
+			if (n in failed):
+				failures.append((object, failed[n]))
+				continue
+
+			object._properties["_id"] = object_id
+			object._reset_modifications()
+			_cache[object_id] = object
+			committed.append(object)
+
+			logger.debug("Object %s %s in collection '%s'." % (object, verb, collection_name))
+
+		_modified(collection_name)
+
+		if (relationships.is_external()):
+			relationships.commit(committed)
+
+		for object in committed:
+			object._commit_postcallback()
+
+		logger.debug("%s object%s committed in collection '%s' in a single bulk operation." % (
+			len(committed), {True: 's', False: ''}[len(committed) > 1], collection_name))
+
+	return failures
+
 def exists (id):
 	return (id in _cache)
 
+def is_forged (properties):
+	""" Test if an object is being instanciated from a database entry (see
+		_forge_from_entry()); if so, its properties were already decoded into
+		a nested dictionary of their own
+	"""
+	return isinstance(_cache.get(properties.get("_id")), type)
+
 #:::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
 
 def count (collection, query):
@@ -100,23 +317,47 @@ def count (collection, query):
 	else:
 		return find(collection, query, count = True)
 
-def distinct (collection, field):
-	""" Return unique values for a given field in a given collection, plus the number of objects having this value
+def aggregate (collection, pipeline):
+	""" Run an aggregation pipeline on a given collection; return an iterator
+		on its results, which are retrieved by batches as they are produced
 	"""
-	cursor = connection.connection()[collection]
+	logger.debug("Aggregating %s in collection '%s'." % (pipeline, collection))
+
+	with connection.protect():
+		return connection.connection()[collection].aggregate(pipeline,
+			cursor = {}, allowDiskUse = True)
+
+# MongoDB values such as lists or nested documents can be grouped on,
+# but can't be used as keys of a Python dictionary
+def _hashable (value):
+	value_t = type(value)
+
+	if (value_t == list):
+		return tuple([_hashable(item) for item in value])
+
+	if (value_t == dict):
+		return tuple(sorted([(str(key), _hashable(item)) for (key, item) in value.iteritems()]))
+
+	return value
 
-	result = cursor.group(
-		key = {field: 1},
-		condition = {},
-		initial = {"count": 0},
-		reduce = "function (o, p) { p.count++; }"
-	)
+def distinct (collection, field, query = None):
+	""" Return unique values for a given field in a given collection, plus the
+		number of objects having this value; only objects matching a query
+		are considered if one is provided
+	"""
+	field = '.'.join(utils.tree.expand_key(field))
+
+	pipeline = []
+	if (query != None) and (query != {}):
+		pipeline.append({"$match": query})
 
-	result_ = {}
-	for r in result:
-		result_[r[field]] = int(r["count"])
+	pipeline.append({"$group": {"_id": '$' + field, "count": {"$sum": 1}}})
 
-	return result_
+	result = {}
+	for r in aggregate(collection, pipeline):
+		result[_hashable(r["_id"])] = int(r["count"])
+
+	return result
 
 def list_collections (with_classes = False):
 	""" Return a list of all existing collections in the database that can be
@@ -137,8 +378,59 @@ def list_collections (with_classes = False):
 
 	return collections
 
-def find (collection, query, find_one = False, count = False):
+def _projection (fields, raw = False):
+	""" Validate a field projection, expressed either as a list of properties
+		to retrieve or as a dictionary with properties as keys and True (to
+		retrieve) or False (to ignore) as values. Return the corresponding
+		'fields' parameter for MongoDB and a (include, keys) tuple describing
+		the projection, or None for both if whole documents are requested.
+
+	.. note::
+		The '_relationship_with' property is always retrieved, unless raw
+		documents are requested (i.e., no object is forged from them).
+	"""
+	if (fields == None):
+		return None, None
+
+	if (type(fields) in (list, tuple, set)):
+		fields = dict([(key, True) for key in fields])
+
+	elif (type(fields) != dict):
+		raise ValueError("Invalid field projection: %s" % fields)
+
+	# an empty projection means whole documents
+	if (len(fields) == 0):
+		return None, None
+
+	keys, modes = [], {}
+	for (key, value) in fields.iteritems():
+		if (key == "_id"):
+			continue
+
+		keys.append(utils.tree.expand_key(key))
+		modes[bool(value)] = True
+
+	if (len(modes) > 1):
+		raise ValueError("Invalid field projection: properties cannot be both included and excluded")
+
+	include = modes.keys()[0] if (len(modes) > 0) else True
+
+	if (include):
+		if (not raw) and (not ("_relationship_with",) in keys):
+			keys.append(("_relationship_with",))
+
+	elif (("_relationship_with",) in keys):
+		raise ValueError("Invalid field projection: property '_relationship_with' cannot be excluded")
+
+	# only the identifiers of raw documents are requested
+	if (len(keys) == 0):
+		return {"_id": True}, (include, keys)
+
+	return dict([('.'.join(key), include) for key in keys]), (include, keys)
+
+def find (collection, query, find_one = False, count = False, fields = None, raw = False):
 	""" Return objects matching a given query (expressed as a JSON object, see http://www.mongodb.org/display/DOCS/Querying), as PersistentObject instances
+		or, if raw is set, as the documents returned by MongoDB
 	"""
 	cursor = connection.connection()[collection]
 	query_t = type(query)
@@ -150,7 +442,7 @@ def find (collection, query, find_one = False, count = False):
 		except bson.errors.InvalidId:
 			raise errors.InvalidObjectOperationError("Invalid identifier: %s" % query)
 
-	if (query_t == bson.objectid.ObjectId):
+	elif (query_t == bson.objectid.ObjectId):
 		query = {"_id": query}
 
 	elif (query_t == dict):
@@ -161,24 +453,92 @@ def find (collection, query, find_one = False, count = False):
 	elif (query != None):
 		raise errors.InvalidObjectOperationError("Invalid query: %s" % query)
 
+	# objects retrieved by identifier are
+	# served from the cache when possible
+	if (find_one) and (query != None) and (query.keys() == ["_id"]) and \
+	   (type(query["_id"]) == bson.objectid.ObjectId) and (query["_id"] in _cache):
+		instance = _cache.lookup(query["_id"], collection)
+		if (instance != None):
+			logger.debug("Object %s found in cache." % query["_id"])
+			return instance
+
 	logger.debug("Querying %s in collection '%s'." % (query, collection))
 
 	if (count):
 		return cursor.find(query, timeout = False).count()
 
+	# by default, properties declared as deferred by the class
+	# are only retrieved when accessed (see PersistentObject)
+	if (fields == None):
+		fields = dict([(key, False) for key in _classes[collection]._deferred_properties])
+
+	fields, projection = _projection(fields, raw)
+
+	# documents are not forged into objects, nor
+	# registered in the cache (e.g., for exports)
+	if (raw):
+		if (find_one):
+			return cursor.find_one(query, fields = fields)
+		else:
+			return cursor.find(query, fields = fields, timeout = False)
+
 	if (find_one):
-		return _forge_from_entry(collection, cursor.find_one(query))
+		return _forge_from_entry(collection, cursor.find_one(query, fields = fields), projection)
 	else:
-		return _forge_from_entries(collection, cursor.find(query, timeout = False))
+		return _forge_from_entries(collection, cursor.find(query, fields = fields, timeout = False), projection)
 
-# Forge an object from a unique entry
-def _forge_from_entry (collection, entry):
+def load_properties (object, fields):
+	""" Retrieve some properties of a committed object from the database
+	"""
+	collection_name = object.__class__.__name__
+
+	# note: the object itself is not displayed, as this
+	# could require properties that are not retrieved yet
+	id = object._properties["_id"]
+	logger.debug("Retrieving properties %s of object %s from collection '%s'." % (fields, id, collection_name))
+
+	entry = connection.connection()[collection_name].find_one({"_id": id}, fields = fields)
+	if (entry == None):
+		raise errors.InvalidObjectError("Object %s no longer exists in collection '%s'." % (id, collection_name))
+
+	return _decode(entry)
+
+# Transform a MongoDB document into a dictionary of properties, in a single
+# pass: keys of (nested) dictionaries are converted from unicode to str, and
+# the result is used as-is by the object it is forged into (see is_forged())
+def _decode (entry):
+	properties = {}
+
+	# each element of the stack is a dictionary to
+	# decode and the dictionary to decode it into
+	stack = [(entry, properties)]
+
+	while (len(stack) > 0):
+		source, target = stack.pop()
+
+		for key, value in source.iteritems():
+			if (type(value) == dict):
+				subtarget = target[str(key)] = {}
+				stack.append((value, subtarget))
+			else:
+				target[str(key)] = value
+
+	return properties
+
+# Forge an object from a unique entry, with projection being either None (the
+# entry is a whole document) or an (include, keys) tuple (see _projection())
+def _forge_from_entry (collection, entry, projection = None):
 	if (entry == None):
 		return None
 
 	id = entry["_id"]
-	if (id in _cache):
-		return _cache[id]
+	instance = _cache.lookup(id, collection)
+	if (instance != None):
+		# partially loaded objects are completed with the new entry
+		if (instance._projection != None):
+			instance._merge_properties(_decode(entry), projection)
+
+		return instance
 
 	# select the class for this object
 	clazz = _classes[collection]
@@ -187,20 +547,24 @@ def _forge_from_entry (collection, entry):
 	# that during the instanciation the identifier is present in the cache
 	_cache[id] = clazz
 
-	# instanciate this class
-	instance = clazz(utils.tree.traverse(entry, lambda x: True, lambda x: str(x)))
+	# instanciate this class; as its identifier is associated with its
+	# class in the cache, the decoded entry will not be copied again
+	instance = clazz(_decode(entry))
+
+	if (projection != None):
+		instance._set_projection(projection)
 
 	_cache[id] = instance
 	return instance
 
 # Forge an iterator from multiple entries
-def _forge_from_entries (collection, resultset):
+def _forge_from_entries (collection, resultset, projection = None):
 	if (resultset == None):
 		return []
 	else:
 		def __generator():
 			for object in resultset:
-				yield _forge_from_entry(collection, object)
+				yield _forge_from_entry(collection, object, projection)
 
 		return __generator()
 
@@ -215,15 +579,85 @@ def remove_object (object):
 		connection.connection()[collection_name].remove({"_id": object["_id"]})
 
 	del _cache[object["_id"]]
+	_modified(collection_name)
 
 	logger.debug("Object %s was removed from collection '%s'." % (object, collection_name))
 
+def remove_objects (collection, ids):
+	""" Remove objects from a collection, given their identifiers
+	"""
+	with connection.protect():
+		connection.connection()[collection].remove({"_id": {"$in": list(ids)}}, safe = True)
+
+	for id in ids:
+		del _cache[id]
+
+	_modified(collection)
+
+	logger.debug("%s object%s removed from collection '%s'." % (len(ids), {True: 's', False: ''}[len(ids) > 1], collection))
+
+def remove_relationships (target_ids, exclude = None):
+	""" Remove all relationships to a set of objects from the objects of all
+		collections (except, optionally, one), with one update per collection
+	"""
+	target_ids = [str(id) for id in target_ids]
+	if (len(target_ids) == 0):
+		return
+
+	update = {"$pull": {"_relationship_with": {"$in": target_ids}}}
+
+	if (not relationships.is_external()):
+		update["$unset"] = dict([("_relationships." + id, 1) for id in target_ids])
+
+	for collection_name in list_collections():
+		if (collection_name == exclude):
+			continue
+
+		with connection.protect():
+			result = connection.connection()[collection_name].update(
+				{"_relationship_with": {"$in": target_ids}},
+				update,
+				multi = True,
+				safe = True
+			)
+
+		if (result.get("n", 1) > 0):
+			_modified(collection_name)
+			logger.debug("Relationships to %s object%s removed from %s object%s in collection '%s'." % (
+				len(target_ids), {True: 's', False: ''}[len(target_ids) > 1],
+				result.get("n"), {True: 's', False: ''}[result.get("n") > 1], collection_name))
+
+	if (relationships.is_external()):
+		relationships.remove({"target": {"$in": target_ids}})
+
+	# instances in memory are updated accordingly
+	target_ids = set(target_ids)
+	for object in _cache.instances():
+		object._forget_relationships_with(target_ids)
+
+def find_ids (collection, query = None):
+	""" Return the identifiers of all objects of a collection matching a query
+	"""
+	with connection.protect():
+		for entry in connection.connection()[collection].find(query, fields = ["_id"], timeout = False):
+			yield entry["_id"]
+
+def list_instances (collection):
+	""" Return all instances of objects of a collection currently in memory
+	"""
+	return [object for object in _cache.instances() if (object.__class__.__name__ == collection)]
+
 def drop_collection (collection):
 	""" Drop a collection
 	"""
 	with connection.protect():
 		connection.connection().drop_collection(collection)
 
+	_existing_collections.discard((connection.connection().name, collection))
+	_modified(collection)
+
+	for object in list_instances(collection):
+		del _cache[object._properties["_id"]]
 	logger.debug("Collection '%s' was dropped." % collection)
 
 def copy_database (target_db, admin_user = None, admin_password = None, force = False):
@@ -255,6 +689,6 @@ def copy_database (target_db, admin_user = None, admin_password = None, force =
 		# restore the current connection
 		finally:
 			connection._connection = db_connection
-			connection._connection_information = db_connection_
+			connection._connection_info = db_connection_
 
 	logger.debug("Copy of '%s' into '%s' successful." % (source_db, target_db))
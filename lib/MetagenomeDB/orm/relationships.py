@@ -0,0 +1,369 @@
+# storage of relationships between objects in a dedicated MongoDB collection
+
+# Note: By default, relationships are stored as properties of their source
+# object ('embedded' storage); i.e., as a list of target identifiers in the
+# '_relationship_with' property and as a dictionary of relationship
+# descriptions, keyed by target identifier, in the '_relationships' property.
+# This file implements an alternative ('collection' storage) where only the
+# '_relationship_with' property is stored in the source object, while each
+# relationship is stored as a document of its own in a 'Relationship'
+# collection. This removes any limit on the number of relationships an
+# object can have. The storage mode is a property of the database, and is
+# set by the existence of this 'Relationship' collection.
+
+from .. import errors
+import connection
+import cache
+from .. import utils
+
+import pymongo
+
+import logging
+
+logger = logging.getLogger("MetagenomeDB.ORM.relationships")
+
+EMBEDDED = "embedded"
+COLLECTION = "collection"
+
+# name of the MongoDB collection relationships are stored in
+_COLLECTION_NAME = "Relationship"
+
+# indices of this collection
+_INDICES = (
+	[("source", pymongo.ASCENDING), ("target", pymongo.ASCENDING)],
+	[("target", pymongo.ASCENDING), ("source_class", pymongo.ASCENDING)],
+	[("properties.type", pymongo.ASCENDING)],
+)
+
+# storage mode of each database, cached
+_storage_modes = {}
+
+def storage_mode():
+	""" Return the way relationships are stored in the current database;
+		either 'embedded' (relationships are stored as part of their source
+		object) or 'collection' (relationships are stored in a dedicated
+		collection).
+
+	.. note::
+		The storage mode is read from the database once, then cached for
+		the lifetime of the process; a change of mode made by another
+		process (e.g., mdb-migrate-relationships) is not seen.
+	"""
+	db = connection.connection()
+
+	if (not db.name in _storage_modes):
+		with connection.protect():
+			if (_COLLECTION_NAME in db.collection_names()):
+				_storage_modes[db.name] = COLLECTION
+			else:
+				_storage_modes[db.name] = EMBEDDED
+
+	return _storage_modes[db.name]
+
+def set_storage_mode (mode):
+	""" Set the way relationships are stored in the current database.
+
+	Parameters:
+		- **mode**: either 'embedded' (relationships are stored as part of
+		  their source object) or 'collection' (relationships are stored in a
+		  dedicated collection).
+
+	.. note::
+		- Switching to 'collection' storage is only possible if the database
+		  contains no relationship yet; otherwise existing relationships must
+		  be migrated with the mdb-migrate-relationships tool.
+		- Switching back to 'embedded' storage is only possible if the
+		  'Relationship' collection is empty.
+	"""
+	if (not mode in (EMBEDDED, COLLECTION)):
+		raise ValueError("Invalid relationship storage mode '%s'" % mode)
+
+	if (mode == storage_mode()):
+		return
+
+	db = connection.connection()
+
+	with connection.protect():
+		if (mode == COLLECTION):
+			for collection_name in _object_collections():
+				if (db[collection_name].find_one({"_relationships": {"$exists": True, "$ne": {}}}) != None):
+					raise errors.DBOperationError("Unable to switch to '%s' relationship storage: collection '%s' contains embedded relationships. Use mdb-migrate-relationships instead." % (mode, collection_name))
+
+			_create_collection()
+
+		else:
+			if (db[_COLLECTION_NAME].count() > 0):
+				raise errors.DBOperationError("Unable to switch to '%s' relationship storage: the '%s' collection is not empty." % (mode, _COLLECTION_NAME))
+
+			db.drop_collection(_COLLECTION_NAME)
+
+	_storage_modes[db.name] = mode
+	logger.debug("Relationship storage set to '%s' for database '%s'." % (mode, db.name))
+
+def is_external():
+	""" Test if relationships are stored in a dedicated collection
+	"""
+	return (storage_mode() == COLLECTION)
+
+def _object_collections():
+	# imported here to avoid a circular import
+	import methods
+	return methods.list_collections()
+
+def _create_collection():
+	db = connection.connection()
+	collection = db[_COLLECTION_NAME]
+
+	# the collection is created explicitly so that it exists even when empty
+	if (not _COLLECTION_NAME in db.collection_names()):
+		db.create_collection(_COLLECTION_NAME)
+
+	for index in _INDICES:
+		collection.create_index(index)
+
+	logger.debug("Collection '%s' created with indices %s." % (_COLLECTION_NAME,
+		', '.join(["'%s'" % '+'.join([key for (key, direction) in index]) for index in _INDICES])))
+
+	return collection
+
+def _collection():
+	return connection.connection()[_COLLECTION_NAME]
+
+#:::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def query (source = None, target = None, source_class = None, relationship_filter = None):
+	""" Build a query for relationships stored in the 'Relationship' collection
+	"""
+	query = {}
+
+	for (key, value) in (("source", source), ("target", target), ("source_class", source_class)):
+		if (value == None):
+			continue
+
+		if (type(value) in (list, tuple, set)):
+			query[key] = {"$in": [str(v) for v in value]}
+		else:
+			query[key] = str(value)
+
+	if (relationship_filter != None):
+		query.update(filter_query(relationship_filter, "properties."))
+
+	return query
+
+def filter_query (relationship_filter, prefix):
+	""" Transform a relationship filter into a query for documents in which
+		relationships are stored as a sub-document with a given prefix
+	"""
+	query = {}
+	for (key, value) in utils.tree.flatten(relationship_filter).iteritems():
+		# logical operators apply to filters themselves
+		if (key in ("$and", "$or", "$nor")):
+			query[key] = [filter_query(filter, prefix) for filter in value]
+		else:
+			query[prefix + key] = value
+
+	return query
+
+def matcher (relationship_filter):
+	""" Return a function testing if a relationship (as a dictionary)
+		matches a relationship filter, with no query to the database
+	"""
+	return utils.matcher.compile(filter_query(relationship_filter, ''))
+
+def find (query, fields = None):
+	""" Return relationships matching a query, as documents with 'source',
+		'target', 'source_class' and 'properties' keys
+	"""
+	logger.debug("Querying %s in collection '%s'." % (query, _COLLECTION_NAME))
+
+	with connection.protect():
+		return _collection().find(query, fields = fields, timeout = False)
+
+def count (query):
+	""" Return the number of relationships matching a query
+	"""
+	with connection.protect():
+		return _collection().find(query).count()
+
+def distinct (query, key):
+	""" Return unique values of a key ('source' or 'target') amongst
+		relationships matching a query
+	"""
+	values = {}
+	for relationship in find(query, fields = [key]):
+		values[relationship[key]] = True
+
+	return values.keys()
+
+def remove (query):
+	""" Remove all relationships matching a query
+	"""
+	with connection.protect():
+		_collection().remove(query, safe = True)
+
+def commit (objects):
+	""" Store the relationships added to or removed from a set of objects
+		since their latest commit.
+
+	.. note::
+		Relationships to be removed are stored in the '_removed_relationships'
+		attribute of the source object, as a dictionary with target
+		identifiers as keys and either None (all relationships with this
+		target) or a list of relationship identifiers as values.
+		Relationships to be added are stored in the '_relationships'
+		property of the source object.
+	"""
+	to_remove, to_insert = [], []
+
+	for object in objects:
+		source_id = str(object._properties["_id"])
+		source_class = object.__class__.__name__
+
+		for (target_id, relationship_ids) in object._removed_relationships.iteritems():
+			if (relationship_ids == None):
+				to_remove.append({"source": source_id, "target": target_id})
+			else:
+				to_remove.append({"_id": {"$in": list(relationship_ids)}})
+
+		for (target_id, relationships) in object._properties["_relationships"].iteritems():
+			for relationship in relationships:
+				to_insert.append({
+					"source": source_id,
+					"target": target_id,
+					"source_class": source_class,
+					"properties": relationship,
+				})
+
+	if (len(to_remove) == 0) and (len(to_insert) == 0):
+		return
+
+	collection = _collection()
+
+	with connection.protect():
+		# removals are processed first, as they only
+		# apply to relationships committed previously
+		if (len(to_remove) > 0):
+			collection.remove({"$or": to_remove}, safe = True)
+
+		if (len(to_insert) > 0):
+			collection.insert(to_insert, safe = True)
+
+	for object in objects:
+		object._properties["_relationships"] = {}
+		object._removed_relationships = {}
+
+	logger.debug("%s relationship%s added and %s removed in collection '%s'." % (
+		len(to_insert), {True: 's', False: ''}[len(to_insert) > 1], len(to_remove), _COLLECTION_NAME))
+
+#:::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+# Remove relationships that have been moved to the 'Relationship' collection
+# from the instances of these objects in memory, so that they are not
+# considered as relationships to add on the next commit (see commit())
+def _forget_migrated (objects):
+	for object in objects:
+		instance = cache.identity_map.get(object["_id"])
+		if (instance == None) or (isinstance(instance, type)):
+			continue
+
+		relationships_ = instance._properties.get("_relationships")
+		if (relationships_ == None):
+			continue
+
+		# relationships added since the latest commit are kept
+		for (target_id, relationships) in object["_relationships"].iteritems():
+			target_id = str(target_id)
+			if (not target_id in relationships_):
+				continue
+
+			for relationship in relationships:
+				if (relationship in relationships_[target_id]):
+					relationships_[target_id].remove(relationship)
+
+			if (len(relationships_[target_id]) == 0):
+				del relationships_[target_id]
+
+def migrate (batch_size = 1000):
+	""" Move relationships embedded in objects to the 'Relationship'
+		collection, by batches of objects. For each batch, yield the name of
+		the object collection being processed, the number of objects in this
+		batch and the number of relationships moved.
+
+	.. note::
+		- The migration can be interrupted and resumed; objects are processed
+		  in order of their identifier, and an object is considered migrated
+		  once its '_relationships' property has been deleted. Relationships
+		  are flagged as 'migrated' until then, so that those moved by an
+		  interrupted migration can be told from those committed since.
+		- Objects in memory only keep the relationships added since their
+		  latest commit.
+		- The storage mode is read once per process (see
+		  :func:`storage_mode`); processes already connected to the database
+		  when the migration starts keep on storing relationships in the
+		  objects, and must be stopped before.
+	"""
+	db = connection.connection()
+
+	with connection.protect():
+		collection_names = _object_collections()
+		relationship_collection = _create_collection()
+
+	_storage_modes[db.name] = COLLECTION
+
+	for collection_name in collection_names:
+		collection = db[collection_name]
+		query = {"_relationships": {"$exists": True}}
+
+		while True:
+			with connection.protect():
+				batch = list(collection.find(query,
+					fields = ["_relationships"],
+					sort = [("_id", pymongo.ASCENDING)],
+					limit = batch_size,
+					timeout = False))
+
+			if (len(batch) == 0):
+				break
+
+			object_ids = [object["_id"] for object in batch]
+			source_ids = [str(object_id) for object_id in object_ids]
+
+			to_insert = []
+			for object in batch:
+				for (target_id, relationships) in object["_relationships"].iteritems():
+					for relationship in relationships:
+						to_insert.append({
+							"source": str(object["_id"]),
+							"target": str(target_id),
+							"source_class": collection_name,
+							"properties": relationship,
+							"migrated": True,
+						})
+
+			with connection.protect():
+				# relationships of these objects may have been partially
+				# moved by a previous, interrupted migration; relationships
+				# committed since then are not flagged, and are kept
+				relationship_collection.remove({"source": {"$in": source_ids}, "migrated": True}, safe = True)
+
+				if (len(to_insert) > 0):
+					relationship_collection.insert(to_insert, safe = True)
+
+				collection.update(
+					{"_id": {"$in": object_ids}},
+					{"$unset": {"_relationships": 1}},
+					multi = True,
+					safe = True
+				)
+
+				relationship_collection.update(
+					{"source": {"$in": source_ids}, "migrated": True},
+					{"$unset": {"migrated": 1}},
+					multi = True,
+					safe = True
+				)
+
+			_forget_migrated(batch)
+
+			query["_id"] = {"$gt": object_ids[-1]}
+			yield collection_name, len(batch), len(to_insert)
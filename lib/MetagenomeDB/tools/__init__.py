@@ -1,6 +1,8 @@
 
 from ui import *
 from parsing import *
+import formats
+import bgzf
 
 import os
 
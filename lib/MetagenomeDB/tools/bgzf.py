@@ -0,0 +1,158 @@
+# bgzf.py: Writing of BGZF-compressed files, with .gzi index
+
+# Note: BGZF files (see the SAM/BAM format specification) are series of gzip
+# members, or blocks, of at most 64 KB each; they can be read by any gzip
+# decompressor, and randomly accessed by tools such as samtools given the
+# offsets of the blocks (.gzi index). Blocks are compressed independently,
+# by a pool of threads, while the data to compress is being produced; they
+# are written in order.
+
+from __future__ import absolute_import
+
+import collections
+import multiprocessing.pool
+import struct
+import zlib
+
+# maximal number of uncompressed bytes per block (as with bgzip)
+BLOCK_SIZE = 65280
+
+# maximal size of a compressed block
+_MAX_BLOCK_SIZE = 65536
+
+# empty block marking the end of a BGZF file
+_EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+def _block (data, level):
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+	compressed = compressor.compress(data) + compressor.flush()
+
+	# header (18 bytes) and footer (8 bytes)
+	size = 18 + len(compressed) + 8
+
+	return ''.join((
+		struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, size - 1),
+		compressed,
+		struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+	))
+
+def compress_block (data, level = 6):
+	""" Compress at most :data:`BLOCK_SIZE` bytes into a BGZF block
+	"""
+	block = _block(data, level)
+
+	# data that cannot be compressed is stored as-is
+	if (len(block) > _MAX_BLOCK_SIZE):
+		block = _block(data, 0)
+
+	return block
+
+class BgzfWriter (object):
+	""" Write-only file-like object compressing its content with BGZF
+	"""
+	def __init__ (self, output, threads = 1, level = 6):
+		""" Create a new BGZF writer.
+
+		Parameters:
+			- **output**: file-like object to write the compressed data to
+			- **threads**: number of threads compressing blocks (default: 1)
+			- **level**: compression level, between 0 and 9 (default: 6)
+		"""
+		self.__output = output
+		self.__level = level
+		self.__pool = multiprocessing.pool.ThreadPool(threads)
+
+		# blocks being compressed, in order, with their uncompressed size
+		self.__pending = collections.deque()
+		self.__max_pending = 4 * threads
+
+		self.__buffer, self.__buffer_size = [], 0
+
+		# uncompressed and compressed sizes of the data written so far
+		self.__size = 0
+		self.__compressed_size = 0
+		self.__uncompressed_size = 0
+
+		# offsets of the blocks, but the first one (see write_index())
+		self.__index = []
+
+		self.closed = False
+
+	def tell (self):
+		""" Return the number of (uncompressed) bytes written so far
+		"""
+		return self.__size
+
+	def write (self, data):
+		if (self.closed):
+			raise ValueError("I/O operation on closed file")
+
+		self.__buffer.append(data)
+		self.__buffer_size += len(data)
+		self.__size += len(data)
+
+		if (self.__buffer_size < BLOCK_SIZE):
+			return
+
+		data = ''.join(self.__buffer)
+
+		n = len(data) - len(data) % BLOCK_SIZE
+		for i in xrange(0, n, BLOCK_SIZE):
+			self.__compress(data[i:i + BLOCK_SIZE])
+
+		self.__buffer = [data[n:]]
+		self.__buffer_size = len(data) - n
+
+	def __compress (self, data):
+		self.__pending.append((self.__pool.apply_async(compress_block, (data, self.__level)), len(data)))
+
+		while (len(self.__pending) > self.__max_pending):
+			self.__write_block()
+
+	def __write_block (self):
+		result, size = self.__pending.popleft()
+		block = result.get()
+
+		if (self.__compressed_size > 0):
+			self.__index.append((self.__compressed_size, self.__uncompressed_size))
+
+		self.__output.write(block)
+		self.__compressed_size += len(block)
+		self.__uncompressed_size += size
+
+	def flush (self):
+		""" Compress and write all data written so far; the current block is
+		ended, even if not full.
+		"""
+		if (self.__buffer_size > 0):
+			self.__compress(''.join(self.__buffer))
+			self.__buffer, self.__buffer_size = [], 0
+
+		while (len(self.__pending) > 0):
+			self.__write_block()
+
+		self.__output.flush()
+
+	def close (self):
+		""" Write all data, followed by an end-of-file marker, and close the
+		underlying file.
+		"""
+		if (self.closed):
+			return
+
+		self.flush()
+		self.__output.write(_EOF)
+		self.__output.close()
+
+		self.__pool.close()
+		self.__pool.join()
+
+		self.closed = True
+
+	def write_index (self, output):
+		""" Write the offsets of the blocks written so far to a file, in the
+		.gzi format of bgzip and samtools.
+		"""
+		output.write(struct.pack("<Q", len(self.__index)))
+		for (compressed_offset, uncompressed_offset) in self.__index:
+			output.write(struct.pack("<QQ", compressed_offset, uncompressed_offset))
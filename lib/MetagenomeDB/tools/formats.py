@@ -0,0 +1,356 @@
+# formats.py: Streaming export of sequences in FASTA and FASTQ formats
+
+# Note: Sequences are read from the database as raw documents, restricted to
+# the properties needed (see read_sequences()), and written as FASTA or FASTQ
+# records without being instanciated as Sequence objects nor converted into
+# Biopython SeqRecord objects. Records are accumulated in a buffer, which is
+# written to the output by large chunks.
+
+from __future__ import absolute_import
+
+import math, string, zlib
+
+from .. import objects
+from ..utils import codec
+
+# formats supported; 'fastq' (or 'fastq-sanger') stands
+# for PHRED quality scores encoded with an offset of 33
+FORMATS = ("fasta", "fastq", "fastq-sanger")
+
+# default number of characters per line of FASTA sequences
+LINE_LENGTH = 60
+
+# default size of the output buffer, in bytes
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# maximal PHRED score encoded in FASTQ files (i.e., '~')
+_MAX_PHRED_SCORE = 93
+
+def _phred_from_solexa (score):
+	return 10 * math.log10(10 ** (score / 10.0) + 1)
+
+def _quality_character (score):
+	return chr(max(0, min(int(round(score)), _MAX_PHRED_SCORE)) + 33)
+
+# quality scores stored on one byte each (see utils/codec.py) are converted
+# into FASTQ characters with a single translation, for any scale and typecode
+def _translation (convert, signed):
+	characters = []
+	for i in xrange(256):
+		if (signed) and (i > 127):
+			i -= 256
+
+		characters.append(_quality_character(convert(i)))
+
+	return string.maketrans(''.join([chr(i) for i in xrange(256)]), ''.join(characters))
+
+_converters = {
+	"phred": lambda score: score,
+	"solexa": _phred_from_solexa,
+}
+
+_translations = {}
+for (scale, convert) in _converters.iteritems():
+	_translations[(scale, 'B')] = _translation(convert, False)
+	_translations[(scale, 'b')] = _translation(convert, True)
+
+def _str (value):
+	if (type(value) == unicode):
+		return value.encode("utf-8")
+
+	return value
+
+# number of names or identifiers looked up per query
+CHUNK_SIZE = 1000
+
+# maximal number of names excluded by a single query
+MAX_EXCLUDED_NAMES = 100000
+
+def _restrict (sequence_filter, key, condition):
+	# add a condition on a property to a sequence filter
+	if (sequence_filter == None):
+		return {key: condition}
+
+	if (key in sequence_filter):
+		return {"$and": [sequence_filter, {key: condition}]}
+
+	sequence_filter = sequence_filter.copy()
+	sequence_filter[key] = condition
+
+	return sequence_filter
+
+def read_sequences (collection, sequence_filter = None, description = True, quality = False, names = None, ids = None, excluded_names = None):
+	""" Read the sequences of a collection from the database, as raw documents
+
+	Parameters:
+		- **collection**: collection to read the sequences of
+		- **sequence_filter**: filter for the sequences (optional)
+		- **description**: if True (default), retrieve sequence descriptions
+		- **quality**: if True, retrieve quality scores (default: False)
+		- **names**: if set, only read sequences with these names (optional)
+		- **ids**: if set, only read sequences with these identifiers
+		  (optional)
+		- **excluded_names**: if set, do not read sequences with these names
+		  (optional). Must not contain more than :data:`MAX_EXCLUDED_NAMES`
+		  names.
+
+	Return:
+		A generator of (name, description, sequence, quality) tuples, with
+		the sequence and quality scores as stored in the database (see
+		:func:`decode_sequence` and :func:`decode_quality`)
+
+	.. note::
+		Names and identifiers are looked up in the database by chunks of
+		:data:`CHUNK_SIZE`, each chunk requiring a single query. Hence, the
+		number of sequences retrieved is proportional to the number of names
+		(or identifiers), not to the number of sequences in the collection.
+	"""
+	fields = ["name", "sequence"]
+	if (description):
+		fields.append("description")
+
+	if (quality):
+		fields.append("quality")
+
+	if (excluded_names != None):
+		if (len(excluded_names) > MAX_EXCLUDED_NAMES):
+			raise ValueError("Too many names to exclude (%s; maximum is %s)" % (len(excluded_names), MAX_EXCLUDED_NAMES))
+
+		sequence_filter = _restrict(sequence_filter, "name", {"$nin": list(excluded_names)})
+
+	if (names != None) and (ids != None):
+		raise ValueError("Sequences cannot be selected by both names and identifiers")
+
+	if (names != None):
+		key, values = "name", list(names)
+	elif (ids != None):
+		key, values = "_id", list(ids)
+	else:
+		key, values = None, None
+
+	if (key == None):
+		filters = [sequence_filter]
+	else:
+		filters = [_restrict(sequence_filter, key, {"$in": values[i:i + CHUNK_SIZE]})
+			for i in xrange(0, len(values), CHUNK_SIZE)]
+
+	for filter in filters:
+		for document in collection._in_vertices("Sequence", filter, fields = fields, raw = True):
+			yield (
+				document["name"],
+				document.get("description", ''),
+				document["sequence"],
+				document.get("quality")
+			)
+
+def sample_sequences (collection, n, seed = None, sequence_filter = None):
+	""" Select sequences of a collection at random, and return their
+	identifiers (see :meth:`Collection.sample_sequences()
+	<MetagenomeDB.Collection.sample_sequences>` and :func:`read_sequences`)
+	"""
+	return collection._sample_sequence_ids(n, seed, sequence_filter)
+
+def read_names (collection, sequence_filter = None):
+	""" Read the names of the sequences of a collection from the database
+
+	Return:
+		A generator of (identifier, name) tuples
+	"""
+	for document in collection._in_vertices("Sequence", sequence_filter, fields = ["name"], raw = True):
+		yield (document["_id"], document["name"])
+
+def shard_sequences (collection, number_of_shards, sequence_filter = None, sample_size = 1000):
+	""" Split the sequences of a collection into ranges of identifiers of
+	similar sizes, so that they can be read concurrently
+
+	Parameters:
+		- **collection**: collection to split the sequences of
+		- **number_of_shards**: maximal number of ranges
+		- **sequence_filter**: filter for the sequences (optional)
+		- **sample_size**: number of identifiers sampled per range to
+		  estimate the boundaries of the ranges (default: 1000)
+
+	Return:
+		A list of sequence filters, each combining **sequence_filter** with a
+		range of identifiers, in increasing order of identifiers
+
+	.. note::
+		The boundaries of the ranges are estimated from a random sample of
+		the identifiers, selected by the server; hence, the ranges are of
+		similar but not necessarily equal sizes. The server still reads the
+		identifiers of all sequences of the collection to select this
+		sample, but only the sample is sent back.
+	"""
+	sample = [document["_id"] for document in collection._in_vertices("Sequence", sequence_filter,
+		fields = ["_id"], raw = True, sample = sample_size * number_of_shards)]
+
+	sample.sort()
+
+	boundaries = []
+	for i in xrange(1, number_of_shards):
+		boundary = sample[i * len(sample) // number_of_shards] if (len(sample) > 0) else None
+		if (boundary != None) and ((len(boundaries) == 0) or (boundary != boundaries[-1])):
+			boundaries.append(boundary)
+
+	if (len(boundaries) == 0):
+		return [sequence_filter]
+
+	ranges = [{"$lt": boundaries[0]}]
+	for i in xrange(1, len(boundaries)):
+		ranges.append({"$gte": boundaries[i - 1], "$lt": boundaries[i]})
+
+	ranges.append({"$gte": boundaries[-1]})
+
+	return [_restrict(sequence_filter, "_id", range_) for range_ in ranges]
+
+def decode_sequence (value):
+	""" Decode a sequence as stored in the database, and return it as a string
+	"""
+	return _str(objects.Sequence._decode_sequence(value))
+
+def decode_quality (quality):
+	""" Decode quality scores as stored in the database
+
+	Return:
+		A tuple with (1) the scale of the scores, in lower case (e.g., 'phred'
+		or 'solexa') and (2) the scores, as a list of integers
+	"""
+	scale = str(quality.get("scale", "PHRED")).lower()
+	values = quality["values"]
+
+	if (type(values) == dict):
+		values = codec.decode_scores(values).tolist()
+
+	return scale, values
+
+def _quality_string (quality):
+	scale = str(quality.get("scale", "PHRED")).lower()
+	if (not scale in _converters):
+		raise ValueError("Unsupported quality scale '%s'" % quality.get("scale"))
+
+	values = quality["values"]
+
+	# scores stored as lists (i.e., by former versions of MetagenomeDB)
+	if (type(values) != dict):
+		try:
+			values = codec.encode_scores(values)
+		except ValueError:
+			convert = _converters[scale]
+			return ''.join([_quality_character(convert(score)) for score in values])
+
+	data = str(values["data"])
+	if (values.get("compressed")):
+		data = zlib.decompress(data)
+
+	return data.translate(_translations[(scale, str(values["typecode"]))])
+
+def _title (name, description):
+	# same header as written by Biopython
+	name = _str(name).replace('\n', ' ')
+	description = _str(description or '').replace('\n', ' ')
+
+	if (description == ''):
+		return name
+
+	if (description.split(None, 1)[0] == name):
+		return description
+
+	return "%s %s" % (name, description)
+
+def write_sequences (records, output, format = "fasta", line_length = LINE_LENGTH, buffer_size = BUFFER_SIZE, index = None):
+	""" Write sequences in FASTA or FASTQ format
+
+	Parameters:
+		- **records**: sequences to write, as an iterable of (name,
+		  description, sequence, quality) tuples (see :func:`read_sequences`)
+		- **output**: file-like object to write the sequences to
+		- **format**: either 'fasta' (default), 'fastq' or 'fastq-sanger'
+		- **line_length**: number of characters per line of FASTA sequences
+		  (default: 60); 0 to write sequences on a single line
+		- **buffer_size**: number of bytes written to **output** at once
+		- **index**: if set, list to add an entry to for each sequence
+		  written, as expected in a FASTA (or FASTQ) index file; offsets
+		  start from the current position of **output** (see
+		  :func:`write_index`)
+
+	Return:
+		The number of sequences written. A ValueError exception is thrown if
+		a sequence lacks quality scores in FASTQ format.
+	"""
+	format = format.lower()
+	if (not format in FORMATS):
+		raise ValueError("Unsupported format '%s'" % format)
+
+	is_fastq = (format != "fasta")
+
+	if (index != None):
+		offset = output.tell()
+
+	buffer, size, n = [], 0, 0
+	for (name, description, sequence, quality) in records:
+		title = _title(name, description)
+		sequence = decode_sequence(sequence)
+		length = len(sequence)
+
+		if (is_fastq):
+			if (quality == None):
+				raise ValueError("No quality scores for sequence '%s'" % title)
+
+			quality = _quality_string(quality)
+			if (len(quality) != length):
+				raise ValueError("Invalid quality scores for sequence '%s'" % title)
+
+			record = "@%s\n%s\n+\n%s\n" % (title, sequence, quality)
+
+		elif (length == 0):
+			record = ">%s\n" % title
+
+		elif (line_length > 0) and (length > line_length):
+			lines = [sequence[i:i + line_length] for i in xrange(0, length, line_length)]
+			record = ">%s\n%s\n" % (title, '\n'.join(lines))
+
+		else:
+			record = ">%s\n%s\n" % (title, sequence)
+
+		if (index != None):
+			# name, length, offset of the sequence, number of bases and
+			# bytes per line and, for FASTQ, offset of the quality scores
+			sequence_offset = offset + len(title) + 2
+
+			if (is_fastq) or (line_length == 0) or (length <= line_length):
+				line_bases = length
+			else:
+				line_bases = line_length
+
+			entry = [(title.split(None, 1) or [''])[0], length, sequence_offset, line_bases, line_bases + 1]
+			if (length == 0):
+				entry[4] = 0
+
+			if (is_fastq):
+				entry.append(sequence_offset + length + 3)
+
+			index.append(tuple(entry))
+			offset += len(record)
+
+		buffer.append(record)
+		size += len(record)
+		n += 1
+
+		if (size >= buffer_size):
+			output.write(''.join(buffer))
+			buffer, size = [], 0
+
+	if (len(buffer) > 0):
+		output.write(''.join(buffer))
+
+	return n
+
+def write_index (index, output):
+	""" Write a FASTA (or FASTQ) index, as created by 'samtools faidx'
+
+	Parameters:
+		- **index**: entries of the index, as created by
+		  :func:`write_sequences`
+		- **output**: file-like object to write the index to (e.g., a .fai file)
+	"""
+	output.write(''.join(['\t'.join([str(value) for value in entry]) + '\n' for entry in index]))
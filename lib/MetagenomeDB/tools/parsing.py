@@ -166,3 +166,21 @@ def parser (fn, format):
 
 	else:
 		raise errors.MetagenomeDBError("Unknown format '%s'" % format)
+
+# Group the items of an iterator into lists of at most 'size' items; e.g., to
+# resolve the names of the sequences found in an input file one chunk at a
+# time, rather than all at once (see Collection.resolve_sequences())
+def chunks (items, size = 1000):
+	if (size < 1):
+		raise ValueError("Invalid chunk size: %s" % size)
+
+	chunk = []
+	for item in items:
+		chunk.append(item)
+
+		if (len(chunk) == size):
+			yield chunk
+			chunk = []
+
+	if (len(chunk) > 0):
+		yield chunk
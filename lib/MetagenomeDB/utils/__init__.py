@@ -1,2 +1,5 @@
 
 from tree import *
+import views
+import matcher
+import codec
@@ -0,0 +1,204 @@
+# Compact encoding of nucleotide sequences and quality scores
+
+# Note: Nucleotides A, C, G and T are stored on 2 bits each; i.e., four
+# nucleotides per byte. Any other IUPAC nucleotide code (e.g., runs of N) is
+# stored as an A, and recorded in a side table of [position, length, code]
+# runs. The first byte of the packed string is the number of nucleotides
+# added to complete the last byte. Only upper-case sequences are packed;
+# the case of soft-masked (i.e., partly lower-case) sequences is recorded
+# separately, as a list of [position, length] runs of lower-case codes (see
+# encode_case() and decode_case()).
+# Quality scores are stored on one byte each, either unsigned (e.g., PHRED
+# scores) or signed (e.g., Solexa scores, which can be negative).
+
+import re
+import string
+import array
+import zlib
+
+_NUCLEOTIDES = "ACGT"
+
+_invalid_code = re.compile("[^ACGTRYKMSWBDHVN]")
+_runs = re.compile(r"([^ACGT])\1*")
+_lower_case_runs = re.compile("[a-z]+")
+
+# all codes but A, C, G and T are replaced by A in the packed string
+_mask = string.maketrans(''.join([chr(i) for i in xrange(256) if (not chr(i) in _NUCLEOTIDES)]),
+	'A' * (256 - len(_NUCLEOTIDES)))
+
+# four nucleotides to one byte, and back
+_pack, _unpack = {}, {}
+for i in xrange(256):
+	quadruplet = ''.join([_NUCLEOTIDES[(i >> shift) & 3] for shift in (6, 4, 2, 0)])
+	_pack[quadruplet] = chr(i)
+	_unpack[chr(i)] = quadruplet
+
+def encode (sequence):
+	""" Encode a nucleotide sequence with 2 bits per nucleotide
+
+	Parameters:
+		- **sequence**: sequence to encode, as a string of upper-case IUPAC
+		  nucleotide codes
+
+	Return:
+		A tuple with (1) the packed sequence, as a string of bytes and (2) a
+		list of [position, length, code] runs of nucleotides other than A, C,
+		G and T. A ValueError exception is thrown if the sequence contains
+		codes other than IUPAC nucleotide codes.
+
+	Example:
+		> print encode("ACGTNNNNAC")
+		('\\x02\\x1b\\x00\\x10', [[4, 4, 'N']])
+	"""
+	if (type(sequence) == unicode):
+		try:
+			sequence = str(sequence)
+		except UnicodeEncodeError:
+			raise ValueError("Not a nucleotide sequence")
+
+	if (_invalid_code.search(sequence) != None):
+		raise ValueError("Not a nucleotide sequence")
+
+	runs = [[m.start(), m.end() - m.start(), m.group(1)] for m in _runs.finditer(sequence)]
+	if (len(runs) > 0):
+		sequence = sequence.translate(_mask)
+
+	padding = -len(sequence) % 4
+	sequence += 'A' * padding
+
+	packed = [_pack[sequence[i:i + 4]] for i in xrange(0, len(sequence), 4)]
+
+	return chr(padding) + ''.join(packed), runs
+
+def decode (packed, runs = (), start = 0, end = None):
+	""" Decode a nucleotide sequence encoded by :func:`encode`
+
+	Parameters:
+		- **packed**: the packed sequence, as a string of bytes
+		- **runs**: list of [position, length, code] runs of nucleotides other
+		  than A, C, G and T (optional)
+		- **start**, **end**: positions (starting at 0) of the first and
+		  after the last nucleotide to decode (optional). By default, the
+		  whole sequence is decoded.
+	"""
+	length = (len(packed) - 1) * 4 - ord(packed[0])
+
+	if (end == None) or (end > length):
+		end = length
+
+	if (start >= end):
+		return ''
+
+	# only the bytes covering the region are decoded
+	first, last = start // 4, (end + 3) // 4
+
+	sequence = ''.join(map(_unpack.__getitem__, packed[1 + first:1 + last]))
+	sequence = sequence[start - first * 4:end - first * 4]
+
+	if (len(runs) == 0):
+		return sequence
+
+	pieces, position_ = [], 0
+	for (position, length, code) in runs:
+		position, length = max(position, start) - start, min(position + length, end) - max(position, start)
+		if (length <= 0):
+			continue
+
+		pieces.append(sequence[position_:position])
+		pieces.append(str(code) * length)
+		position_ = position + length
+
+	pieces.append(sequence[position_:])
+
+	return ''.join(pieces)
+
+def encode_case (sequence):
+	""" Separate the case of a sequence from its codes
+
+	Return:
+		A tuple with (1) the sequence in upper case and (2) a list of
+		[position, length] runs of lower-case codes
+
+	Example:
+		> print encode_case("ACgtnNAC")
+		('ACGTNNAC', [[2, 3]])
+	"""
+	lower = [[m.start(), m.end() - m.start()] for m in _lower_case_runs.finditer(sequence)]
+	if (len(lower) == 0):
+		return sequence, lower
+
+	return sequence.upper(), lower
+
+def decode_case (sequence, lower, start = 0):
+	""" Restore the case of a sequence, or of a region of this sequence
+
+	Parameters:
+		- **sequence**: sequence (or region) in upper case
+		- **lower**: list of [position, length] runs of lower-case codes, as
+		  returned by :func:`encode_case`
+		- **start**: position (starting at 0) of the region in the sequence
+		  (optional)
+	"""
+	if (len(lower) == 0):
+		return sequence
+
+	end = start + len(sequence)
+
+	pieces, position_ = [], 0
+	for (position, length) in lower:
+		position, length = max(position, start) - start, min(position + length, end) - max(position, start)
+		if (length <= 0):
+			continue
+
+		pieces.append(sequence[position_:position])
+		pieces.append(sequence[position:position + length].lower())
+		position_ = position + length
+
+	pieces.append(sequence[position_:])
+
+	return ''.join(pieces)
+
+# minimal number of scores for compression to be attempted
+_MIN_COMPRESSED_SCORES = 256
+
+def encode_scores (scores):
+	""" Encode a list of quality scores with one byte per score
+
+	Parameters:
+		- **scores**: list of integers, between -128 and 255
+
+	Return:
+		A dictionary with a 'data' key (the scores, as a string of bytes),
+		a 'typecode' key ('B' for unsigned bytes or 'b' for signed bytes;
+		see the array module) and a 'compressed' key (True if the data was
+		compressed with zlib). A ValueError exception is thrown if any score
+		cannot be stored in a byte.
+	"""
+	if (len(scores) == 0) or (min(scores) >= 0):
+		typecode = 'B'
+	else:
+		typecode = 'b'
+
+	try:
+		data = array.array(typecode, scores).tostring()
+	except (OverflowError, TypeError):
+		raise ValueError("Invalid quality scores: values must be integers between -128 and 255")
+
+	if (len(data) >= _MIN_COMPRESSED_SCORES):
+		data_ = zlib.compress(data)
+		if (len(data_) < len(data)):
+			return {"data": data_, "typecode": typecode, "compressed": True}
+
+	return {"data": data, "typecode": typecode, "compressed": False}
+
+def decode_scores (encoded_scores):
+	""" Decode quality scores encoded by :func:`encode_scores`
+
+	Return:
+		An array of integers (see the array module)
+	"""
+	data = encoded_scores["data"]
+	if (encoded_scores.get("compressed")):
+		data = zlib.decompress(data)
+
+	return array.array(str(encoded_scores["typecode"]), str(data))
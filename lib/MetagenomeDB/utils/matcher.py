@@ -0,0 +1,403 @@
+# Evaluation of MongoDB queries against nested dictionaries
+
+# Note: Only a subset of the MongoDB query language is supported; i.e., the
+# comparison operators ($in, $nin, $gt, $gte, $lt, $lte, $ne), $exists, $regex
+# (and $options), $elemMatch, $not and the logical operators $and, $or and
+# $nor. Queries are compiled once into functions that can then be applied to
+# any number of documents.
+
+import re
+
+_pattern_t = type(re.compile(''))
+
+def compile (query):
+	""" Compile a MongoDB query into a function receiving a document (as a
+	nested dictionary) and returning True if this document matches the query
+
+	Parameters:
+		- **query**: query to compile, as a dictionary
+
+	Example:
+		> m = compile({"score.e_value": {"$lt": 1e-5}, "type": "similar-to"})
+		> print m({"type": "similar-to", "score": {"e_value": 1e-10}})
+		True
+	"""
+	if (type(query) != dict):
+		raise ValueError("Malformed query: %s" % query)
+
+	predicates = []
+	for (key, condition) in query.iteritems():
+		if (key in ("$and", "$or", "$nor")):
+			predicates.append(_compile_logical_operator(key, condition))
+
+		elif (key.startswith('$')):
+			raise ValueError("Unsupported operator '%s'" % key)
+
+		else:
+			predicates.append(_compile_field(key, _compile_condition(condition)))
+
+	if (len(predicates) == 1):
+		return predicates[0]
+
+	def match (document):
+		for predicate in predicates:
+			if (not predicate(document)):
+				return False
+
+		return True
+
+	return match
+
+def match (query, document):
+	""" Test if a document (as a nested dictionary) matches a MongoDB query
+
+	.. note::
+		The query is compiled at each call; use :func:`compile` to test more
+		than one document against the same query.
+	"""
+	return compile(query)(document)
+
+def _compile_logical_operator (operator, queries):
+	if (not type(queries) in (list, tuple)) or (len(queries) == 0):
+		raise ValueError("Malformed query: operator '%s' requires a non-empty list of queries" % operator)
+
+	matchers = [compile(query) for query in queries]
+
+	if (operator == "$and"):
+		def predicate (document):
+			for match in matchers:
+				if (not match(document)):
+					return False
+			return True
+
+	elif (operator == "$or"):
+		def predicate (document):
+			for match in matchers:
+				if (match(document)):
+					return True
+			return False
+
+	else:
+		def predicate (document):
+			for match in matchers:
+				if (match(document)):
+					return False
+			return True
+
+	return predicate
+
+# Return a function receiving a document and applying a condition on the
+# values found in this document for a given (dot-notation) key
+def _compile_field (key, condition):
+	path = key.split('.')
+
+	if (len(path) == 1):
+		def predicate (document):
+			if (key in document):
+				return condition((document[key],))
+			return condition(())
+
+		return predicate
+
+	def predicate (document):
+		return condition(_values(document, path))
+
+	return predicate
+
+# Return all values found in a document for a given path; as with MongoDB,
+# values in lists of sub-documents are considered as well
+def _values (document, path):
+	values = [document]
+
+	for subkey in path:
+		values_ = []
+		for value in values:
+			value_t = type(value)
+
+			if (value_t == dict):
+				if (subkey in value):
+					values_.append(value[subkey])
+
+			elif (value_t == list):
+				if (subkey.isdigit()):
+					index = int(subkey)
+					if (index < len(value)):
+						values_.append(value[index])
+
+				for item in value:
+					if (type(item) == dict) and (subkey in item):
+						values_.append(item[subkey])
+
+		if (len(values_) == 0):
+			return values_
+
+		values = values_
+
+	return values
+
+# Return a function receiving the values found for a key and returning True
+# if any of these values (or any item of these values if lists) passes a test
+def _any (test, match_missing = False):
+	def condition (values):
+		if (len(values) == 0):
+			return match_missing
+
+		for value in values:
+			if (test(value)):
+				return True
+
+			if (type(value) == list):
+				for item in value:
+					if (test(item)):
+						return True
+
+		return False
+
+	return condition
+
+def _is_operator_condition (condition):
+	if (type(condition) != dict) or (len(condition) == 0):
+		return False
+
+	operators = [key.startswith('$') for key in condition]
+
+	if (all(operators)):
+		return True
+
+	if (any(operators)):
+		raise ValueError("Malformed condition: %s" % condition)
+
+	return False
+
+def _compile_condition (condition):
+	if (not _is_operator_condition(condition)):
+		return _equals(condition)
+
+	conditions = []
+	for (operator, value) in condition.iteritems():
+		if (operator == "$options"):
+			if (not "$regex" in condition):
+				raise ValueError("Malformed condition: $options without $regex")
+			continue
+
+		if (operator == "$regex"):
+			conditions.append(_regex(value, condition.get("$options", '')))
+
+		elif (operator in _operators):
+			conditions.append(_operators[operator](value))
+
+		else:
+			raise ValueError("Unsupported operator '%s'" % operator)
+
+	if (len(conditions) == 1):
+		return conditions[0]
+
+	def condition_ (values):
+		for condition in conditions:
+			if (not condition(values)):
+				return False
+		return True
+
+	return condition_
+
+def _equals (expected):
+	if (type(expected) == _pattern_t):
+		return _regex(expected)
+
+	def test (value):
+		return _equal(value, expected)
+
+	# a null value matches missing keys
+	return _any(test, expected == None)
+
+def _not_equals (expected):
+	condition = _equals(expected)
+
+	def condition_ (values):
+		return not condition(values)
+
+	return condition_
+
+def _in (expected):
+	if (not type(expected) in (list, tuple)):
+		raise ValueError("Malformed condition: $in/$nin require a list")
+
+	patterns = [_regex(value) for value in expected if (type(value) == _pattern_t)]
+	expected = [value for value in expected if (type(value) != _pattern_t)]
+
+	def test_ (value):
+		for value_ in expected:
+			if (_equal(value, value_)):
+				return True
+		return False
+
+	# values are looked up along with their type (see _type())
+	try:
+		expected_ = frozenset([(_type(value), value) for value in expected])
+		def test (value):
+			try:
+				return ((_type(value), value) in expected_)
+			except TypeError:
+				return test_(value)
+
+	except TypeError:
+		test = test_
+
+	condition = _any(test, None in expected)
+	if (len(patterns) == 0):
+		return condition
+
+	def condition_ (values):
+		if (condition(values)):
+			return True
+
+		for pattern in patterns:
+			if (pattern(values)):
+				return True
+
+		return False
+
+	return condition_
+
+def _not_in (expected):
+	condition = _in(expected)
+
+	def condition_ (values):
+		return not condition(values)
+
+	return condition_
+
+# MongoDB only compares values of the same type; numbers are a single type
+def _type (value):
+	value_t = type(value)
+
+	if (value_t in (int, long, float)):
+		return float
+
+	if (value_t == unicode):
+		return str
+
+	if (value_t == tuple):
+		return list
+
+	return value_t
+
+# Test if two values are equal; unlike in Python, booleans are
+# not equal to numbers, and neither are nested booleans
+def _equal (a, b):
+	a_t = _type(a)
+	if (a_t != _type(b)):
+		return False
+
+	if (a_t == dict):
+		if (len(a) != len(b)):
+			return False
+
+		for (key, value) in a.iteritems():
+			if (not key in b) or (not _equal(value, b[key])):
+				return False
+
+		return True
+
+	if (a_t == list):
+		if (len(a) != len(b)):
+			return False
+
+		for (value_a, value_b) in zip(a, b):
+			if (not _equal(value_a, value_b)):
+				return False
+
+		return True
+
+	return (a == b)
+
+def _comparison (compare):
+	def operator (expected):
+		expected_t = _type(expected)
+
+		def test (value):
+			return (_type(value) == expected_t) and compare(value, expected)
+
+		return _any(test)
+
+	return operator
+
+def _exists (expected):
+	expected = bool(expected)
+
+	def condition (values):
+		return ((len(values) > 0) == expected)
+
+	return condition
+
+_flags = {'i': re.IGNORECASE, 'm': re.MULTILINE, 'x': re.VERBOSE, 's': re.DOTALL}
+
+def _regex (pattern, options = ''):
+	if (type(pattern) != _pattern_t):
+		if (not type(pattern) in (str, unicode)):
+			raise ValueError("Malformed condition: $regex requires a string")
+
+		flags = 0
+		for option in options:
+			if (not option in _flags):
+				raise ValueError("Unsupported regular expression option '%s'" % option)
+			flags |= _flags[option]
+
+		pattern = re.compile(pattern, flags)
+
+	def test (value):
+		return (type(value) in (str, unicode)) and (pattern.search(value) != None)
+
+	return _any(test)
+
+def _elem_match (query):
+	if (type(query) != dict):
+		raise ValueError("Malformed condition: $elemMatch requires a query")
+
+	# the query applies either to sub-documents, or to values
+	if (_is_operator_condition(query)) and (not "$and" in query) and \
+	   (not "$or" in query) and (not "$nor" in query):
+		condition = _compile_condition(query)
+		def test (item):
+			return condition((item,))
+	else:
+		match = compile(query)
+		def test (item):
+			return (type(item) == dict) and match(item)
+
+	def condition_ (values):
+		for value in values:
+			if (type(value) != list):
+				continue
+
+			for item in value:
+				if (test(item)):
+					return True
+
+		return False
+
+	return condition_
+
+def _not (condition):
+	if (type(condition) != _pattern_t) and (not _is_operator_condition(condition)):
+		raise ValueError("Malformed condition: $not requires operators or a regular expression")
+
+	condition = _compile_condition(condition)
+
+	def condition_ (values):
+		return not condition(values)
+
+	return condition_
+
+_operators = {
+	"$ne": _not_equals,
+	"$in": _in,
+	"$nin": _not_in,
+	"$gt": _comparison(lambda a, b: a > b),
+	"$gte": _comparison(lambda a, b: a >= b),
+	"$lt": _comparison(lambda a, b: a < b),
+	"$lte": _comparison(lambda a, b: a <= b),
+	"$exists": _exists,
+	"$elemMatch": _elem_match,
+	"$not": _not,
+}
@@ -1,27 +1,51 @@
 # Manipulation of a JSON objects as nested dictionaries
 
+# Note: the same keys (property names, relationship filters) are expanded over
+# and over again; expanded keys are therefore memoized. The cache is bounded,
+# and simply emptied when full, as the set of keys used by an application is
+# typically small.
+_expanded_keys = {}
+_EXPANDED_KEYS_MAX = 4096
+
 def expand_key (key, separator = '.'):
 	""" Expand a dot-notation key into a list
 	"""
 	key_t = type(key)
 
 	if (key_t == list):
-		key = tuple(key)
-
-	elif (key_t == str) or (key_t == unicode):
-		key = tuple(key.split(separator))
+		key, key_t = tuple(key), tuple
 
-	elif (key_t != tuple):
+	elif (key_t != str) and (key_t != unicode) and (key_t != tuple):
 		raise ValueError("Malformed key: '%s'" % key)
 
-	if (len(key) == 0):
+	# str and unicode versions of a key have the same hash,
+	# but must be expanded into tuples of their own type
+	cache_key = (key_t, key, separator)
+
+	try:
+		return _expanded_keys[cache_key]
+	except KeyError:
+		pass
+
+	if (key_t == tuple):
+		expanded_key = key
+	else:
+		expanded_key = tuple(key.split(separator))
+
+	n = len(expanded_key)
+	if (n == 0):
 		raise ValueError("Empty key")
 
-	for i, subkey in enumerate(key):
-		if (subkey.startswith('$')) and (i+1 < len(key)):
-			raise ValueError("Malformed key '%s': special keys ('%s'?) must be last" % (separator.join(key), subkey))
+	for i in xrange(n - 1):
+		subkey = expanded_key[i]
+		if (subkey.startswith('$')):
+			raise ValueError("Malformed key '%s': special keys ('%s'?) must be last" % (separator.join(expanded_key), subkey))
+
+	if (len(_expanded_keys) >= _EXPANDED_KEYS_MAX):
+		_expanded_keys.clear()
 
-	return key
+	_expanded_keys[cache_key] = expanded_key
+	return expanded_key
 
 def set (dictionary, key, value):
 	""" Insert a nested key into a dictionary
@@ -37,15 +61,14 @@ def set (dictionary, key, value):
 		> print m
 		{'a': {'b': {'c': 1}}}
 	"""
-	is_leaf, root = (len(key) == 1), key[0]
+	node = dictionary
+	for subkey in key[:-1]:
+		if (not subkey in node):
+			node[subkey] = {}
 
-	if (is_leaf):
-		dictionary[root] = value
-	else:
-		if (not root in dictionary):
-			dictionary[root] = {}
+		node = node[subkey]
 
-		set(dictionary[root], key[1:], value)
+	node[key[-1]] = value
 
 def get (dictionary, key):
 	""" Query a nested key from a dictionary
@@ -54,12 +77,11 @@ def get (dictionary, key):
 		- **dictionary**: dictionary to query
 		- **key**: nested key, as a list
 	"""
-	is_leaf, root = (len(key) == 1), key[0]
+	node = dictionary
+	for subkey in key:
+		node = node[subkey]
 
-	if (is_leaf):
-		return dictionary[root]
-	else:
-		return get(dictionary[root], key[1:])
+	return node
 
 def delete (dictionary, key):
 	""" Delete a nested key from a dictionary
@@ -68,38 +90,64 @@ def delete (dictionary, key):
 		- **dictionary**: dictionary to modify
 		- **key**: nested key to delete, as a list
 	"""
-	is_leaf, root = (len(key) == 1), key[0]
+	# parent dictionaries along the key
+	parents, node = [], dictionary
+	for subkey in key[:-1]:
+		if (type(node) != dict):
+			raise KeyError(subkey)
 
-	if (type(dictionary) != dict):
-		raise KeyError(root)
+		parents.append(node)
+		node = node[subkey]
 
-	if (is_leaf):
-		del dictionary[root]
+	if (type(node) != dict):
+		raise KeyError(key[-1])
 
-	else:
-		delete(dictionary[root], key[1:])
-		if (len(dictionary[root]) == 0):
-			del dictionary[root]
+	del node[key[-1]]
+
+	# parent dictionaries left empty are removed as well
+	for i in xrange(len(parents) - 1, -1, -1):
+		if (len(node) > 0):
+			break
+
+		node = parents[i]
+		del node[key[i]]
 
 def contains (dictionary, key):
 	""" Test if a dictionary contains a nested key
-	
+
 	Parameters:
 		- **dictionary**: dictionary to evaluate
 		- **key**: nested key to test, as a list
 	"""
-	is_leaf, root = (len(key) == 1), key[0]
-
-	if (root in dictionary):
-		if (is_leaf):
-			return True
+	node = dictionary
+	for subkey in key[:-1]:
+		if (not subkey in node):
+			return False
 
-		if (type(dictionary[root]) != dict):
+		node = node[subkey]
+		if (type(node) != dict):
 			return False
 
-		return contains(dictionary[root], key[1:])
+	return (key[-1] in node)
+
+def _walk (dictionary):
+	# iterate through a nested dictionary without recursion; each
+	# element of the stack is a branch and an iterator on its keys
+	stack = [((), dictionary, iter(dictionary))]
+
+	while (len(stack) > 0):
+		branch, node, keys = stack[-1]
+
+		for key in keys:
+			subbranch, value = branch + expand_key(key), node[key]
+
+			if (type(value) == dict):
+				stack.append((subbranch, value, iter(value)))
+				break
 
-	return False
+			yield subbranch, value
+		else:
+			stack.pop()
 
 def items (dictionary):
 	""" Iterate through a nested dictionary and return all
@@ -113,20 +161,7 @@ def items (dictionary):
 		> print items(m)
 		[(('a', 'b', 'c'), 1), (('a', 'd'), 2)]
 	"""
-	def walk (node, b = []):
-		items = []
-
-		for key in node:
-			branch, value = b + list(expand_key(key)), node[key]
-
-			if (type(value) == dict):
-				items.extend(walk(value, branch))
-			else:
-				items.append((tuple(branch), value))
-
-		return items
-
-	return walk(dictionary)
+	return list(_walk(dictionary))
 
 def expand (dictionary, separator = '.'):
 	""" Transform a dictionary with dot-notation keys into a nested dictionary
@@ -141,7 +176,12 @@ def expand (dictionary, separator = '.'):
 	"""
 	d = {}
 	for key, value in dictionary.iteritems():
-		set(d, expand_key(key, separator), value)
+		key = expand_key(key, separator)
+
+		if (len(key) == 1):
+			d[key[0]] = value
+		else:
+			set(d, key, value)
 
 	return d
 
@@ -157,11 +197,22 @@ def flatten (dictionary, separator = '.'):
 		{"a.b.c": 1}
 	"""
 	d = {}
-	for (key, value) in items(dictionary):
+	for (key, value) in _walk(dictionary):
 		# hack: we don't want to flatten special MongoDB
 		# keys (everything starting with a '$')
-		if (key[-1].startswith('$')):
-			d[separator.join(key[:-1])] = {key[-1]: value}
+		if (key[-1].startswith('$')) and (len(key) > 1):
+			parent_key = separator.join(key[:-1])
+
+			# several operators can apply to the same key
+			operators = d.get(parent_key)
+			if (type(operators) == dict):
+				operators[key[-1]] = value
+			else:
+				d[parent_key] = {key[-1]: value}
+
+		elif (len(key) == 1):
+			d[key[0]] = value
+
 		else:
 			d[separator.join(key)] = value
 
@@ -181,20 +232,27 @@ def traverse (dictionary, selector = lambda x: False, key_modifier = lambda x: x
 	"""
 	tree = {}
 
-	for key in dictionary:
-		value = dictionary[key]
-		selected = selector(key)
+	# each element of the stack is a dictionary to
+	# traverse and the dictionary to copy it into
+	stack = [(dictionary, tree)]
 
-		if (selected):
-			key = key_modifier(key)
+	while (len(stack) > 0):
+		source, target = stack.pop()
 
-		if (type(value) == dict):
-			tree[key] = traverse(value, selector, key_modifier, value_modifier)
+		for key, value in source.iteritems():
+			selected = selector(key)
 
-		elif (selected):
-			tree[key] = value_modifier(value)
+			if (selected):
+				key = key_modifier(key)
 
-		else:
-			tree[key] = value
+			if (type(value) == dict):
+				subtree = target[key] = {}
+				stack.append((value, subtree))
+
+			elif (selected):
+				target[key] = value_modifier(value)
+
+			else:
+				target[key] = value
 
 	return tree
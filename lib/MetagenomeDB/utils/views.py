@@ -0,0 +1,107 @@
+# Read-only views of nested dictionaries and lists
+
+import collections
+import copy
+
+def view (value):
+	""" Return a read-only view of a value if this value is a dictionary
+	or a list, or the value itself otherwise
+
+	Parameters:
+		- **value**: value to protect against modifications
+
+	Example:
+		> m = view({'a': [1, 2]})
+		> print m['a'][0]
+		1
+		> m['a'] = 3
+		TypeError: 'DictView' object does not support item assignment
+	"""
+	value_t = type(value)
+
+	if (value_t == dict):
+		return DictView(value)
+
+	if (value_t == list):
+		return ListView(value)
+
+	return value
+
+class DictView (collections.Mapping):
+	""" Read-only view of a dictionary; values are themselves returned as views
+	"""
+	__slots__ = ("_dictionary",)
+
+	def __init__ (self, dictionary):
+		self._dictionary = dictionary
+
+	def __getitem__ (self, key):
+		return view(self._dictionary[key])
+
+	def __contains__ (self, key):
+		return (key in self._dictionary)
+
+	def __iter__ (self):
+		return iter(self._dictionary)
+
+	def __len__ (self):
+		return len(self._dictionary)
+
+	def __eq__ (self, other):
+		if (isinstance(other, DictView)):
+			other = other._dictionary
+
+		return (self._dictionary == other)
+
+	def __ne__ (self, other):
+		return not (self == other)
+
+	__hash__ = None
+
+	def __repr__ (self):
+		return repr(self._dictionary)
+
+	def copy (self):
+		""" Return a modifiable (deep) copy of the dictionary
+		"""
+		return copy.deepcopy(self._dictionary)
+
+class ListView (collections.Sequence):
+	""" Read-only view of a list; items are themselves returned as views
+	"""
+	__slots__ = ("_list",)
+
+	def __init__ (self, list_):
+		self._list = list_
+
+	def __getitem__ (self, index):
+		if (type(index) == slice):
+			return ListView(self._list[index])
+
+		return view(self._list[index])
+
+	def __iter__ (self):
+		for item in self._list:
+			yield view(item)
+
+	def __len__ (self):
+		return len(self._list)
+
+	def __eq__ (self, other):
+		if (isinstance(other, ListView)):
+			other = other._list
+
+		return (self._list == other)
+
+	def __ne__ (self, other):
+		return not (self == other)
+
+	__hash__ = None
+
+	def __repr__ (self):
+		return repr(self._list)
+
+	def copy (self):
+		""" Return a modifiable (deep) copy of the list
+		"""
+		return copy.deepcopy(self._list)
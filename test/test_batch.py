@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# Tests of the deferred commit of objects (see MetagenomeDB.batch()). A MongoDB
+# server is needed; a 'MetagenomeDB_test' database is created, then dropped.
+# Usage: python test/test_batch.py
+
+import unittest
+
+import MetagenomeDB as mdb
+
+DATABASE = "MetagenomeDB_test"
+
+class BatchTest (unittest.TestCase):
+
+	def setUp (self):
+		try:
+			mdb.orm.connect(db = DATABASE)
+		except mdb.errors.DBConnectionError as msg:
+			raise unittest.SkipTest("no MongoDB server available (%s)" % msg)
+
+		self.collection = mdb.Collection({"name": "test"})
+		self.collection.commit()
+
+	def tearDown (self):
+		for name in ("Sequence", "Collection"):
+			mdb.orm.drop_collection(name)
+
+	def test_duplicate_name_in_batch (self):
+		with mdb.batch():
+			sequence = mdb.Sequence({"name": "read", "sequence": "ACGT"})
+			sequence.add_to_collection(self.collection)
+			sequence.commit()
+
+			# the first sequence is queued, not committed yet
+			duplicate = mdb.Sequence({"name": "read", "sequence": "ACGT"})
+			self.assertRaises(mdb.errors.DuplicateObjectError, duplicate.add_to_collection, self.collection)
+
+		self.assertEqual(self.collection.count_sequences(), 1)
+
+	def test_duplicate_name_after_flush (self):
+		with mdb.batch() as queue:
+			sequence = mdb.Sequence({"name": "read", "sequence": "ACGT"})
+			sequence.add_to_collection(self.collection)
+			sequence.commit()
+			queue.flush()
+
+			duplicate = mdb.Sequence({"name": "read", "sequence": "ACGT"})
+			self.assertRaises(mdb.errors.DuplicateObjectError, duplicate.add_to_collection, self.collection)
+
+		self.assertEqual(self.collection.count_sequences(), 1)
+
+	def test_same_name_in_other_collection (self):
+		other = mdb.Collection({"name": "other"})
+		other.commit()
+
+		with mdb.batch():
+			for collection in (self.collection, other):
+				sequence = mdb.Sequence({"name": "read", "sequence": "ACGT"})
+				sequence.add_to_collection(collection)
+				sequence.commit()
+
+		self.assertEqual(self.collection.count_sequences(), 1)
+		self.assertEqual(other.count_sequences(), 1)
+
+	def test_all_failures_reported (self):
+		collections = [mdb.Collection({"name": name}) for name in ("test", "new", "test")]
+
+		try:
+			mdb.commit_all(collections)
+			self.fail("duplicate collections were committed")
+
+		except mdb.errors.DuplicateObjectError as msg:
+			self.assertEqual([id(object) for (object, error) in msg.failures],
+				[id(collections[0]), id(collections[2])])
+
+		self.assertEqual([collection.is_committed() for collection in collections],
+			[False, True, False])
+
+if (__name__ == "__main__"):
+	unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# Tests of the writing of BGZF-compressed files and of their .gzi index (see
+# MetagenomeDB.tools.bgzf). No MongoDB server is needed.
+# Usage: python test/test_bgzf.py
+
+import unittest
+import StringIO
+import gzip
+import random
+import struct
+import zlib
+
+from MetagenomeDB.tools import bgzf
+
+class Output (StringIO.StringIO):
+	# file-like object whose content remains available once closed
+	def close (self):
+		self.content = self.getvalue()
+		StringIO.StringIO.close(self)
+
+def random_data (length, seed = 0):
+	rng = random.Random(seed)
+	return ''.join([rng.choice("ACGT\n") for i in xrange(length)])
+
+def compress (chunks, threads = 1, level = 6):
+	output, index = Output(), StringIO.StringIO()
+
+	writer = bgzf.BgzfWriter(output, threads = threads, level = level)
+	for chunk in chunks:
+		writer.write(chunk)
+
+	writer.close()
+	writer.write_index(index)
+
+	return output.content, index.getvalue()
+
+def read_index (index):
+	n, = struct.unpack("<Q", index[:8])
+	return [struct.unpack("<QQ", index[8 + i * 16:24 + i * 16]) for i in xrange(n)]
+
+# offsets and content of the blocks of a BGZF file
+def read_blocks (data):
+	blocks, offset = [], 0
+	while (offset < len(data)):
+		header = struct.unpack("<BBBBIBBHBBHH", data[offset:offset + 18])
+		if (header[:4] != (31, 139, 8, 4)) or (header[7:10] != (6, 66, 67)):
+			raise ValueError("Not a BGZF block at offset %s" % offset)
+
+		size = header[-1] + 1
+		crc, length = struct.unpack("<II", data[offset + size - 8:offset + size])
+		content = zlib.decompress(data[offset + 18:offset + size - 8], -15)
+
+		if (len(content) != length) or (zlib.crc32(content) & 0xffffffff != crc):
+			raise ValueError("Invalid BGZF block at offset %s" % offset)
+
+		blocks.append((offset, content))
+		offset += size
+
+	return blocks
+
+class BgzfTest (unittest.TestCase):
+
+	@classmethod
+	def setUpClass (cls):
+		cls.data = random_data(300000)
+
+	def test_gzip (self):
+		# BGZF files can be read by any gzip decompressor
+		data, index = compress([self.data])
+		self.assertEqual(gzip.GzipFile(fileobj = StringIO.StringIO(data)).read(), self.data)
+
+	def test_blocks (self):
+		data, index = compress([self.data[i:i + 1000] for i in xrange(0, len(self.data), 1000)])
+		blocks = read_blocks(data)
+
+		# full blocks, followed by a partial one and the end-of-file marker
+		self.assertEqual([len(content) for (offset, content) in blocks],
+			[bgzf.BLOCK_SIZE] * 4 + [len(self.data) - 4 * bgzf.BLOCK_SIZE, 0])
+		self.assertEqual(''.join([content for (offset, content) in blocks]), self.data)
+		self.assertTrue(data.endswith(bgzf._EOF))
+
+	def test_index (self):
+		# the .gzi index lists the offsets of all blocks but the first one
+		data, index = compress([self.data], threads = 3)
+		blocks = read_blocks(data)[:-1]
+
+		entries, uncompressed_offset = [], 0
+		for (offset, content) in blocks:
+			entries.append((offset, uncompressed_offset))
+			uncompressed_offset += len(content)
+
+		self.assertEqual(read_index(index), entries[1:])
+
+		for (compressed_offset, uncompressed_offset) in read_index(index):
+			self.assertEqual(read_blocks(data[compressed_offset:])[0][1],
+				self.data[uncompressed_offset:uncompressed_offset + bgzf.BLOCK_SIZE])
+
+	def test_uncompressible (self):
+		# data that cannot be compressed is stored as-is
+		data = ''.join([chr(random.Random(0).randint(0, 255)) for i in xrange(bgzf.BLOCK_SIZE)])
+		block = bgzf.compress_block(data, 9)
+
+		self.assertTrue(len(block) <= bgzf._MAX_BLOCK_SIZE)
+		self.assertEqual(read_blocks(block)[0][1], data)
+
+	def test_tell (self):
+		writer = bgzf.BgzfWriter(Output())
+		writer.write("ACGT")
+		writer.write(self.data)
+
+		self.assertEqual(writer.tell(), len(self.data) + 4)
+
+		writer.close()
+		self.assertRaises(ValueError, writer.write, "ACGT")
+
+	def test_empty (self):
+		data, index = compress([])
+
+		self.assertEqual(data, bgzf._EOF)
+		self.assertEqual(read_index(index), [])
+		self.assertEqual(gzip.GzipFile(fileobj = StringIO.StringIO(data)).read(), '')
+
+if (__name__ == "__main__"):
+	unittest.main()
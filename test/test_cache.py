@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Tests of the identity map of the objects retrieved from the database (see
+# MetagenomeDB.orm.cache). No MongoDB server is needed.
+# Usage: python test/test_cache.py
+
+import unittest
+import gc
+
+from MetagenomeDB.orm import cache
+
+class Collection (object):
+	_committed = True
+
+class Sequence (object):
+	_committed = True
+
+class IdentityMapTest (unittest.TestCase):
+
+	def setUp (self):
+		self.map = cache.IdentityMap()
+
+	def test_default_sizes (self):
+		# collections are retained by default, but not sequences
+		self.assertEqual(self.map.get_size("Collection"), cache.DEFAULT_SIZES["Collection"])
+		self.assertEqual(self.map.get_size("Sequence"), 0)
+
+		self.map[1], self.map[2] = Collection(), Sequence()
+		gc.collect()
+
+		self.assertTrue(1 in self.map)
+		self.assertFalse(2 in self.map)
+
+	def test_bounded (self):
+		self.map.set_size("Sequence", 2)
+		for id in xrange(5):
+			self.map[id] = Sequence()
+
+		gc.collect()
+
+		# only the most recently used objects are retained
+		self.assertEqual(sorted([id for id in xrange(5) if (id in self.map)]), [3, 4])
+		self.assertEqual(self.map.statistics()["Sequence"]["evictions"], 3)
+
+		self.assertTrue(self.map.lookup(3, "Sequence") is not None)
+		self.map[5] = Sequence()
+		gc.collect()
+
+		self.assertEqual(sorted([id for id in xrange(6) if (id in self.map)]), [3, 5])
+
+	def test_referenced (self):
+		# objects still referenced are always found
+		self.map.set_size("Sequence", 0)
+		sequence = Sequence()
+		self.map[1] = sequence
+		gc.collect()
+
+		self.assertTrue(self.map.lookup(1, "Sequence") is sequence)
+		self.assertEqual(self.map.lookup(1, "Collection"), None)
+
+	def test_modified (self):
+		# modified objects are released until committed again
+		collection = Collection()
+		self.map[1] = collection
+
+		collection._committed = False
+		self.map.update(1, collection)
+		del collection
+		gc.collect()
+
+		self.assertFalse(1 in self.map)
+
+	def test_release (self):
+		self.map[1] = Collection()
+		self.map.release()
+		gc.collect()
+
+		self.assertFalse(1 in self.map)
+		self.assertRaises(ValueError, self.map.set_size, "Collection", -1)
+
+if (__name__ == "__main__"):
+	unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# Tests of the compact encoding of nucleotide sequences and quality scores
+# (see MetagenomeDB.utils.codec). No MongoDB server is needed.
+# Usage: python test/test_codec.py
+
+import unittest
+import random
+
+from MetagenomeDB.utils import codec
+from MetagenomeDB import Sequence
+
+def random_sequence (length, seed = 0, alphabet = "ACGT"):
+	rng = random.Random(seed)
+	return ''.join([rng.choice(alphabet) for i in xrange(length)])
+
+class NucleotideTest (unittest.TestCase):
+
+	def test_round_trip (self):
+		for length in xrange(0, 12):
+			sequence = random_sequence(length, seed = length)
+			packed, runs = codec.encode(sequence)
+
+			self.assertEqual(runs, [])
+			self.assertEqual(len(packed), 1 + (length + 3) // 4)
+			self.assertEqual(codec.decode(packed), sequence)
+
+	def test_example (self):
+		self.assertEqual(codec.encode("ACGTNNNNAC"), ('\x02\x1b\x00\x10', [[4, 4, 'N']]))
+
+	def test_runs (self):
+		sequence = "NNACGTRYACGTTNNNNKN"
+		packed, runs = codec.encode(sequence)
+
+		self.assertEqual(runs, [[0, 2, 'N'], [6, 1, 'R'], [7, 1, 'Y'], [13, 4, 'N'], [17, 1, 'K'], [18, 1, 'N']])
+		self.assertEqual(codec.decode(packed, runs), sequence)
+
+	def test_region (self):
+		sequence = random_sequence(37, alphabet = "ACGTACGTN")
+		packed, runs = codec.encode(sequence)
+
+		for start in xrange(len(sequence) + 1):
+			for end in xrange(start, len(sequence) + 2):
+				self.assertEqual(codec.decode(packed, runs, start, end), sequence[start:end])
+
+	def test_unicode (self):
+		packed, runs = codec.encode(u"ACGT")
+		self.assertEqual(codec.decode(packed), "ACGT")
+
+	def test_invalid (self):
+		for sequence in ("ACGU", "acgt", "AC GT", u"AC\u00c9"):
+			self.assertRaises(ValueError, codec.encode, sequence)
+
+class ScoresTest (unittest.TestCase):
+
+	def test_unsigned (self):
+		scores = [0, 10, 40, 255]
+		encoded = codec.encode_scores(scores)
+
+		self.assertEqual(encoded["typecode"], 'B')
+		self.assertFalse(encoded["compressed"])
+		self.assertEqual(list(codec.decode_scores(encoded)), scores)
+
+	def test_signed (self):
+		scores = [-5, 0, 40, 127]
+		encoded = codec.encode_scores(scores)
+
+		self.assertEqual(encoded["typecode"], 'b')
+		self.assertEqual(list(codec.decode_scores(encoded)), scores)
+
+	def test_compressed (self):
+		scores = [30] * 1000 + [20] * 1000
+		encoded = codec.encode_scores(scores)
+
+		self.assertTrue(encoded["compressed"])
+		self.assertTrue(len(encoded["data"]) < len(scores))
+		self.assertEqual(list(codec.decode_scores(encoded)), scores)
+
+	def test_empty (self):
+		self.assertEqual(list(codec.decode_scores(codec.encode_scores([]))), [])
+
+	def test_invalid (self):
+		for scores in ([256], [-129], [-1, 255], [1.5]):
+			self.assertRaises(ValueError, codec.encode_scores, scores)
+
+class CaseTest (unittest.TestCase):
+
+	def test_round_trip (self):
+		sequence = "ACgtnNACaa"
+		upper, lower = codec.encode_case(sequence)
+
+		self.assertEqual(upper, "ACGTNNACAA")
+		self.assertEqual(lower, [[2, 3], [8, 2]])
+		self.assertEqual(codec.decode_case(upper, lower), sequence)
+
+	def test_region (self):
+		sequence = "ACgtnNACaa"
+		upper, lower = codec.encode_case(sequence)
+
+		for start in xrange(len(sequence)):
+			for end in xrange(start, len(sequence) + 1):
+				self.assertEqual(codec.decode_case(upper[start:end], lower, start), sequence[start:end])
+
+	def test_upper_case (self):
+		self.assertEqual(codec.encode_case("ACGT"), ("ACGT", []))
+
+class SoftMaskedSequenceTest (unittest.TestCase):
+
+	def setUp (self):
+		sequence = random_sequence(5000)
+		self.sequence = sequence[:100] + sequence[100:900].lower() + sequence[900:3000] + sequence[3000:3500].lower() + sequence[3500:]
+
+	def test_packed (self):
+		# soft-masked sequences are packed, with their case stored aside
+		value, length = Sequence._process_sequence(self.sequence)
+
+		self.assertTrue("packed" in value)
+		self.assertEqual(value["lower"], [[100, 800], [3000, 500]])
+		self.assertEqual(Sequence._decode_sequence(value), self.sequence)
+
+	def test_subsequence (self):
+		sequence = Sequence({"name": "contig", "sequence": self.sequence})
+
+		for (start, end) in ((1, 5000), (95, 910), (899, 901), (2990, 3010), (850, 850)):
+			self.assertEqual(sequence.get_subsequence(start, end), self.sequence[start - 1:end])
+
+	def test_many_runs (self):
+		# sequences with too many lower-case runs are not packed
+		sequence = ''.join([("ACGT", "acgt")[i % 2] for i in xrange(100)])
+		value, length = Sequence._process_sequence(sequence)
+
+		self.assertEqual(value, sequence)
+
+if (__name__ == "__main__"):
+	unittest.main()
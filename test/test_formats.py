@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# Tests of the export of sequences in FASTA and FASTQ formats, and of their
+# index (see MetagenomeDB.tools.formats). No MongoDB server is needed.
+# Usage: python test/test_formats.py
+
+import unittest
+import StringIO
+import random
+
+from MetagenomeDB.tools import formats
+from MetagenomeDB.utils import codec
+
+def random_sequence (length, seed = 0):
+	rng = random.Random(seed)
+	return ''.join([rng.choice("ACGTN") for i in xrange(length)])
+
+RECORDS = [
+	("read1", "read1 first read", random_sequence(150, 1), {"scale": "PHRED", "values": [30] * 150}),
+	("read2", None, random_sequence(60, 2), {"scale": "PHRED", "values": codec.encode_scores(range(60))}),
+	("read3", "", random_sequence(61, 3), {"scale": "PHRED", "values": [40] * 61}),
+	("read4", "fourth read", '', {"scale": "PHRED", "values": []}),
+	("read5", None, random_sequence(7, 5), {"scale": "Solexa", "values": [-5, 0, 10, 20, 30, 40, 62]}),
+]
+
+def write (records, **kwargs):
+	output, index = StringIO.StringIO(), []
+	n = formats.write_sequences(records, output, index = index, **kwargs)
+
+	return n, output.getvalue(), index
+
+# read a region of a sequence given its entry in a FASTA (or FASTQ) index,
+# the same way as 'samtools faidx' does
+def fetch (data, entry, start, end):
+	name, length, offset, line_bases, line_bytes = entry[:5]
+
+	sequence = []
+	for i in xrange(start, min(end, length)):
+		sequence.append(data[offset + (i // line_bases) * line_bytes + i % line_bases])
+
+	return ''.join(sequence)
+
+class FastaTest (unittest.TestCase):
+
+	def test_records (self):
+		n, data, index = write(RECORDS, line_length = 60)
+
+		self.assertEqual(n, len(RECORDS))
+		self.assertTrue(data.startswith(">read1 first read\n%s\n%s\n%s\n>read2\n" % (
+			RECORDS[0][2][:60], RECORDS[0][2][60:120], RECORDS[0][2][120:])))
+		self.assertTrue(">read4 fourth read\n>read5\n" in data)
+
+	def test_single_line (self):
+		n, data, index = write(RECORDS[:1], line_length = 0)
+		self.assertEqual(data, ">read1 first read\n%s\n" % RECORDS[0][2])
+
+	def test_index (self):
+		for line_length in (0, 10, 60, 61):
+			n, data, index = write(RECORDS, line_length = line_length)
+
+			self.assertEqual([entry[0] for entry in index], ["read%s" % i for i in xrange(1, 6)])
+
+			for (entry, record) in zip(index, RECORDS):
+				sequence = record[2]
+
+				self.assertEqual(entry[1], len(sequence))
+				self.assertEqual(fetch(data, entry, 0, len(sequence)), sequence)
+				self.assertEqual(fetch(data, entry, 5, 65), sequence[5:65])
+
+	def test_index_offset (self):
+		# offsets start from the current position of the output
+		output, index = StringIO.StringIO(), []
+		output.write(">read0\nACGT\n")
+		formats.write_sequences(RECORDS[1:2], output, index = index)
+
+		self.assertEqual(fetch(output.getvalue(), index[0], 0, 60), RECORDS[1][2])
+
+	def test_write_index (self):
+		n, data, index = write(RECORDS, line_length = 60)
+		output = StringIO.StringIO()
+		formats.write_index(index, output)
+
+		lines = output.getvalue().splitlines()
+		self.assertEqual(lines[0], "read1\t150\t18\t60\t61")
+		self.assertEqual(lines[3], "read4\t0\t%s\t0\t0" % (data.index(">read4") + 19))
+		self.assertEqual(len(lines), len(RECORDS))
+
+class FastqTest (unittest.TestCase):
+
+	def test_records (self):
+		n, data, index = write(RECORDS, format = "fastq")
+		lines = data.splitlines()
+
+		self.assertEqual(lines[:4], ["@read1 first read", RECORDS[0][2], "+", '?' * 150])
+		self.assertEqual(lines[5], RECORDS[1][2])
+		self.assertEqual(lines[7], ''.join([chr(i + 33) for i in xrange(60)]))
+		# Solexa scores are converted into PHRED scores
+		self.assertEqual(lines[-1], "\"$+5?I_")
+
+	def test_index (self):
+		n, data, index = write(RECORDS, format = "fastq")
+
+		for (entry, record) in zip(index, RECORDS):
+			self.assertEqual(len(entry), 6)
+			self.assertEqual(fetch(data, entry, 0, entry[1]), record[2])
+
+			# offset of the quality scores
+			self.assertEqual(data[entry[5] - 2:entry[5]], "+\n")
+			self.assertEqual(data[entry[5] + entry[1]], '\n')
+
+	def test_missing_quality (self):
+		self.assertRaises(ValueError, write, [("read1", None, "ACGT", None)], format = "fastq")
+		self.assertRaises(ValueError, write, [("read1", None, "ACGT", {"values": [30]})], format = "fastq")
+
+	def test_unsupported_format (self):
+		self.assertRaises(ValueError, write, RECORDS, format = "genbank")
+
+if (__name__ == "__main__"):
+	unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+# Tests of the evaluation of MongoDB queries against documents (see
+# MetagenomeDB.utils.matcher). No MongoDB server is needed.
+# Usage: python test/test_matcher.py
+
+import unittest
+import re
+
+from MetagenomeDB.utils import matcher
+
+DOCUMENT = {
+	"type": "similar-to",
+	"score": {"e_value": 1e-10, "percent_identity": 98.5},
+	"hits": [{"name": "a", "length": 10}, {"name": "b", "length": 20}],
+	"tags": ["x", "y"],
+	"matrix": [[1, 2], [3, 4]],
+	"valid": True,
+	"count": 1,
+}
+
+class MatcherTest (unittest.TestCase):
+
+	def assertMatches (self, query, document = DOCUMENT):
+		self.assertTrue(matcher.match(query, document), query)
+
+	def assertNotMatches (self, query, document = DOCUMENT):
+		self.assertFalse(matcher.match(query, document), query)
+
+class EqualityTest (MatcherTest):
+
+	def test_values (self):
+		self.assertMatches({"type": "similar-to"})
+		self.assertMatches({"type": u"similar-to"})
+		self.assertMatches({"score.e_value": 1e-10})
+		self.assertNotMatches({"type": "part-of"})
+
+	def test_numbers (self):
+		# integers and floats are comparable
+		self.assertMatches({"count": 1.0})
+		self.assertMatches({"count": 1L})
+		self.assertMatches({"score.percent_identity": {"$gt": 98}})
+
+	def test_booleans (self):
+		# unlike in Python, booleans are not equal to numbers
+		self.assertMatches({"valid": True})
+		self.assertNotMatches({"valid": 1})
+		self.assertNotMatches({"count": True})
+		self.assertNotMatches({"valid": {"$in": [1, 2]}})
+		self.assertNotMatches({"count": {"$in": [True]}})
+		self.assertNotMatches({"valid": {"$gt": 0}})
+		self.assertNotMatches({"x": [True]}, {"x": [1]})
+		self.assertNotMatches({"x": {"y": 0}}, {"x": {"y": False}})
+
+	def test_lists (self):
+		# a value matches either the list or any of its items
+		self.assertMatches({"tags": "x"})
+		self.assertMatches({"tags": ["x", "y"]})
+		self.assertMatches({"tags": ("x", "y")})
+		self.assertNotMatches({"tags": ["y", "x"]})
+		self.assertMatches({"matrix": [1, 2]})
+		self.assertMatches({"hits.name": "b"})
+		self.assertMatches({"hits.1.name": "b"})
+		self.assertNotMatches({"hits.0.name": "b"})
+
+	def test_documents (self):
+		self.assertMatches({"hits": {"name": "a", "length": 10}})
+		self.assertNotMatches({"hits": {"name": "a"}})
+
+	def test_missing (self):
+		# a null value matches missing keys
+		self.assertMatches({"missing": None})
+		self.assertMatches({"score.missing": None})
+		self.assertNotMatches({"type": None})
+		self.assertMatches({"missing": {"$exists": False}})
+		self.assertMatches({"hits.name": {"$exists": True}})
+		self.assertNotMatches({"hits.missing": {"$exists": True}})
+
+	def test_regex (self):
+		self.assertMatches({"type": re.compile("^similar")})
+		self.assertMatches({"type": {"$regex": "^SIMILAR", "$options": "i"}})
+		self.assertMatches({"tags": {"$regex": "y"}})
+		self.assertNotMatches({"count": {"$regex": "1"}})
+
+class OperatorsTest (MatcherTest):
+
+	def test_comparison (self):
+		self.assertMatches({"score.e_value": {"$lt": 1e-5}})
+		self.assertMatches({"hits.length": {"$gte": 20}})
+		self.assertNotMatches({"hits.length": {"$gt": 20}})
+		self.assertMatches({"hits.length": {"$gt": 5, "$lt": 15}})
+		# values of different types are not compared
+		self.assertNotMatches({"type": {"$gt": 0}})
+		self.assertNotMatches({"count": {"$lt": "a"}})
+
+	def test_in (self):
+		self.assertMatches({"type": {"$in": ["part-of", "similar-to"]}})
+		self.assertMatches({"tags": {"$in": ["z", "y"]}})
+		self.assertMatches({"count": {"$in": [1.0]}})
+		self.assertMatches({"missing": {"$in": [None]}})
+		self.assertMatches({"type": {"$in": [re.compile("^sim")]}})
+		self.assertMatches({"hits": {"$in": [{"name": "b", "length": 20}]}})
+		self.assertNotMatches({"tags": {"$in": []}})
+		self.assertMatches({"tags": {"$nin": ["z"]}})
+		self.assertNotMatches({"tags": {"$nin": ["x"]}})
+
+	def test_ne (self):
+		self.assertMatches({"type": {"$ne": "part-of"}})
+		self.assertMatches({"missing": {"$ne": 1}})
+		self.assertNotMatches({"tags": {"$ne": "x"}})
+		self.assertMatches({"valid": {"$ne": 1}})
+
+	def test_elem_match (self):
+		# on sub-documents, all conditions apply to the same item
+		self.assertMatches({"hits": {"$elemMatch": {"name": "a", "length": 10}}})
+		self.assertNotMatches({"hits": {"$elemMatch": {"name": "a", "length": 20}}})
+		self.assertMatches({"hits": {"$elemMatch": {"$or": [{"name": "c"}, {"length": 20}]}}})
+		# without $elemMatch, conditions may apply to different items
+		self.assertMatches({"hits.length": {"$gt": 10, "$lt": 20}})
+		self.assertNotMatches({"hits": {"$elemMatch": {"length": {"$gt": 10, "$lt": 20}}}})
+		# on values
+		self.assertMatches({"tags": {"$elemMatch": {"$in": ["y"]}}})
+		self.assertNotMatches({"type": {"$elemMatch": {"$in": ["similar-to"]}}})
+		self.assertMatches({"matrix": {"$elemMatch": {"$elemMatch": {"$gt": 3}}}})
+
+	def test_not (self):
+		self.assertMatches({"count": {"$not": {"$gt": 1}}})
+		self.assertNotMatches({"count": {"$not": {"$gte": 1}}})
+		# documents lacking the key match
+		self.assertMatches({"missing": {"$not": {"$gt": 1}}})
+		self.assertMatches({"type": {"$not": re.compile("^part")}})
+		self.assertNotMatches({"tags": {"$not": {"$in": ["x"]}}})
+
+	def test_logical (self):
+		self.assertMatches({"$and": [{"type": "similar-to"}, {"count": 1}]})
+		self.assertMatches({"$or": [{"type": "part-of"}, {"count": 1}]})
+		self.assertNotMatches({"$or": [{"type": "part-of"}, {"count": 2}]})
+		self.assertMatches({"$nor": [{"type": "part-of"}, {"count": 2}]})
+		self.assertNotMatches({"$nor": [{"type": "similar-to"}]})
+
+class CompileTest (unittest.TestCase):
+
+	def test_compiled (self):
+		match = matcher.compile({"score.e_value": {"$lt": 1e-5}, "type": "similar-to"})
+
+		self.assertTrue(match({"type": "similar-to", "score": {"e_value": 1e-10}}))
+		self.assertFalse(match({"type": "similar-to", "score": {"e_value": 1}}))
+		self.assertFalse(match({"score": {"e_value": 1e-10}}))
+
+	def test_malformed (self):
+		for query in (
+			[],
+			{"$where": "true"},
+			{"a": {"$near": [0, 0]}},
+			{"a": {"$gt": 1, "b": 2}},
+			{"a": {"$options": "i"}},
+			{"a": {"$regex": "a", "$options": "z"}},
+			{"a": {"$in": 1}},
+			{"a": {"$not": 1}},
+			{"$or": []},
+			{"a": {"$elemMatch": 1}}):
+			self.assertRaises(ValueError, matcher.compile, query)
+
+if (__name__ == "__main__"):
+	unittest.main()
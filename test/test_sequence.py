@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Tests of the storage of sequences (see MetagenomeDB.Sequence). No MongoDB
+# server is needed; documents are forged into objects directly, and the
+# retrieval of properties is simulated.
+# Usage: python test/test_sequence.py
+
+import unittest
+import random
+
+import bson
+
+from MetagenomeDB import Sequence
+from MetagenomeDB.orm import methods
+
+def random_sequence (length, seed = 0):
+	rng = random.Random(seed)
+	return ''.join([rng.choice("ACGT") for i in xrange(length)])
+
+class PackedContigTest (unittest.TestCase):
+
+	@classmethod
+	def setUpClass (cls):
+		cls.contig = random_sequence(2000000)
+		value, length = Sequence._process_sequence(cls.contig)
+
+		cls.document = {
+			"_id": bson.objectid.ObjectId(),
+			"name": "contig",
+			"sequence": value,
+			"length": length,
+			"_relationship_with": [],
+		}
+
+	def setUp (self):
+
+		# size of the documents retrieved from the database
+		self.fetched = []
+
+		def load_properties (object, fields):
+			self.assertEqual(object._properties["_id"], self.document["_id"])
+
+			sequence = {}
+			for (key, value) in self.document["sequence"].iteritems():
+				key_ = "sequence." + key
+				if (not key_ in fields):
+					continue
+
+				if (type(fields[key_]) == dict):
+					first, n = fields[key_]["$slice"]
+					value = value[first:first + n]
+
+				sequence[key] = value
+
+			properties = {"_id": self.document["_id"], "sequence": sequence}
+			self.fetched.append(len(bson.BSON.encode(properties)))
+
+			return properties
+
+		self.load_properties = methods.load_properties
+		methods.load_properties = load_properties
+
+	def tearDown (self):
+		methods.load_properties = self.load_properties
+
+	def forge (self):
+		# the sequence is not retrieved with the other properties
+		document = self.document.copy()
+		del document["sequence"]
+
+		sequence = methods._forge_from_entry("Sequence", document)
+		sequence._projection = (False, [("sequence",), ("quality",)])
+
+		return sequence
+
+	def test_packed_as_blocks (self):
+		value = self.document["sequence"]
+
+		self.assertTrue("blocks" in value)
+		self.assertTrue(all(["packed" in block for block in value["blocks"]]))
+		self.assertEqual(Sequence._decode_sequence(value), self.contig)
+
+	def test_region (self):
+		sequence = self.forge()
+
+		for (start, end) in ((1, 500), (65000, 66000), (1999501, 2000000)):
+			self.assertEqual(sequence.get_subsequence(start, end), self.contig[start - 1:end])
+
+	def test_bytes_fetched (self):
+		sequence = self.forge()
+
+		# a window covers at most two blocks of 65,536 nucleotides,
+		# each packed as about 16 kB, out of 500 kB for the contig
+		for start in (1, 65300, 1000000):
+			del self.fetched[:]
+			sequence.get_subsequence(start, start + 499)
+
+			self.assertEqual(len(self.fetched), 1)
+			self.assertTrue(self.fetched[0] < 2 * 16500, self.fetched[0])
+
+if (__name__ == "__main__"):
+	unittest.main()
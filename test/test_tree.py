@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# Tests of the manipulation of nested dictionaries (see
+# MetagenomeDB.utils.tree). No MongoDB server is needed.
+# Usage: python test/test_tree.py
+
+import unittest
+
+from MetagenomeDB.utils import tree
+
+class ExpandKeyTest (unittest.TestCase):
+
+	def test_expand (self):
+		self.assertEqual(tree.expand_key("a.b.c"), ("a", "b", "c"))
+		self.assertEqual(tree.expand_key("a"), ("a",))
+		self.assertEqual(tree.expand_key(["a", "b"]), ("a", "b"))
+		self.assertEqual(tree.expand_key(("a", "b")), ("a", "b"))
+		self.assertEqual(tree.expand_key("a/b", '/'), ("a", "b"))
+
+	def test_type (self):
+		# str and unicode keys are expanded into tuples of their own type
+		self.assertEqual(type(tree.expand_key("a.b")[0]), str)
+		self.assertEqual(type(tree.expand_key(u"a.b")[0]), unicode)
+
+	def test_special_keys (self):
+		self.assertEqual(tree.expand_key("a.$gt"), ("a", "$gt"))
+		self.assertRaises(ValueError, tree.expand_key, "a.$gt.b")
+
+	def test_malformed (self):
+		for key in (1, None, ()):
+			self.assertRaises(ValueError, tree.expand_key, key)
+
+	def test_bounded_cache (self):
+		for i in xrange(tree._EXPANDED_KEYS_MAX + 10):
+			self.assertEqual(tree.expand_key("a.%s" % i), ("a", str(i)))
+
+		self.assertTrue(len(tree._expanded_keys) <= tree._EXPANDED_KEYS_MAX)
+
+class NestedKeyTest (unittest.TestCase):
+
+	def setUp (self):
+		self.dictionary = {"a": {"b": {"c": 1}, "d": 2}, "e": 3}
+
+	def test_get_set (self):
+		tree.set(self.dictionary, ("a", "b", "f"), 4)
+		tree.set(self.dictionary, ("g", "h"), 5)
+
+		self.assertEqual(tree.get(self.dictionary, ("a", "b", "f")), 4)
+		self.assertEqual(tree.get(self.dictionary, ("a", "d")), 2)
+		self.assertEqual(self.dictionary["g"], {"h": 5})
+		self.assertRaises(KeyError, tree.get, self.dictionary, ("a", "x"))
+
+	def test_contains (self):
+		self.assertTrue(tree.contains(self.dictionary, ("a", "b", "c")))
+		self.assertTrue(tree.contains(self.dictionary, ("e",)))
+		self.assertFalse(tree.contains(self.dictionary, ("a", "b", "x")))
+		self.assertFalse(tree.contains(self.dictionary, ("a", "d", "x")))
+		self.assertFalse(tree.contains(self.dictionary, ("x", "y")))
+
+	def test_delete (self):
+		# parent dictionaries left empty are removed as well
+		tree.delete(self.dictionary, ("a", "b", "c"))
+		self.assertEqual(self.dictionary, {"a": {"d": 2}, "e": 3})
+
+		tree.delete(self.dictionary, ("a", "d"))
+		self.assertEqual(self.dictionary, {"e": 3})
+
+		self.assertRaises(KeyError, tree.delete, self.dictionary, ("e", "x"))
+		self.assertRaises(KeyError, tree.delete, self.dictionary, ("x",))
+
+class TransformTest (unittest.TestCase):
+
+	def test_items (self):
+		m = {"a": {"b": {"c": 1}, "d": 2}, "e": {}}
+		self.assertEqual(sorted(tree.items(m)), [(("a", "b", "c"), 1), (("a", "d"), 2)])
+
+	def test_deep_items (self):
+		# nested dictionaries are browsed without recursion
+		m = node = {}
+		for i in xrange(5000):
+			node = node.setdefault("a", {})
+		node["b"] = 1
+
+		(key, value), = tree.items(m)
+		self.assertEqual(len(key), 5001)
+		self.assertEqual(value, 1)
+
+	def test_expand_flatten (self):
+		flat = {"a.b.c": 1, "a.d": 2, "e": 3}
+		nested = {"a": {"b": {"c": 1}, "d": 2}, "e": 3}
+
+		self.assertEqual(tree.expand(flat), nested)
+		self.assertEqual(tree.flatten(nested), flat)
+
+	def test_flatten_operators (self):
+		# operators are kept along with the key they apply to
+		query = {"a": {"b": {"$gt": 1, "$lt": 5}}, "c": {"$in": [1, 2]}}
+		self.assertEqual(tree.flatten(query), {"a.b": {"$gt": 1, "$lt": 5}, "c": {"$in": [1, 2]}})
+
+	def test_traverse (self):
+		m = {"a": {"b": 1, "_c": 2}, "_d": {"e": 3}}
+		m_ = tree.traverse(m,
+			selector = lambda key: key.startswith('_'),
+			key_modifier = lambda key: key[1:],
+			value_modifier = lambda value: value * 10)
+
+		self.assertEqual(m_, {"a": {"b": 1, "c": 20}, "d": {"e": 3}})
+		# the original dictionary is not modified
+		self.assertEqual(m, {"a": {"b": 1, "_c": 2}, "_d": {"e": 3}})
+
+if (__name__ == "__main__"):
+	unittest.main()
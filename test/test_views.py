@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+# Tests of the read-only views of nested dictionaries and lists (see
+# MetagenomeDB.utils.views). No MongoDB server is needed.
+# Usage: python test/test_views.py
+
+import unittest
+
+from MetagenomeDB.utils import views
+
+class ViewTest (unittest.TestCase):
+
+	def setUp (self):
+		self.value = {"a": [1, {"b": 2}], "c": {"d": [3]}, "e": 4}
+		self.view = views.view(self.value)
+
+	def test_types (self):
+		self.assertTrue(isinstance(self.view, views.DictView))
+		self.assertTrue(isinstance(self.view["a"], views.ListView))
+		self.assertTrue(isinstance(self.view["a"][1], views.DictView))
+		self.assertTrue(isinstance(self.view["a"][0:1], views.ListView))
+		self.assertTrue(isinstance(list(self.view["c"]["d"])[0], int))
+		self.assertEqual(views.view(4), 4)
+
+	def test_read (self):
+		self.assertEqual(self.view["a"][1]["b"], 2)
+		self.assertEqual(self.view["c"]["d"][-1], 3)
+		self.assertEqual(sorted(self.view.keys()), ["a", "c", "e"])
+		self.assertEqual(len(self.view), 3)
+		self.assertEqual(len(self.view["a"]), 2)
+		self.assertTrue("e" in self.view)
+		self.assertFalse("x" in self.view)
+		self.assertEqual(self.view.get("x", 5), 5)
+		self.assertRaises(KeyError, lambda: self.view["x"])
+		self.assertRaises(IndexError, lambda: self.view["a"][2])
+
+	def test_read_only (self):
+		def set_item (container, key, value):
+			container[key] = value
+
+		self.assertRaises(TypeError, set_item, self.view, "e", 5)
+		self.assertRaises(TypeError, set_item, self.view["a"], 0, 5)
+		self.assertRaises(TypeError, set_item, self.view["a"][1], "b", 5)
+		self.assertRaises(AttributeError, lambda: self.view["a"].append(5))
+		self.assertRaises(AttributeError, lambda: self.view.update({}))
+
+	def test_live (self):
+		# views reflect changes made to the underlying value
+		self.value["a"][1]["b"] = 5
+		self.assertEqual(self.view["a"][1]["b"], 5)
+
+	def test_equality (self):
+		self.assertEqual(self.view, self.value)
+		self.assertEqual(self.view, views.view(self.value))
+		self.assertEqual(self.view["a"], [1, {"b": 2}])
+		self.assertNotEqual(self.view["c"], {"d": []})
+		self.assertRaises(TypeError, hash, self.view)
+
+	def test_copy (self):
+		copy = self.view.copy()
+		copy["a"][1]["b"] = 5
+
+		self.assertEqual(type(copy), dict)
+		self.assertEqual(self.value["a"][1]["b"], 2)
+		self.assertEqual(type(self.view["a"].copy()), list)
+
+if (__name__ == "__main__"):
+	unittest.main()